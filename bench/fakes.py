@@ -0,0 +1,173 @@
+#
+# Offline stand-ins for the discord.py objects the bot touches.
+# They implement only the attributes and methods the bot uses, so hot paths can be
+# exercised without a gateway connection or any network access.
+#
+import asyncio
+import os
+import random
+import sys
+
+BENCH_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+REPO_DIRECTORY = os.path.dirname(BENCH_DIRECTORY)
+
+if REPO_DIRECTORY not in sys.path:
+    sys.path.insert(0, REPO_DIRECTORY)
+
+class FakePermissions:
+
+    def __init__(self, administrator = False):
+        self.administrator = administrator
+
+class FakeMember:
+
+    def __init__(self, memberId, name = None, administrator = False):
+        self.id = memberId
+        self.name = name or 'user{}'.format(memberId)
+        self.bot = False
+        self.guild_permissions = FakePermissions(administrator)
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def mention(self):
+        return '<@{}>'.format(self.id)
+
+# Raised by FakeRest like discord.HTTPException, with the attributes the bot looks at
+class FakeHTTPException(Exception):
+
+    def __init__(self, status, retry_after = None):
+        super(FakeHTTPException, self).__init__('{} from fake REST API'.format(status))
+        self.status = status
+        self.retry_after = retry_after
+
+#
+# Stand-in for Discord's REST API. Each request takes latency seconds plus a random jitter
+# averaging jitter seconds, and a rateLimited fraction of requests is answered with a 429.
+# Like discord.py's HTTP client, a 429 is retried after retryAfter seconds and only raised,
+# as a FakeHTTPException, once maxRetries retries were rate limited as well.
+#
+class FakeRest:
+
+    def __init__(self, latency = 0, jitter = 0, rateLimited = 0, retryAfter = 1.0, maxRetries = 5, seed = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rateLimited = rateLimited
+        self.retryAfter = retryAfter
+        self.maxRetries = maxRetries
+        self.generator = random.Random(seed)
+        self.requests = 0
+        self.rateLimits = 0
+        self.failures = 0
+
+    async def request(self):
+        for attempt in range(self.maxRetries + 1):
+            self.requests += 1
+            delay = self.latency
+            if self.jitter > 0:
+                delay += self.generator.expovariate(1 / self.jitter)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            if self.generator.random() >= self.rateLimited:
+                return
+
+            self.rateLimits += 1
+            if attempt == self.maxRetries:
+                self.failures += 1
+                raise FakeHTTPException(429, self.retryAfter)
+
+            await asyncio.sleep(self.retryAfter)
+
+class FakeChannel:
+
+    # latency is the number of seconds each send takes. With a FakeRest sends go through it instead.
+    def __init__(self, channelId, guild = None, latency = 0, rest = None):
+        self.id = channelId
+        self.guild = guild
+        self.latency = latency
+        self.rest = rest
+        self.sent = 0
+        self.sentCharacters = 0
+
+    async def send(self, content = None, embeds = None):
+        if self.rest != None:
+            await self.rest.request()
+        elif self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+        self.sent += 1
+        if content != None:
+            self.sentCharacters += len(content)
+
+class FakeDMChannel(FakeChannel):
+
+    def __init__(self, channelId, latency = 0):
+        super(FakeDMChannel, self).__init__(channelId, None, latency)
+        del self.guild
+
+#
+# Members are created on demand so large synthetic guilds do not need a member cache
+# holding every user up front.
+#
+class FakeGuild:
+
+    def __init__(self, guildId, name = None, channelIds = (), latency = 0, rest = None):
+        self.id = guildId
+        self.name = name or 'guild{}'.format(guildId)
+        self.channels = {channelId: FakeChannel(channelId, self, latency, rest) for channelId in channelIds}
+        self.departed = set()
+
+    def get_channel(self, channelId):
+        return self.channels.get(channelId)
+
+    def get_member(self, memberId):
+        if memberId in self.departed:
+            return None
+
+        return FakeMember(memberId)
+
+class FakeMessage:
+
+    def __init__(self, content, author, channel):
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.attachments = []
+
+class FakeGuildDirectory:
+
+    def __init__(self):
+        self.guilds = {}
+
+    def add(self, guild):
+        self.guilds[guild.id] = guild
+
+    def get_guild(self, guildId):
+        return self.guilds.get(guildId)
+
+# Builds fake guilds matching a data.json style dataset, one channel per configured channel id
+def buildGuilds(dataset, latency = 0, rest = None):
+    directory = FakeGuildDirectory()
+    for guildId, guildData in dataset.items():
+        channelIds = ()
+        if guildData.get('channel_id', -1) != -1:
+            channelIds = (guildData['channel_id'],)
+
+        directory.add(FakeGuild(int(guildId), guildData.get('name'), channelIds, latency, rest))
+
+    return directory
+
+#
+# Imports the bot module and sets it up against the given data file without connecting to
+# Discord. The data is loaded before returning.
+#
+def importBot(dataFile, backend = 'json'):
+    os.environ['DATA_FILE'] = dataFile
+    os.environ['DATA_STORAGE'] = backend
+
+    import main
+    main.setup()
+    main.store.load()
+    return main
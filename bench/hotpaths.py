@@ -0,0 +1,237 @@
+#
+# Benchmarks the bot's hot paths against a synthetic dataset:
+#   startup       loading the data file into a fresh storage backend
+#   save          flushing one mutation to disk
+#   announce      one announcement pass over every guild with a channel
+#   upcoming      the `!bday upcoming` command, rendered from scratch (cold) and from the
+#                 per guild cache (cached)
+#
+# Reports latency percentiles, throughput and peak traced memory for each path.
+# Results can be saved as a baseline and compared against later runs.
+#
+# Usage: python bench/hotpaths.py [--guilds N] [--users M] [--backend json|journal|sqlite|cached|binary]
+#                                 [--save-baseline FILE] [--baseline FILE]
+#
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from datetime import date
+
+from fakes import FakeMember, FakeMessage, buildGuilds, importBot
+from synthetic import generateDataset, writeDataset
+
+from outbound import SendQueue
+from storage import convertStorage, migrateJsonToSqlite, openStorage
+
+# Metrics compared against a baseline, and whether higher values are better
+COMPARED_METRICS = (('p50', False), ('p99', False), ('throughput', True), ('peakKiB', False))
+
+def percentile(sortedValues, fraction):
+    if len(sortedValues) == 0:
+        return 0
+
+    index = min(len(sortedValues) - 1, int(round(fraction * (len(sortedValues) - 1))))
+    return sortedValues[index]
+
+#
+# Summarizes the latencies of a path in milliseconds. Throughput is in operations per second,
+# where an operation is whatever the path counts, IE guilds for an announcement pass.
+#
+def summarize(latencies, operations, peakBytes):
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    return {
+        'samples': len(latencies),
+        'p50': percentile(latencies, 0.5) * 1000,
+        'p90': percentile(latencies, 0.9) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+        'max': latencies[-1] * 1000,
+        'throughput': operations / total if total > 0 else 0,
+        'peakKiB': peakBytes / 1024,
+    }
+
+# Runs the coroutine function once under tracemalloc and returns the peak traced memory
+async def measurePeak(run):
+    tracemalloc.start()
+    try:
+        await run()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+async def timeRepeated(run, repeat):
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await run()
+        latencies.append(time.perf_counter() - start)
+
+    return latencies
+
+async def benchStartup(dataFile, backend, repeat):
+    async def run():
+        store = openStorage(backend, dataFile)
+        store.load()
+        await store.close()
+
+    latencies = await timeRepeated(run, repeat)
+    return summarize(latencies, len(latencies), await measurePeak(run))
+
+async def benchSave(bot, generator, repeat):
+    guildIds = [guild.id for guild in bot.store.announceGuilds()]
+
+    async def run():
+        bot.store.setUser(generator.choice(guildIds), generator.randint(1, 10 ** 17), 'bench', generator.randint(1, 366))
+        await bot.store.flush()
+
+    latencies = await timeRepeated(run, repeat)
+    return summarize(latencies, len(latencies), await measurePeak(run))
+
+# The announcement ledger skips dates that were already announced, so every pass announces in a later year
+announceYears = itertools.count(2001)
+
+async def benchAnnounce(bot, guilds, day, repeat):
+    client = bot.client
+    announceGuilds = bot.store.announceGuilds()
+
+    async def run():
+        announceDate = day.replace(year = next(announceYears))
+        for guildData in announceGuilds:
+            await client.announceBirthdays(guildData.id, announceDate)
+        await client.sendQueue.drain()
+
+    latencies = await timeRepeated(run, repeat)
+    return summarize(latencies, len(announceGuilds) * len(latencies), await measurePeak(run))
+
+async def benchUpcoming(bot, guilds, generator, repeat, cached):
+    client = bot.client
+    author = FakeMember(1, administrator = True)
+    messages = []
+    for guildData in bot.store.announceGuilds():
+        guild = guilds.get_guild(guildData.id)
+        channel = guild.get_channel(guildData.channelId)
+        messages.append(FakeMessage('!bday upcoming', author, channel))
+
+    async def run():
+        message = generator.choice(messages)
+        if cached == False:
+            client.upcomingCache.clear()
+        await client.commandUpcoming(message, message.content.split())
+
+    if cached:
+        for message in messages:
+            await client.commandUpcoming(message, message.content.split())
+
+    latencies = await timeRepeated(run, repeat)
+    return summarize(latencies, len(latencies), await measurePeak(run))
+
+async def runSuite(options, dataFile):
+    generator = random.Random(options.seed)
+    results = {}
+
+    backendFile = dataFile
+    if options.backend in ('sqlite', 'cached'):
+        backendFile = os.path.join(os.path.dirname(dataFile), 'data.db')
+        migrateJsonToSqlite(dataFile, backendFile)
+    elif options.backend == 'binary':
+        backendFile = os.path.join(os.path.dirname(dataFile), 'data.bin')
+        convertStorage('json', dataFile, 'binary', backendFile)
+
+    results['startup'] = await benchStartup(backendFile, options.backend, options.startup_repeat)
+
+    bot = importBot(backendFile, options.backend)
+    with open(dataFile) as data_file:
+        guilds = buildGuilds(json.load(data_file))
+    bot.client.get_guild = guilds.get_guild
+
+    # Measure the pass itself rather than Discord's per channel rate limit
+    bot.client.sendQueue = SendQueue(channelRate = float('inf'), channelBurst = float('inf'))
+
+    # Popular dates are where announcement bursts come from
+    results['announce (Jan 1)'] = await benchAnnounce(bot, guilds, date(2021, 1, 1), options.repeat)
+    results['announce (Jun 15)'] = await benchAnnounce(bot, guilds, date(2021, 6, 15), options.repeat)
+    results['upcoming (cold)'] = await benchUpcoming(bot, guilds, generator, options.repeat * 10, False)
+    results['upcoming (cached)'] = await benchUpcoming(bot, guilds, generator, options.repeat * 10, True)
+    results['save'] = await benchSave(bot, generator, options.repeat)
+
+    await bot.store.close()
+    return results
+
+def printResults(results):
+    print('{:<20} {:>8} {:>10} {:>10} {:>10} {:>10} {:>12} {:>12}'.format(
+        'path', 'samples', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'ops/s', 'peak KiB'))
+    for path, summary in results.items():
+        print('{:<20} {:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>12.1f} {:>12.1f}'.format(
+            path, summary['samples'], summary['p50'], summary['p90'], summary['p99'], summary['max'],
+            summary['throughput'], summary['peakKiB']))
+
+# Prints the change of each metric against the baseline. Returns True if any path regressed.
+def compareResults(results, baseline, tolerance):
+    regressed = False
+    print('\nCompared to baseline (tolerance {:.0%}):'.format(tolerance))
+    for path, summary in results.items():
+        if path not in baseline:
+            continue
+
+        changes = []
+        for metric, higherIsBetter in COMPARED_METRICS:
+            before = baseline[path][metric]
+            after = summary[metric]
+            if before == 0:
+                continue
+
+            change = (after - before) / before
+            worse = change < -tolerance if higherIsBetter else change > tolerance
+            regressed = regressed or worse
+            changes.append('{} {:+.1%}{}'.format(metric, change, ' REGRESSION' if worse else ''))
+
+        print('{:<20} {}'.format(path, ', '.join(changes)))
+
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Birthday bot hot path benchmarks')
+    parser.add_argument('--guilds', type = int, default = 200)
+    parser.add_argument('--users', type = int, default = 500, help = 'average users per guild')
+    parser.add_argument('--skew', type = float, default = 0.05)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--backend', choices = ('json', 'journal', 'sqlite', 'cached', 'binary'), default = 'json')
+    parser.add_argument('--repeat', type = int, default = 20)
+    parser.add_argument('--startup-repeat', type = int, default = 5)
+    parser.add_argument('--save-baseline', metavar = 'FILE')
+    parser.add_argument('--baseline', metavar = 'FILE')
+    parser.add_argument('--tolerance', type = float, default = 0.1, help = 'allowed relative change before a metric counts as a regression')
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        dataFile = os.path.join(directory, 'data.json')
+        writeDataset(dataFile, generateDataset(options.guilds, options.users, options.skew, options.seed))
+
+        # The bot logs every guild it announces, keep that out of the report
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            results = asyncio.run(runSuite(options, dataFile))
+
+    print('{} guilds x ~{} users, backend {}'.format(options.guilds, options.users, options.backend))
+    printResults(results)
+
+    if options.save_baseline:
+        with open(options.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent = 2)
+
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if compareResults(results, baseline, options.tolerance):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
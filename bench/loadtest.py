@@ -0,0 +1,322 @@
+#
+# End-to-end load test of the bot's message handling, fully offline.
+# A fake gateway replays a mix of commands at a target rate across many synthetic guilds into
+# BirthdayBotClient.on_message, running each message as its own task the way discord.py
+# dispatches gateway events. Replies go to a fake REST API (see FakeRest) that adds latency
+# and answers a fraction of requests with 429s.
+#
+# Messages are sent on schedule whether or not earlier ones have finished, so a slow bot
+# shows up as growing latency instead of a lower send rate. Latency is measured from when a
+# message was due to when its handler returned. Reports per command kind:
+#   latency percentiles, and the sustained commands per second over the whole run
+# and for the run as a whole the 429s injected and how long the event loop stalled.
+#
+# The bot's command throttle is turned off unless --throttle is given, since the synthetic
+# traffic would otherwise be cut down to the throttle's limits. Throttled commands return
+# right away and are counted in the report.
+#
+# Usage: python bench/loadtest.py [--guilds N] [--users M] [--rate R] [--duration S]
+#                                 [--mix set=30,show=25,upcoming=20,delete=10,admin=15]
+#                                 [--latency MS] [--jitter MS] [--rate-limited FRACTION]
+#                                 [--backend json|journal|sqlite|cached|binary] [--throttle]
+#                                 [--json FILE] [--max-p99 MS]
+#
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from fakes import FakeChannel, FakeMember, FakeMessage, FakeRest, buildGuilds, importBot
+from hotpaths import percentile
+from synthetic import generateDataset, writeDataset
+
+from metrics import COMMANDS_THROTTLED
+from model import DAYS_IN_YEAR, fromDayOfYear
+from storage import convertStorage, migrateJsonToSqlite
+
+COMMAND_KINDS = ('set', 'show', 'upcoming', 'delete', 'admin')
+DEFAULT_MIX = 'set=30,show=25,upcoming=20,delete=10,admin=15'
+
+# Arguments of the admin timezone command
+TIMEZONES = ('UTC-5', 'UTC+1', 'America/New_York', 'Europe/Berlin', 'Asia/Tokyo')
+
+# Share of set commands coming from members without a birthday yet
+NEW_MEMBER_SHARE = 0.2
+
+# How often the stall monitor checks in, and how late it must be for the loop to count as stalled
+STALL_INTERVAL = 0.001
+STALL_THRESHOLD = 0.005
+
+# Parses 'set=30,show=25' into {'set': 30.0, 'show': 25.0}
+def parseMix(value):
+    mix = {}
+    for part in value.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in COMMAND_KINDS:
+            raise argparse.ArgumentTypeError('unknown command kind {!r}, expected one of {}'.format(kind, ', '.join(COMMAND_KINDS)))
+
+        try:
+            mix[kind] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError('invalid weight for {}: {!r}'.format(kind, weight))
+
+    if sum(mix.values()) <= 0:
+        raise argparse.ArgumentTypeError('the mix needs at least one positive weight')
+
+    return mix
+
+#
+# Builds the messages of the replay. Guilds are picked with weights falling off with their
+# rank, so a few busy guilds produce most of the traffic like on a real bot. Authors come
+# from each guild's registered members.
+#
+class MessageMix:
+
+    def __init__(self, dataset, guilds, mix, generator):
+        self.generator = generator
+        self.kinds = list(mix)
+        self.kindWeights = [mix[kind] for kind in self.kinds]
+        # [(guild, channel, [memberIds])]
+        self.targets = []
+        for guildId, guildData in dataset.items():
+            guild = guilds.get_guild(int(guildId))
+            channel = next(iter(guild.channels.values()))
+            self.targets.append((guild, channel, [int(userId) for userId in guildData.get('users', {})]))
+
+        self.targetWeights = [1 / (rank + 1) for rank in range(len(self.targets))]
+        self.nextMemberId = 1
+
+    def member(self, memberIds):
+        if len(memberIds) == 0 or self.generator.random() < NEW_MEMBER_SHARE:
+            self.nextMemberId += 1
+            return self.nextMemberId
+
+        return self.generator.choice(memberIds)
+
+    def date(self):
+        return '{}-{}'.format(*fromDayOfYear(self.generator.randint(1, DAYS_IN_YEAR)))
+
+    # Returns (kind, FakeMessage)
+    def next(self):
+        kind = self.generator.choices(self.kinds, self.kindWeights)[0]
+        guild, channel, memberIds = self.generator.choices(self.targets, self.targetWeights)[0]
+        author = FakeMember(self.member(memberIds))
+
+        if kind == 'set':
+            content = '!bday {}'.format(self.date())
+        elif kind == 'show':
+            content = '!bday'
+        elif kind == 'upcoming':
+            content = '!bday upcoming'
+        elif kind == 'delete':
+            content = '!bday delete'
+        else:
+            author = FakeMember(author.id, administrator = True)
+            content = self.generator.choice((
+                '!bday <@!{}> {}'.format(self.member(memberIds), self.date()),
+                '!bday timezone {}'.format(self.generator.choice(TIMEZONES)),
+                '!bday hour {}'.format(self.generator.randint(1, 24)),
+            ))
+
+        return kind, FakeMessage(content, author, channel)
+
+#
+# Measures how late the event loop runs a short sleep. Lateness beyond STALL_THRESHOLD is
+# time the loop spent on one task while others waited.
+#
+class StallMonitor:
+
+    def __init__(self, interval = STALL_INTERVAL):
+        self.interval = interval
+        self.lags = []
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0, loop.time() - start - self.interval))
+
+    def stop(self):
+        if self.task != None:
+            self.task.cancel()
+
+    def summary(self):
+        lags = sorted(self.lags)
+        return {
+            'samples': len(lags),
+            'stalledSeconds': sum(lag for lag in lags if lag > STALL_THRESHOLD),
+            'stalls': sum(1 for lag in lags if lag > STALL_THRESHOLD),
+            'p99': percentile(lags, 0.99) * 1000,
+            'max': (lags[-1] if len(lags) > 0 else 0) * 1000,
+        }
+
+async def deliver(client, kind, message, due, latencies, errors):
+    loop = asyncio.get_running_loop()
+    try:
+        await client.on_message(message)
+    except Exception as error:
+        errors[type(error).__name__] = errors.get(type(error).__name__, 0) + 1
+
+    latencies[kind].append(loop.time() - due)
+
+#
+# Sends rate messages per second for duration seconds, each as its own task. Returns the
+# seconds from the first message until the last handler finished.
+#
+async def replay(client, messages, rate, duration, latencies, errors):
+    loop = asyncio.get_running_loop()
+    tasks = set()
+    started = loop.time()
+    for index in range(int(rate * duration)):
+        due = started + index / rate
+        delay = due - loop.time()
+        # Behind schedule, messages that are due are sent right away in a burst
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        kind, message = messages.next()
+        task = loop.create_task(deliver(client, kind, message, due, latencies, errors))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    if len(tasks) > 0:
+        await asyncio.wait(tasks)
+
+    return loop.time() - started
+
+def summarizeKind(latencies, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'samples': len(latencies),
+        'p50': percentile(latencies, 0.5) * 1000,
+        'p90': percentile(latencies, 0.9) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+        'max': (latencies[-1] if len(latencies) > 0 else 0) * 1000,
+        'throughput': len(latencies) / elapsed if elapsed > 0 else 0,
+    }
+
+async def runLoadTest(options, dataFile, dataset):
+    backendFile = dataFile
+    if options.backend in ('sqlite', 'cached'):
+        backendFile = os.path.join(os.path.dirname(dataFile), 'data.db')
+        migrateJsonToSqlite(dataFile, backendFile)
+    elif options.backend == 'binary':
+        backendFile = os.path.join(os.path.dirname(dataFile), 'data.bin')
+        convertStorage('json', dataFile, 'binary', backendFile)
+
+    bot = importBot(backendFile, options.backend)
+    rest = FakeRest(options.latency / 1000, options.jitter / 1000, options.rate_limited, options.retry_after, seed = options.seed)
+    guilds = buildGuilds(dataset, rest = rest)
+    for guild in guilds.guilds.values():
+        # Guilds without a configured channel take commands in any channel
+        if len(guild.channels) == 0:
+            guild.channels[guild.id] = FakeChannel(guild.id, guild, rest = rest)
+
+    client = bot.client
+    client.get_guild = guilds.get_guild
+    messages = MessageMix(dataset, guilds, options.mix, random.Random(options.seed))
+
+    latencies = {kind: [] for kind in options.mix}
+    errors = {}
+    monitor = StallMonitor()
+    monitor.start()
+    elapsed = await replay(client, messages, options.rate, options.duration, latencies, errors)
+    monitor.stop()
+
+    closeStarted = time.perf_counter()
+    await bot.store.close()
+    closeSeconds = time.perf_counter() - closeStarted
+
+    results = {kind: summarizeKind(kindLatencies, elapsed) for kind, kindLatencies in latencies.items()}
+    results['all'] = summarizeKind([latency for kindLatencies in latencies.values() for latency in kindLatencies], elapsed)
+    return {
+        'commands': results,
+        'eventLoop': monitor.summary(),
+        'rest': {'requests': rest.requests, 'rateLimits': rest.rateLimits, 'failures': rest.failures},
+        'throttled': {scope: COMMANDS_THROTTLED.get(scope = scope) for scope in ('user', 'guild')},
+        'errors': errors,
+        'elapsed': elapsed,
+        'closeSeconds': closeSeconds,
+    }
+
+def printResults(options, report):
+    print('{} guilds x ~{} users, backend {}, {} commands/s offered for {}s'.format(
+        options.guilds, options.users, options.backend, options.rate, options.duration))
+    print('REST latency {} ms + ~{} ms jitter, {:.1%} of requests rate limited'.format(options.latency, options.jitter, options.rate_limited))
+    print()
+    print('{:<10} {:>8} {:>10} {:>10} {:>10} {:>10} {:>12}'.format('command', 'samples', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'commands/s'))
+    for kind, summary in report['commands'].items():
+        print('{:<10} {:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>12.1f}'.format(
+            kind, summary['samples'], summary['p50'], summary['p90'], summary['p99'], summary['max'], summary['throughput']))
+
+    eventLoop = report['eventLoop']
+    rest = report['rest']
+    print()
+    print('event loop: stalled {:.3f}s in {} stalls over {:.0f} ms, lag p99 {:.3f} ms, max {:.3f} ms'.format(
+        eventLoop['stalledSeconds'], eventLoop['stalls'], STALL_THRESHOLD * 1000, eventLoop['p99'], eventLoop['max']))
+    print('REST: {} requests, {} rate limited, {} failed after retries'.format(rest['requests'], rest['rateLimits'], rest['failures']))
+    if options.throttle:
+        print('throttled: {} by user, {} by guild'.format(report['throttled']['user'], report['throttled']['guild']))
+    print('run took {:.2f}s, final flush {:.3f}s'.format(report['elapsed'], report['closeSeconds']))
+    if len(report['errors']) > 0:
+        print('handler errors: {}'.format(', '.join('{} {}'.format(name, count) for name, count in sorted(report['errors'].items()))))
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Birthday bot end-to-end load test')
+    parser.add_argument('--guilds', type = int, default = 500)
+    parser.add_argument('--users', type = int, default = 200, help = 'average users per guild')
+    parser.add_argument('--skew', type = float, default = 0.05)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--backend', choices = ('json', 'journal', 'sqlite', 'cached', 'binary'), default = 'json')
+    parser.add_argument('--cache-size', type = int, help = 'GUILD_CACHE_SIZE of the cached backend')
+    parser.add_argument('--rate', type = float, default = 200, help = 'commands per second')
+    parser.add_argument('--duration', type = float, default = 10, help = 'seconds')
+    parser.add_argument('--mix', type = parseMix, default = parseMix(DEFAULT_MIX), help = 'relative weights of the command kinds')
+    parser.add_argument('--latency', type = float, default = 50, help = 'REST latency in milliseconds')
+    parser.add_argument('--jitter', type = float, default = 20, help = 'mean extra REST latency in milliseconds')
+    parser.add_argument('--rate-limited', type = float, default = 0.01, help = 'fraction of REST requests answered with a 429')
+    parser.add_argument('--retry-after', type = float, default = 1.0, help = 'seconds a 429 asks to wait')
+    parser.add_argument('--throttle', action = 'store_true', help = 'keep the command throttle on, with its configured limits')
+    parser.add_argument('--json', metavar = 'FILE', help = 'also write the report to FILE')
+    parser.add_argument('--max-p99', type = float, metavar = 'MS', help = 'exit with status 1 if the overall p99 latency is higher')
+    options = parser.parse_args()
+
+    if options.cache_size != None:
+        os.environ['GUILD_CACHE_SIZE'] = str(options.cache_size)
+
+    if options.throttle == False:
+        os.environ['COMMAND_USER_RATE'] = '0'
+        os.environ['COMMAND_GUILD_RATE'] = '0'
+
+    dataset = generateDataset(options.guilds, options.users, options.skew, options.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        dataFile = os.path.join(directory, 'data.json')
+        writeDataset(dataFile, dataset)
+
+        # Keep the bot's own logging out of the report
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            report = asyncio.run(runLoadTest(options, dataFile, dataset))
+
+    printResults(options, report)
+
+    if options.json:
+        with open(options.json, 'w') as report_file:
+            json.dump(report, report_file, indent = 2)
+
+    if options.max_p99 != None and report['commands']['all']['p99'] > options.max_p99:
+        print('\noverall p99 of {:.3f} ms is above the limit of {} ms'.format(report['commands']['all']['p99'], options.max_p99))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
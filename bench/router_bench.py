@@ -0,0 +1,73 @@
+#
+# Measures how many messages per second go through the command router.
+# Handlers are no-ops, so this only covers prefix filtering, tokenization, dispatch and the
+# declarative permission checks.
+#
+# Usage: python bench/router_bench.py [--messages N]
+#
+import argparse
+import asyncio
+import logging
+import time
+
+from fakes import FakeChannel, FakeGuild, FakeMember, FakeMessage
+
+from commands import DATE_PATTERN, USER_PATTERN, CommandRouter
+
+MESSAGES = (
+    'hello everyone',
+    '!bday',
+    '!bday 7-4',
+    '!bday <@!123456789012345678> 7-4',
+    '!bday upcoming',
+    '!bday delete',
+    '!bday help',
+    '!bday timezone UTC-5',
+    '!bday unknown',
+)
+
+class Client:
+
+    def isValidChannel(self, message):
+        return True
+
+async def handle(client, message, args):
+    pass
+
+def buildRouter():
+    router = CommandRouter(('!birthday', '!bday'), 'server only', 'admin only')
+    router.register(None, handle, serverOnly = True)
+    router.register('channel', handle, serverOnly = True, adminOnly = True, anyChannel = True)
+    for name in ('help', 'about'):
+        router.register(name, handle)
+    for name in ('delete', 'upcoming'):
+        router.register(name, handle, serverOnly = True)
+    for name in ('timezone', 'hour', 'wipe_all', 'announce'):
+        router.register(name, handle, serverOnly = True, adminOnly = True)
+    router.registerPattern('user', USER_PATTERN, handle, serverOnly = True, adminOnly = True)
+    router.registerPattern('set', DATE_PATTERN, handle, serverOnly = True)
+    return router
+
+async def run(count):
+    router = buildRouter()
+    client = Client()
+    author = FakeMember(1, administrator = True)
+    channel = FakeChannel(2, FakeGuild(3))
+    messages = [FakeMessage(MESSAGES[i % len(MESSAGES)], author, channel) for i in range(count)]
+
+    # The router logs unknown commands at info level, keep that out of the measurement
+    logging.getLogger('commands').setLevel(logging.WARNING)
+
+    start = time.perf_counter()
+    for message in messages:
+        await router.dispatch(client, message)
+    elapsed = time.perf_counter() - start
+
+    print('Dispatched {} messages in {:.3f} s'.format(count, elapsed))
+    print('{:.0f} messages/s, {:.2f} us/message'.format(count / elapsed, elapsed / count * 1e6))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Command router throughput benchmark')
+    parser.add_argument('--messages', type = int, default = 200000)
+    options = parser.parse_args()
+    asyncio.run(run(options.messages))
@@ -0,0 +1,136 @@
+#
+# Benchmarks startup against synthetic datasets of increasing size:
+#   import        importing main.py in a fresh interpreter
+#   json.load     parsing the whole data file at once, for reference
+#   load          loading the data file into the storage backend
+#   loadAsync     the same load run on the event loop next to other tasks the way the bot
+#                 does while it connects. Also reports the longest time the loop was blocked.
+#
+# Usage: python bench/startup.py [--sizes 100x100,1000x100,5000x100] [--backend json|journal|sqlite|cached|binary]
+#
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from fakes import REPO_DIRECTORY
+from synthetic import generateDataset, writeDataset
+
+from main import loadStore
+from storage import convertStorage, migrateJsonToSqlite, openStorage
+
+# How often the ticker checks in while measuring how long loadAsync blocks the event loop
+TICK_SECONDS = 0.001
+
+def parseSizes(string):
+    sizes = []
+    for size in string.split(','):
+        guilds, users = size.split('x')
+        sizes.append((int(guilds), int(users)))
+
+    return sizes
+
+# Returns the time taken by run and, from a second run under tracemalloc, its peak traced memory
+def measure(run):
+    start = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    try:
+        run()
+        return elapsed, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def benchImport():
+    environment = dict(os.environ, DISCORD_TOKEN = '')
+    command = 'import time; start = time.perf_counter(); import main; print(time.perf_counter() - start)'
+    output = subprocess.run([sys.executable, '-c', command], cwd = REPO_DIRECTORY, env = environment,
+        capture_output = True, text = True, check = True).stdout
+    return float(output.strip().splitlines()[-1])
+
+def benchJsonLoad(dataFile):
+    def run():
+        with open(dataFile) as data_file:
+            json.load(data_file)
+
+    return measure(run)
+
+def benchLoad(dataFile, backend):
+    def run():
+        store = openStorage(backend, dataFile)
+        store.load()
+        store.closeSync()
+
+    return measure(run)
+
+# Returns the load time and the longest gap between ticks of a task sharing the event loop
+async def benchLoadAsync(dataFile, backend):
+    longestGap = 0
+    loading = True
+
+    async def tick():
+        nonlocal longestGap
+        last = time.perf_counter()
+        while loading:
+            await asyncio.sleep(TICK_SECONDS)
+            now = time.perf_counter()
+            longestGap = max(longestGap, now - last - TICK_SECONDS)
+            last = now
+
+    ticker = asyncio.create_task(tick())
+    await asyncio.sleep(0)
+
+    store = openStorage(backend, dataFile)
+    start = time.perf_counter()
+    await loadStore(store)
+    elapsed = time.perf_counter() - start
+
+    loading = False
+    await ticker
+    await store.close()
+    return elapsed, longestGap
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Birthday bot startup benchmark')
+    parser.add_argument('--sizes', type = parseSizes, default = parseSizes('100x100,1000x100,5000x100'),
+        help = 'comma separated GUILDSxUSERS dataset sizes')
+    parser.add_argument('--backend', choices = ('json', 'journal', 'sqlite', 'cached', 'binary'), default = 'json')
+    parser.add_argument('--seed', type = int, default = 0)
+    options = parser.parse_args()
+
+    print('import main: {:.1f} ms'.format(benchImport() * 1000))
+    print('{:<14} {:>10} {:<10} {:>10} {:>12} {:>14}'.format('dataset', 'file KiB', 'path', 'ms', 'peak KiB', 'max stall ms'))
+
+    for guilds, users in options.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            dataFile = os.path.join(directory, 'data.json')
+            writeDataset(dataFile, generateDataset(guilds, users, seed = options.seed))
+            label = '{}x{}'.format(guilds, users)
+            fileKiB = os.path.getsize(dataFile) / 1024
+
+            backendFile = dataFile
+            if options.backend in ('sqlite', 'cached'):
+                backendFile = os.path.join(directory, 'data.db')
+                migrateJsonToSqlite(dataFile, backendFile)
+            elif options.backend == 'binary':
+                backendFile = os.path.join(directory, 'data.bin')
+                convertStorage('json', dataFile, 'binary', backendFile)
+
+            elapsed, peak = benchJsonLoad(dataFile)
+            print('{:<14} {:>10.0f} {:<10} {:>10.1f} {:>12.1f} {:>14}'.format(label, fileKiB, 'json.load', elapsed * 1000, peak / 1024, '-'))
+
+            elapsed, peak = benchLoad(backendFile, options.backend)
+            print('{:<14} {:>10.0f} {:<10} {:>10.1f} {:>12.1f} {:>14}'.format(label, fileKiB, 'load', elapsed * 1000, peak / 1024, '-'))
+
+            elapsed, longestGap = asyncio.run(benchLoadAsync(backendFile, options.backend))
+            print('{:<14} {:>10.0f} {:<10} {:>10.1f} {:>12} {:>14.1f}'.format(label, fileKiB, 'loadAsync', elapsed * 1000, '-', longestGap * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#
+# Generates synthetic data.json datasets for benchmarks.
+#
+# Usage: python bench/synthetic.py OUTPUT --guilds N --users M [--skew S] [--seed SEED]
+#
+import argparse
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model import DAYS_IN_YEAR, formatStoredDate
+
+# Dates that draw a disproportionate share of registrations
+POPULAR_DAYS = (1, 359, 60)  # January 1st, December 25th, February 29th
+
+# UTC offsets in use across guilds, weighted towards the Americas and Europe
+TIMEZONES = (-8, -8, -7, -6, -5, -5, -5, -4, -3, 0, 0, 1, 1, 2, 3, 5, 8, 9, 10, 12)
+
+# Snowflake sized ids, so ids are as long as real ones when serialized
+FIRST_ID = 100000000000000000
+
+#
+# Returns a dataset with the layout of data.json.
+# skew is the fraction of users whose birthday is on one of POPULAR_DAYS. The remaining
+# users are spread over the year. Channels, timezones and announce hours vary per guild.
+#
+def generateDataset(guildCount, usersPerGuild, skew = 0.05, seed = 0, userSpread = 0.5):
+    generator = random.Random(seed)
+    dataset = {}
+    nextId = FIRST_ID
+
+    for guildIndex in range(guildCount):
+        guildId = nextId
+        nextId += 1
+
+        # Guild sizes vary around usersPerGuild
+        userCount = max(1, int(usersPerGuild * generator.uniform(1 - userSpread, 1 + userSpread)))
+        users = {}
+        for userIndex in range(userCount):
+            if generator.random() < skew:
+                birthday = generator.choice(POPULAR_DAYS)
+            else:
+                birthday = generator.randint(1, DAYS_IN_YEAR)
+
+            users[str(nextId)] = {'name': 'user{}'.format(nextId), 'date': formatStoredDate(birthday)}
+            nextId += 1
+
+        guildData = {'name': 'guild{}'.format(guildIndex), 'users': users}
+
+        # Most guilds configure a channel, some keep the defaults
+        if generator.random() < 0.9:
+            guildData['channel_id'] = nextId
+            nextId += 1
+
+        if generator.random() < 0.7:
+            guildData['timezone'] = generator.choice(TIMEZONES)
+
+        if generator.random() < 0.5:
+            guildData['announce_hour'] = generator.randint(1, 24)
+
+        dataset[str(guildId)] = guildData
+
+    return dataset
+
+def writeDataset(fileName, dataset):
+    with open(fileName, 'w') as data_file:
+        json.dump(dataset, data_file, indent = 2)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Generate a synthetic data.json')
+    parser.add_argument('output')
+    parser.add_argument('--guilds', type = int, default = 100)
+    parser.add_argument('--users', type = int, default = 100, help = 'average users per guild')
+    parser.add_argument('--skew', type = float, default = 0.05)
+    parser.add_argument('--seed', type = int, default = 0)
+    options = parser.parse_args()
+
+    writeDataset(options.output, generateDataset(options.guilds, options.users, options.skew, options.seed))
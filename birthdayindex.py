@@ -0,0 +1,132 @@
+import bisect
+
+#
+# One guild's birthdays ordered by day, then by user id. Kept as two parallel tuples rather
+# than a sequence of pairs, which would cost a tuple per user.
+#
+# Instances are never modified. Changes return a new instance and the index swaps it in, so
+# a reader holding one keeps a consistent view however the guild changes meanwhile.
+#
+class SortedBirthdays:
+    __slots__ = ('days', 'userIds')
+
+    def __init__(self, entries = ()):
+        entries = sorted(entries)
+        self.days = tuple(birthday for birthday, userId in entries)
+        self.userIds = tuple(userId for birthday, userId in entries)
+
+    @classmethod
+    def fromSorted(cls, days, userIds):
+        sortedBirthdays = cls.__new__(cls)
+        sortedBirthdays.days = days
+        sortedBirthdays.userIds = userIds
+        return sortedBirthdays
+
+    def __len__(self):
+        return len(self.days)
+
+    # Position of the entry in the lists, or of where it would be inserted
+    def position(self, userId, birthday):
+        first = bisect.bisect_left(self.days, birthday)
+        last = bisect.bisect_right(self.days, birthday, first)
+        return bisect.bisect_left(self.userIds, userId, first, last)
+
+    # Returns a copy with the entry added
+    def added(self, userId, birthday):
+        index = self.position(userId, birthday)
+        return SortedBirthdays.fromSorted(self.days[:index] + (birthday,) + self.days[index:],
+            self.userIds[:index] + (userId,) + self.userIds[index:])
+
+    # Returns a copy without the entry, or this instance if it has no such entry
+    def removed(self, userId, birthday):
+        index = self.position(userId, birthday)
+        if index >= len(self.days) or self.days[index] != birthday or self.userIds[index] != userId:
+            return self
+
+        return SortedBirthdays.fromSorted(self.days[:index] + self.days[index + 1:], self.userIds[:index] + self.userIds[index + 1:])
+
+    def entries(self):
+        return zip(self.days, self.userIds)
+
+    def usersOn(self, birthday):
+        first = bisect.bisect_left(self.days, birthday)
+        last = bisect.bisect_right(self.days, birthday, first)
+        return list(self.userIds[first:last])
+
+    # Returns (userId, birthday) pairs for the days start through end, wrapping past the end of the year if start is after end
+    def between(self, start, end):
+        first = bisect.bisect_left(self.days, start)
+        last = bisect.bisect_right(self.days, end)
+        if start <= end:
+            return list(zip(self.userIds[first:last], self.days[first:last]))
+
+        return list(zip(self.userIds[first:], self.days[first:])) + list(zip(self.userIds[:last], self.days[:last]))
+
+EMPTY_BIRTHDAYS = SortedBirthdays()
+
+#
+# In-memory calendar of birthdays, kept up to date incrementally by the storage layer as users
+# are set and deleted. Callers pass the previous birthday when a user is replaced or removed.
+#
+# Each guild keeps its birthdays sorted by day, so the birthdays on a day or in a range of
+# days are a bisect and a slice rather than a walk over every user.
+#
+class CalendarIndex:
+
+    def __init__(self):
+        # {guildId: SortedBirthdays}
+        self.guildDays = {}
+
+    def clear(self):
+        self.guildDays.clear()
+
+    def add(self, guildId, userId, birthday):
+        self.guildDays[guildId] = self.sortedBirthdays(guildId).added(userId, birthday)
+
+    def remove(self, guildId, userId, birthday):
+        sortedBirthdays = self.guildDays.get(guildId)
+        if sortedBirthdays == None:
+            return
+
+        sortedBirthdays = sortedBirthdays.removed(userId, birthday)
+        if len(sortedBirthdays) == 0:
+            del self.guildDays[guildId]
+        else:
+            self.guildDays[guildId] = sortedBirthdays
+
+    #
+    # Replaces a batch of the guild's users with one rebuild of its sorted birthdays instead of
+    # a copy per user. previous maps the replaced or removed users to their old UserRecords and
+    # users maps the added ones to their new UserRecords.
+    #
+    def replaceUsers(self, guildId, previous, users):
+        entries = [(user.birthday, userId) for userId, user in users.items()]
+        current = self.guildDays.pop(guildId, None)
+        if current != None:
+            entries.extend((birthday, userId) for birthday, userId in current.entries() if userId not in previous and userId not in users)
+
+        if len(entries) > 0:
+            self.guildDays[guildId] = SortedBirthdays(entries)
+
+    # users is the guild's {userId: UserRecord} map
+    def addGuild(self, guildId, users):
+        self.replaceUsers(guildId, {}, users)
+
+    def removeGuild(self, guildId, users):
+        self.replaceUsers(guildId, users, {})
+
+    # Returns the guild's current SortedBirthdays, which later changes do not affect
+    def sortedBirthdays(self, guildId):
+        return self.guildDays.get(guildId, EMPTY_BIRTHDAYS)
+
+    #
+    # Returns a list of (userId, birthday) for the guild's birthdays between the days start and
+    # end inclusive, ordered by date from start. Wraps around the end of the year if start is
+    # after end.
+    #
+    def between(self, guildId, start, end):
+        sortedBirthdays = self.guildDays.get(guildId)
+        if sortedBirthdays == None:
+            return []
+
+        return sortedBirthdays.between(start, end)
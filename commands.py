@@ -0,0 +1,134 @@
+import logging
+import re
+
+from metrics import COMMAND_SECONDS
+
+log = logging.getLogger(__name__)
+
+# Patterns are compiled once here instead of on every message
+USER_PATTERN = re.compile(r'<@!?(\d+)>')
+DATE_PATTERN = re.compile(r'(\d+)[- ](\d+)')
+TIMEZONE_PATTERN = re.compile(r'[uU][tT][cC]([-+]\d+)')
+
+def isAdminMessage(message):
+    return message.author.guild_permissions.administrator
+
+def isServerMessage(message):
+    try:
+        return message.channel.guild != None
+    except:
+        return False
+
+# Returns the id of the message's guild, or None for direct messages
+def guildIdOf(message):
+    guild = getattr(message.channel, 'guild', None)
+    return guild.id if guild != None else None
+
+def userMatch(string):
+    return USER_PATTERN.match(string)
+
+def dateMatch(string):
+    dateRegex = DATE_PATTERN.match(string)
+    if dateRegex == None:
+        return None
+
+    return (int(dateRegex.group(1)), int(dateRegex.group(2)))
+
+#
+# A command handler and the checks that must pass before it runs.
+# name: label the command's metrics are recorded under
+# serverOnly: the command must be sent from a server channel
+# adminOnly: the sender must be a server admin
+# anyChannel: skip the check that the command comes from the configured bot channel
+#
+class Command:
+    __slots__ = ('name', 'handler', 'serverOnly', 'adminOnly', 'anyChannel')
+
+    def __init__(self, name, handler, serverOnly = False, adminOnly = False, anyChannel = False):
+        self.name = name
+        self.handler = handler
+        self.serverOnly = serverOnly
+        self.adminOnly = adminOnly
+        self.anyChannel = anyChannel
+
+#
+# Table driven command dispatch.
+# Subcommands are looked up by name in a dict. Arguments that are values rather than names,
+# like `!bday @user` or `!bday 7-4`, are matched against the registered patterns in order.
+# Handlers are called as handler(client, message, args) with args being the whitespace
+# separated words of the message, prefix included. Handlers that change a guild's data hold
+# client.guildLocks.lock(guildId) around the change only, never while replying.
+#
+# With a throttle (see throttle.py) commands over the sender's or guild's limit are dropped
+# right after the prefix check. The sender gets throttledReply now and then, or nothing if
+# it is None.
+#
+class CommandRouter:
+
+    def __init__(self, prefixes, serverOnlyReply, adminOnlyReply, throttle = None, throttledReply = None):
+        self.prefixes = prefixes
+        self.serverOnlyReply = serverOnlyReply
+        self.adminOnlyReply = adminOnlyReply
+        self.throttle = throttle
+        self.throttledReply = throttledReply
+        self.commands = {}
+        self.patterns = []
+        self.default = None
+
+    # Registers a subcommand. A name of None registers the command run with no arguments.
+    def register(self, name, handler, **checks):
+        if name == None:
+            self.default = Command('show', handler, **checks)
+        else:
+            self.commands[name] = Command(name, handler, **checks)
+
+    # name labels the command's metrics, since the matched argument is a value
+    def registerPattern(self, name, pattern, handler, **checks):
+        self.patterns.append((pattern, Command(name, handler, **checks)))
+
+    def resolve(self, args):
+        if len(args) < 2:
+            return self.default
+
+        command = self.commands.get(args[1])
+        if command != None:
+            return command
+
+        for pattern, command in self.patterns:
+            if pattern.match(args[1]) != None:
+                return command
+
+        return None
+
+    # Returns True if the message was a command for this bot
+    async def dispatch(self, client, message):
+        if message.content.startswith(self.prefixes) == False:
+            return False
+
+        if self.throttle != None and self.throttle.check(message.author.id, guildIdOf(message)) != None:
+            if self.throttledReply != None and self.throttle.shouldWarn(message.author.id):
+                await message.channel.send(self.throttledReply)
+            return True
+
+        args = message.content.split()
+        command = self.resolve(args)
+        if command == None:
+            log.info('Received unknown command', extra = {'content': message.content})
+            return True
+
+        # Commands must come from a DM or the guild's configured channel, unless exempt
+        if command.anyChannel == False and client.isValidChannel(message) == False:
+            return True
+
+        if command.serverOnly and isServerMessage(message) == False:
+            await message.channel.send(self.serverOnlyReply)
+            return True
+
+        if command.adminOnly and isAdminMessage(message) == False:
+            await message.channel.send(self.adminOnlyReply)
+            return True
+
+        with COMMAND_SECONDS.time(subcommand = command.name):
+            await command.handler(client, message, args)
+
+        return True
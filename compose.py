@@ -0,0 +1,76 @@
+import discord
+
+# Discord rejects messages longer than this
+MESSAGE_LIMIT = 2000
+
+# Limits on embed descriptions, embeds per message and total embed text per message
+EMBED_DESCRIPTION_LIMIT = 4096
+EMBEDS_PER_MESSAGE = 10
+EMBED_TOTAL_LIMIT = 6000
+
+#
+# Packs lines into as few messages as possible, each at most limit characters long.
+# The header, if given, starts the first message. Lines longer than the limit on their own
+# are split.
+#
+def packLines(lines, header = None, limit = MESSAGE_LIMIT):
+    messages = []
+    current = []
+    currentLength = 0
+
+    if header != None:
+        lines = [header] + list(lines)
+
+    for line in lines:
+        while len(line) > limit:
+            messages.extend(packLines(current, limit = limit))
+            current = []
+            currentLength = 0
+            messages.append(line[:limit])
+            line = line[limit:]
+
+        # Lines are joined with a newline
+        addedLength = len(line) + (1 if len(current) > 0 else 0)
+        if currentLength + addedLength > limit:
+            messages.append('\n'.join(current))
+            current = []
+            currentLength = 0
+            addedLength = len(line)
+
+        current.append(line)
+        currentLength += addedLength
+
+    if len(current) > 0:
+        messages.append('\n'.join(current))
+
+    return messages
+
+#
+# Builds embed pages titled 'title (page/pages)' holding as many lines as fit in each
+# description, then groups the pages into messages within Discord's per message limits.
+# Returns a list of lists of embeds, one list per message to send.
+#
+def packEmbeds(title, lines):
+    descriptions = packLines(lines, limit = EMBED_DESCRIPTION_LIMIT)
+    if len(descriptions) == 0:
+        return []
+
+    messages = []
+    current = []
+    currentLength = 0
+    for page, description in enumerate(descriptions):
+        pageTitle = title
+        if len(descriptions) > 1:
+            pageTitle = '{} ({}/{})'.format(title, page + 1, len(descriptions))
+
+        embedLength = len(pageTitle) + len(description)
+        if len(current) == EMBEDS_PER_MESSAGE or currentLength + embedLength > EMBED_TOTAL_LIMIT:
+            messages.append(current)
+            current = []
+            currentLength = 0
+
+        current.append(discord.Embed(title = pageTitle, description = description))
+        currentLength += embedLength
+
+    messages.append(current)
+    return messages
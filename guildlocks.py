@@ -0,0 +1,24 @@
+import asyncio
+import weakref
+
+#
+# One asyncio lock per guild. Code that changes a guild's data, or reads it and then writes
+# based on what it read, holds the guild's lock so such changes never interleave at await
+# points. Other guilds are not held up, and readers use storage snapshots instead of locking.
+# The lock is held around the change only. Replies and other Discord requests are made after
+# releasing it, so a slow request does not hold up the guild's other writers or announcements.
+#
+# Locks are created on first use and dropped once nothing holds or waits on them.
+#
+class GuildLocks:
+
+    def __init__(self):
+        self.locks = weakref.WeakValueDictionary()
+
+    def lock(self, guildId):
+        lock = self.locks.get(guildId)
+        if lock == None:
+            lock = asyncio.Lock()
+            self.locks[guildId] = lock
+
+        return lock
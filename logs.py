@@ -0,0 +1,48 @@
+import json
+import logging
+import sys
+
+# Attributes every LogRecord has. Anything else was passed through `extra` and is a field.
+STANDARD_ATTRIBUTES = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime'}
+
+def recordFields(record):
+    return {key: value for key, value in record.__dict__.items() if key not in STANDARD_ATTRIBUTES}
+
+#
+# Formats records as 'time level logger message key=value ...', or as one JSON object per
+# line with asJson. Fields come from the `extra` argument of the logging call.
+#
+class StructuredFormatter(logging.Formatter):
+
+    def __init__(self, asJson = False):
+        super(StructuredFormatter, self).__init__()
+        self.asJson = asJson
+
+    def format(self, record):
+        fields = recordFields(record)
+        if record.exc_info:
+            fields['exception'] = self.formatException(record.exc_info)
+
+        if self.asJson:
+            entry = {
+                'time': self.formatTime(record),
+                'level': record.levelname,
+                'logger': record.name,
+                'message': record.getMessage(),
+            }
+            entry.update(fields)
+            return json.dumps(entry, default = str)
+
+        text = '{} {} {} {}'.format(self.formatTime(record), record.levelname, record.name, record.getMessage())
+        for key, value in fields.items():
+            text += ' {}={}'.format(key, json.dumps(value, default = str) if isinstance(value, str) and ' ' in value else value)
+
+        return text
+
+def configureLogging(level = 'INFO', asJson = False):
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(StructuredFormatter(asJson))
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level.upper())
@@ -1,24 +1,86 @@
 import asyncio
+import gc
+import logging
 import os
-import json
-import re
+import signal
+import tempfile
+import time
 
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 
 import discord
 from dotenv import load_dotenv
 
+from commands import DATE_PATTERN, TIMEZONE_PATTERN, USER_PATTERN, CommandRouter, dateMatch, isAdminMessage, isServerMessage, userMatch
+from compose import packEmbeds, packLines
+from guildlocks import GuildLocks
+from logs import configureLogging
+from metrics import ANNOUNCE_BIRTHDAYS, monitorEventLoopLag, startMetricsServer
+from model import LEAP_YEAR, fromDayOfYear, toDayOfYear
+from outbound import DEFAULT_DRAIN_TIMEOUT, SendQueue
+from reconcile import Reconciler
+from scheduler import MAX_UTC_OFFSET, MIN_UTC_OFFSET, AnnouncementScheduler, findTimezone, missedAnnouncements, toLocalTime
+from sharding import parseShardIds, shardOf
+from storage import DEFAULT_CACHE_CAPACITY, openStorage
+from throttle import DEFAULT_GUILD_BURST, DEFAULT_GUILD_RATE, DEFAULT_USER_BURST, DEFAULT_USER_RATE, CommandThrottle
+from transfer import FORMATS, exportChunks, formatOf, openImportBytes, parseImport
+
 # Load API key and configuration as environment variables from file
 load_dotenv()
 
 TOKEN = os.getenv('DISCORD_TOKEN')
 GUILD = os.getenv('DISCORD_GUILD')
 
-DEFAULT_DATA_FILE = 'data.json'
+# Storage backend, one of 'json', 'journal', 'sqlite', 'cached' or 'binary'. DATA_FILE overrides the backend's default file.
+DATA_STORAGE = os.getenv('DATA_STORAGE', 'json')
+DATA_FILE = os.getenv('DATA_FILE')
+# Birthdays the 'cached' backend keeps in memory, the rest stay in its SQLite database until used
+GUILD_CACHE_SIZE = int(os.getenv('GUILD_CACHE_SIZE', DEFAULT_CACHE_CAPACITY))
+
+# Total number of gateway shards and the ones this process runs, IE '0,2'. Discord picks the
+# shard count if unset. With SHARD_COUNT set the data is partitioned by shard, see sharding.py.
+SHARD_COUNT = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+SHARD_IDS = parseShardIds(os.getenv('SHARD_IDS')) if os.getenv('SHARD_IDS') else None
+
+# Log verbosity and format, 'text' or 'json'
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+
+# Port to serve Prometheus metrics on at /metrics. Metrics are not served if unset.
+METRICS_PORT = os.getenv('METRICS_PORT')
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
+# How far back announcements missed while the bot was down or disconnected are still made, in hours
+ANNOUNCE_CATCHUP_WINDOW = timedelta(hours = float(os.getenv('ANNOUNCE_CATCHUP_HOURS', '24')))
+# Announcements that were not delivered are sent again with the guild's next one, a day later
+ANNOUNCE_RETRY_WINDOW = ANNOUNCE_CATCHUP_WINDOW + timedelta(days = 1)
+
+# Commands each user, and each guild's users together, may send per second and in a burst.
+# Commands over the limit are dropped before they are parsed. A rate of 0 turns the limit off.
+COMMAND_USER_RATE = float(os.getenv('COMMAND_USER_RATE', DEFAULT_USER_RATE))
+COMMAND_USER_BURST = int(os.getenv('COMMAND_USER_BURST', DEFAULT_USER_BURST))
+COMMAND_GUILD_RATE = float(os.getenv('COMMAND_GUILD_RATE', DEFAULT_GUILD_RATE))
+COMMAND_GUILD_BURST = int(os.getenv('COMMAND_GUILD_BURST', DEFAULT_GUILD_BURST))
+# Tell throttled users to slow down, at most every 30 seconds. Otherwise their commands are dropped silently.
+COMMAND_THROTTLE_REPLY = os.getenv('COMMAND_THROTTLE_REPLY', 'true').lower() in ('1', 'true', 'yes')
+
+# How long shutting down waits for queued announcements to be sent, in seconds
+SEND_DRAIN_TIMEOUT = float(os.getenv('SEND_DRAIN_TIMEOUT', DEFAULT_DRAIN_TIMEOUT))
+
+# Show `upcoming` as paginated embeds instead of plain text messages
+UPCOMING_EMBEDS = os.getenv('UPCOMING_EMBEDS', '').lower() in ('1', 'true', 'yes')
+
+log = logging.getLogger(__name__)
+
 DEFAULT_TIME_ZONE = -7
 DEFAULT_NOTIFICATION_HOUR = 12
 COMMAND_PREFIXES = ('!birthday', '!bday')
 
+# Largest attachment `import` accepts
+IMPORT_MAX_BYTES = 2 * 1024 * 1024
+# Discord looks up at most this many members per request
+MEMBER_QUERY_LIMIT = 100
+
 COMMAND_NONE = '''
 > Please specify a command.
 > Type `!bday help` for list of commands.
@@ -59,22 +121,32 @@ COMMAND_HELP_ADMIN = '''
 > 
 > __**Birthdaybot Admin Commands**__
 > 
-> `timezone UTC(+/-)#`
+> `timezone ZONE`
 > This command sets the server time zone
-> Example: `timezone UTC-5` sets the time zone to US Eastern Time.
+> `ZONE` is a time zone name, which follows daylight saving time, or a fixed UTC offset.
+> Example: `timezone America/New_York` sets the time zone to US Eastern Time, `timezone UTC-5` to a fixed UTC-5.
 > Default: UTC-8 (US Pacific Time)
 > 
 > `hour HH`
 > This command sets when birthdays should be notified to the server.
 > It expects an hour in 24 HR format. IE 6 = 6:00 AM, 09 = 9:00 AM, 22 = 10:00 PM
 > Default: Noon (12:00 PM UTC-7)
-> Note: Announcements should be made near the beginning of the hour. IE 12:05-12:10
+> Note: Announcements are made at the beginning of the hour.
 > 
 > `channel`
 > This command sets the birthday announcement channel to the current channel.
 > Birthday bot commands will be restricted to this channel.
 > Default: No announcements will be made if no channel is set.
 >
+> `import`
+> Imports birthdays from an attached CSV or JSON file, replacing the birthdays of the users in it.
+> CSV files need a header row with `user_id`, `name` and `date` columns, IE `1234,Alice,7-4`.
+> JSON files map user ids to `{"name": ..., "date": ...}` like `export json` produces.
+> Rows for users who are not on this server or with invalid dates are skipped and reported.
+> 
+> `export [csv|json]`
+> Exports the birthdays of this server as a file. Default: csv
+>
 > `wipe_all`
 > This command wipes all user data related to the current server.
 '''
@@ -99,182 +171,416 @@ COMMAND_SERVER_ONLY = '''
 > Please use this command in a server channel.
 '''
 
-# load server settings and user information from data.json
-data = {}
-try:
-    with open(DEFAULT_DATA_FILE) as data_file:
-        data = json.load(data_file)
-        print(data)
-except:
-    print('No data file found. Creating...')
-    with open(DEFAULT_DATA_FILE, 'w') as data_file:
-        json.dump(data, data_file)
-
-def saveData(dataToSave, dataFileName = DEFAULT_DATA_FILE):
-    with open(dataFileName, 'w') as data_file:
-        json.dump(dataToSave, data_file, indent = 2)
-
-def isAdminMessage(message):
-    return message.author.guild_permissions.administrator
-
-def isServerMessage(message):
-    try:
-        return message.channel.guild != None
-    except:
-        return False
+COMMAND_THROTTLED = '''
+> You're sending commands too quickly, please slow down.
+'''
+
+# Created by setup(). Importing this module has no side effects beyond reading the configuration.
+store = None
+client = None
 
 def getGuildData(guildId):
-    return data[str(guildId)]
+    return store.getGuild(guildId)
 
 def deleteGuildData(guildId):
-    del data[str(guildId)]
-    saveData(data)
+    store.deleteGuild(guildId)
 
 def getUserData(guildId, userId):
-    return data[str(guildId)]['users'][str(userId)]
+    return store.getUser(guildId, userId)
 
 def deleteUserData(guildId, userId):
-    del data[str(guildId)]['users'][str(userId)]
-    saveData(data)
-
-def userMatch(string):
-    return re.compile('<@!(\d+)>').match(string)
+    store.deleteUser(guildId, userId)
 
-def dateMatch(string):
-    dateRegex = re.compile('(\d+)[- ](\d+)').match(string)
-    if dateRegex == None:
+# Returns the birthday in a MM-DD argument as a day of the year, or None if it is not a valid date
+def parseBirthday(string):
+    dateMatches = dateMatch(string)
+    if dateMatches == None:
         return None
 
-    return (int(dateRegex.group(1)), int(dateRegex.group(2)))
+    try:
+        return toDayOfYear(dateMatches[0], dateMatches[1])
+    except ValueError:
+        return None
 
+# Returns the guild's time zone name or fixed UTC offset in hours
 def getTimezone(guildData):
-    try:
-        return guildData['timezone']
-    except KeyError:
+    if guildData.timezone == None:
         return DEFAULT_TIME_ZONE
 
+    return guildData.timezone
+
+def formatTimezone(timezone):
+    if isinstance(timezone, str):
+        return timezone
+
+    return 'UTC{:+d}'.format(timezone)
+
+# Returns the current local time in the guild as a naive datetime
+def getLocalNow(guildData):
+    return toLocalTime(getTimezone(guildData), datetime.utcnow())
+
 def getAnnounceHour(guildData):
-    try:
-        return guildData['announce_hour']
-    except KeyError:
+    if guildData.announceHour == None:
         return DEFAULT_NOTIFICATION_HOUR
 
-def getDatetimeFromBirthday(birthday, year = datetime.utcnow().year):
-    return datetime(year, birthday[0], birthday[1])
+    return guildData.announceHour
+
+# expects a birthday as a day of the year. The year is only used for formatting.
+def getDatetimeFromBirthday(birthday):
+    return datetime(LEAP_YEAR, *fromDayOfYear(birthday))
+
+#
+# Loads the store on the running event loop. The loaded records hold no reference cycles, so
+# collecting while they pile up only stalls the loop, and freezing them afterwards keeps
+# later collections from rescanning them.
+#
+async def loadStore(store):
+    gc.disable()
+    try:
+        await store.loadAsync()
+    finally:
+        gc.enable()
 
-class BirthdayBotClient(discord.Client):
+    gc.freeze()
+
+#
+# Announcements of one guild queued together by postAnnouncements, one send group per date.
+# messages is {ISO date: [contents]}, unsent collects what each date could not deliver.
+#
+class AnnouncementPost:
+    __slots__ = ('guildId', 'ledgerDate', 'remaining', 'unsent')
+
+    def __init__(self, guildId, ledgerDate, messages):
+        self.guildId = guildId
+        self.ledgerDate = ledgerDate
+        self.remaining = len(messages)
+        self.unsent = {}
+
+class BirthdayBotClient(discord.AutoShardedClient):
 
     def __init__(self):
         intents = discord.Intents.default()
         intents.members = True
 
-        super(BirthdayBotClient, self).__init__(intents = intents)
-
-    async def sampleBirthdayLoop(self):
-        while True:
-            await self.sampleBirthdays()
-
-            # Sleep until 5 minutes into the next hour
-            currentMinute = datetime.utcnow().minute
-            sleepMinutes = 65 - currentMinute
-            print('Announcements for this hour finished. waiting {} minutes\n'.format(sleepMinutes))
-            await asyncio.sleep(sleepMinutes * 60)
+        super(BirthdayBotClient, self).__init__(intents = intents, shard_count = SHARD_COUNT, shard_ids = SHARD_IDS)
+
+        # Each shard runs its own announcement schedule. {shardId: AnnouncementScheduler}
+        self.schedulers = {}
+        self.sendQueue = SendQueue()
+        # Announcements queued but not delivered yet. {guildId: AnnouncementPost}
+        self.undelivered = {}
+        # Messages of posted dates that were not delivered, [] for dates that were. {guildId: {ISO date: [contents]}}
+        self.unsent = {}
+        # Held while changing a guild's data, see CommandRouter
+        self.guildLocks = GuildLocks()
+        self.metricsServer = None
+        self.lagMonitor = None
+        self.reconciler = Reconciler(self, store)
+        # Task loading the stored data, started before connecting to the gateway
+        self.loading = None
+        # Task closing the client after a SIGTERM
+        self.closing = None
+        # Rendered `upcoming` replies. {guildId: ((localDate, birthdayVersion), [send kwargs])}
+        self.upcomingCache = {}
+
+    def shardOfGuild(self, guildId):
+        return shardOf(guildId, self.shard_count or 1)
+
+    def schedulerForShard(self, shardId):
+        scheduler = self.schedulers.get(shardId)
+        if scheduler == None:
+            # Without a prefetch the scheduler only wakes up for announcements
+            scheduler = AnnouncementScheduler(self.announceBirthdays, store.prefetch if store.pagesGuilds else None)
+            self.schedulers[shardId] = scheduler
+
+        return scheduler
+
+    def schedulerFor(self, guildId):
+        return self.schedulerForShard(self.shardOfGuild(guildId))
+
+    #
+    # Adds the guild to the announcement schedule, or updates its entry after a settings change.
+    # guildData saves looking up the guild when the caller already has its settings.
+    #
+    def scheduleGuild(self, guildId, includeCurrentHour = False, guildData = None):
+        try:
+            if guildData == None:
+                guildData = getGuildData(guildId)
+        except KeyError:
+            self.schedulerFor(guildId).unschedule(guildId)
+            return
 
-    async def sampleBirthdays(self, forGuild = 'all'):
-        if self.is_ready() == False:
-            print('Client not ready. Waiting...')
+        if guildData.hasChannel() == False:
+            self.schedulerFor(guildId).unschedule(guildId)
             return
 
-        for guildId, guildData in data.items():
+        self.schedulerFor(guildId).schedule(guildId, getTimezone(guildData), getAnnounceHour(guildData),
+            includeCurrentHour = includeCurrentHour)
+
+    #
+    # Announces the birthdays on the given local date. Called by the scheduler at the announce hour.
+    # Dates up to the guild's last_announced ledger entry are skipped, so a date is announced
+    # once no matter how often this runs. Earlier dates the ledger is missing, because their
+    # announcements were not delivered, are announced along with it as far back as
+    # ANNOUNCE_RETRY_WINDOW. Returns False if the guild could not be announced to.
+    #
+    async def announceBirthdays(self, guildId, announceDate):
+        async with self.guildLocks.lock(guildId):
             try:
-                if guildData['channel_id'] == -1:
-                    continue
+                guildData = getGuildData(guildId)
             except KeyError:
+                # Removed since it was scheduled
+                return True
+
+            dates = [announceDate]
+            # Usually the ledger is at the day before, with nothing missed in between
+            if guildData.lastAnnounced != None and guildData.lastAnnounced < (announceDate - timedelta(days = 1)).isoformat():
+                missed = missedAnnouncements(getTimezone(guildData), getAnnounceHour(guildData),
+                    date.fromisoformat(guildData.lastAnnounced), datetime.utcnow(), ANNOUNCE_RETRY_WINDOW)
+                dates = [missedDate for missedDate in missed if missedDate < announceDate] + dates
+
+            snapshot = store.snapshot(guildId, toDayOfYear(dates[0].month, dates[0].day), toDayOfYear(announceDate.month, announceDate.day))
+            return self.postAnnouncements(snapshot, dates, announceDate)
+
+    #
+    # Queues the announcements of a GuildSnapshot for the dates, oldest first, and moves the
+    # guild's ledger to ledgerDate once every message has been delivered. Dates that are
+    # already in the ledger or still being delivered are skipped. Of dates that were posted
+    # before without being fully delivered, only the messages that did not go out are sent.
+    # Returns False if the guild could not be announced to. Callers hold the guild's lock.
+    #
+    def postAnnouncements(self, guildData, dates, ledgerDate):
+        guildId = guildData.id
+        inFlight = self.undelivered.get(guildId)
+        announced = max(guildData.lastAnnounced or '', inFlight.ledgerDate if inFlight != None else '')
+        if ledgerDate.isoformat() <= announced:
+            log.debug('Already announced', extra = {'guild_id': guildId, 'date': ledgerDate.isoformat()})
+            return True
+
+        guild = self.get_guild(guildId)
+        if guild == None:
+            log.warning('Guild is not available. Skipping announcements', extra = {'guild_id': guildId})
+            return False
+
+        announceChannel = guild.get_channel(guildData.channelId)
+        if announceChannel == None:
+            log.warning('Announcement channel no longer exists', extra = {'guild_id': guildId, 'channel_id': guildData.channelId})
+            return False
+
+        log.debug('Computing announcements', extra = {'guild_id': guildId})
+
+        unsent = self.unsent.pop(guildId, {})
+        # {ISO date: [message contents]}
+        messages = {}
+        for announceDate in dates:
+            isoDate = announceDate.isoformat()
+            if isoDate <= announced:
                 continue
 
-            if forGuild != 'all':
-                print(forGuild)
-                print(guildId)
-                if guildId != forGuild:
-                    continue
+            contents = unsent.get(isoDate)
+            if contents == None:
+                day = toDayOfYear(announceDate.month, announceDate.day)
+                lines = ['Happy birthday to <@!{}>!'.format(userId) for userId in guildData.birthdaysOn(day)]
+                ANNOUNCE_BIRTHDAYS.inc(len(lines))
+                contents = packLines(lines)
 
-            guild = self.get_guild(int(guildId))
-            announceChannel = guild.get_channel(guildData['channel_id'])
-            print('Computing announcements for guild {}'.format(guild))
+            if len(contents) > 0:
+                messages[isoDate] = contents
 
-            timezone = getTimezone(guildData)
-            announceHour= getAnnounceHour(guildData)
+        if len(messages) == 0:
+            store.setGuildSetting(guildId, 'last_announced', ledgerDate.isoformat())
+            return True
 
-            date = datetime.utcnow() + timedelta(hours = timezone)
-            print(date)
-            if date.hour == announceHour:
-                print("Making announcements this hour")
-            else:
-                print("Skipping this hour")
+        # Sends are queued so a slow channel does not hold up the other guilds
+        post = AnnouncementPost(guildId, ledgerDate.isoformat(), messages)
+        self.undelivered[guildId] = post
+        for isoDate, contents in messages.items():
+            self.sendQueue.sendGroup(announceChannel, contents,
+                lambda undelivered, isoDate = isoDate: self.announcementsDelivered(post, isoDate, undelivered))
+        return True
+
+    # Called by the send queue once the announcements of a date queued by postAnnouncements are sent or given up on
+    def announcementsDelivered(self, post, isoDate, undelivered):
+        post.unsent[isoDate] = undelivered
+        post.remaining -= 1
+        if post.remaining > 0:
+            return
+
+        guildId = post.guildId
+        if self.undelivered.get(guildId) is post:
+            del self.undelivered[guildId]
+
+        if any(len(contents) > 0 for contents in post.unsent.values()):
+            self.unsent.setdefault(guildId, {}).update(post.unsent)
+            log.warning('Announcements were not delivered, they are sent again with the guild\'s next announcement',
+                extra = {'guild_id': guildId, 'date': post.ledgerDate})
+            return
+
+        try:
+            guildData = getGuildData(guildId)
+        except KeyError:
+            return
+
+        if guildData.lastAnnounced == None or guildData.lastAnnounced < post.ledgerDate:
+            store.setGuildSetting(guildId, 'last_announced', post.ledgerDate)
+
+    #
+    # Announces the birthdays the guilds of a shard missed while the bot was down or the shard
+    # disconnected, as far back as ANNOUNCE_CATCHUP_WINDOW. Guilds without a ledger entry have
+    # nothing to catch up. The missed dates that have birthdays come from one range lookup
+    # per guild. Guilds are only looked up again, under their lock, if they missed a date.
+    #
+    async def catchUpAnnouncements(self, shardId):
+        now = datetime.utcnow()
+        announced = 0
+        for guildData in list(store.announceGuilds()):
+            if self.shardOfGuild(guildData.id) != shardId or guildData.lastAnnounced == None:
                 continue
 
-            # Collect a list of birthday members
-            birthdayPeople = []
-            for userId, userData in guildData['users'].items():
-                dateMatches = dateMatch(userData['date'])
-                if dateMatches == None:
-                    print('DATA_ERROR: Date format for user {} is invalid'.format(userId))
-                    continue
+            try:
+                announced += await self.catchUpGuild(guildData, now)
+            except Exception:
+                log.exception('Could not catch up on missed announcements', extra = {'guild_id': guildData.id})
+
+        if announced > 0:
+            log.info('Caught up on missed announcements', extra = {'shard_id': shardId, 'announcements': announced})
+
+    # Catches up one guild with a ledger entry. Returns the number of dates announced.
+    async def catchUpGuild(self, guildData, now):
+        guildId = guildData.id
+        if len(missedAnnouncements(getTimezone(guildData), getAnnounceHour(guildData),
+                date.fromisoformat(guildData.lastAnnounced), now, ANNOUNCE_CATCHUP_WINDOW)) == 0:
+            return 0
 
-                if dateMatches[0] == date.month and dateMatches[1] == date.day:
-                    birthdayPeople.append(guild.get_member(int(userId)))
-                    await announceChannel.send('Happy birthday to <@!{}>!'.format(userId))
+        async with self.guildLocks.lock(guildId):
+            try:
+                guildData = getGuildData(guildId)
+            except KeyError:
+                return 0
+
+            if guildData.lastAnnounced == None:
+                return 0
+
+            dates = missedAnnouncements(getTimezone(guildData), getAnnounceHour(guildData),
+                date.fromisoformat(guildData.lastAnnounced), now, ANNOUNCE_CATCHUP_WINDOW)
+            if len(dates) == 0:
+                return 0
+
+            startDay = toDayOfYear(dates[0].month, dates[0].day)
+            endDay = toDayOfYear(dates[-1].month, dates[-1].day)
+            guildData = store.snapshot(guildId, startDay, endDay)
+            days = {birthday for userId, birthday in guildData.birthdaysBetween(startDay, endDay)}
+            # Dates without birthdays are only recorded, along with the others
+            missed = [missedDate for missedDate in dates if toDayOfYear(missedDate.month, missedDate.day) in days]
+            if self.postAnnouncements(guildData, missed, dates[-1]) == False:
+                return 0
+
+        return len(missed)
+
+    async def sampleBirthdays(self, forGuild):
+        if self.is_ready() == False:
+            log.info('Client not ready. Waiting...')
+            return
+
+        guildData = getGuildData(forGuild)
+        if guildData.hasChannel() == False:
+            return
+
+        date = getLocalNow(guildData)
+        if date.hour != getAnnounceHour(guildData):
+            log.info('Skipping this hour', extra = {'guild_id': forGuild, 'local_time': date.isoformat()})
+            return
+
+        log.info('Making announcements this hour', extra = {'guild_id': forGuild, 'local_time': date.isoformat()})
+
+        await self.announceBirthdays(forGuild, date.date())
 
     def ensureGuildDataExists(self, guild):
         try:
             getGuildData(guild.id)
         except KeyError:
-            print('No data found for current guild. Creating')
-            guildData = {'name': guild.name, 'users' : {}}
-            data[str(guild.id)] = guildData
-            saveData(data)
+            log.info('No data found for current guild. Creating', extra = {'guild_id': guild.id})
+            store.createGuild(guild.id, guild.name)
 
     def isValidChannel(self, message):
         # Always allow DMs to go through
         if isServerMessage(message) == False:
-            print('Is private message')
+            log.debug('Is private message')
             return True
 
         guild = message.channel.guild
         self.ensureGuildDataExists(guild)
         guildData = getGuildData(guild.id)
 
-        try:
-            if guildData['channel_id'] == -1:
-                return True
-        except:
+        if guildData.hasChannel() == False:
             return True
 
-        return guildData['channel_id'] == message.channel.id
+        return guildData.channelId == message.channel.id
 
     def setChannel(self, message):
         guild = message.channel.guild
         self.ensureGuildDataExists(guild)
-        data[str(guild.id)]['channel_id'] = message.channel.id
-        saveData(data)
+        store.setGuildSetting(guild.id, 'channel_id', message.channel.id)
+        self.scheduleGuild(guild.id)
 
     def setTimezone(self, message, utcOffset):
         guild = message.channel.guild
         self.ensureGuildDataExists(guild)
-        data[str(guild.id)]['timezone'] = utcOffset
-        saveData(data)
+        store.setGuildSetting(guild.id, 'timezone', utcOffset)
+        self.scheduleGuild(guild.id)
 
     def setHour(self, message, hour):
         guild = message.channel.guild
         self.ensureGuildDataExists(guild)
-        data[str(guild.id)]['announce_hour'] = hour
-        saveData(data)
+        store.setGuildSetting(guild.id, 'announce_hour', hour)
+        self.scheduleGuild(guild.id)
 
-    # expects date in the form of a tuple (month, day)
-    def setBirthday(self, guild, member, date):
+    # expects a birthday as a day of the year
+    def setBirthday(self, guild, member, birthday):
         self.ensureGuildDataExists(guild)
-        data[str(guild.id)]['users'][str(member.id)] = {'name': member.name, 'date' : '{}-{}'.format(date[0], date[1])}
-        saveData(data)
+        store.setUser(guild.id, member.id, member.name, birthday)
+
+    # Sets many birthdays at once, as one change to the store. users is a list of (member, birthday).
+    def setBirthdays(self, guild, users):
+        self.ensureGuildDataExists(guild)
+        store.setUsers(guild.id, ((member.id, member.name, birthday) for member, birthday in users))
+
+    # Returns {memberId: member} for the ids that belong to members of the guild
+    async def resolveMembers(self, guild, memberIds):
+        members = {}
+        missing = []
+        for memberId in memberIds:
+            member = guild.get_member(memberId)
+            if member != None:
+                members[memberId] = member
+            else:
+                missing.append(memberId)
+
+        # Members that are not cached are looked up in batches instead of one request each
+        for start in range(0, len(missing), MEMBER_QUERY_LIMIT):
+            try:
+                found = await guild.query_members(user_ids = missing[start:start + MEMBER_QUERY_LIMIT], limit = MEMBER_QUERY_LIMIT)
+            except (asyncio.TimeoutError, discord.ClientException):
+                log.warning('Failed to look up members', exc_info = True, extra = {'guild_id': guild.id})
+                continue
+
+            for member in found:
+                members[member.id] = member
+
+        return members
+
+    # Drops all data of the guild. Returns False if it had none.
+    def forgetGuild(self, guildId):
+        try:
+            deleteGuildData(guildId)
+        except KeyError:
+            return False
+
+        self.upcomingCache.pop(guildId, None)
+        self.undelivered.pop(guildId, None)
+        self.unsent.pop(guildId, None)
+        self.schedulerFor(guildId).unschedule(guildId)
+        return True
 
     def getBirthday(self, guild, memberId):
         self.ensureGuildDataExists(guild)
@@ -288,293 +594,472 @@ class BirthdayBotClient(discord.Client):
         try:
             deleteUserData(guild.id, memberId)
         except KeyError:
-            print('No data found for user while deleting.')
+            log.info('No data found for user while deleting', extra = {'guild_id': guild.id, 'user_id': memberId})
             
+    async def setup_hook(self):
+        self.loading = asyncio.create_task(self.loadData())
+        self.handleSignals()
+
+    #
+    # Closes the client on SIGTERM, as sent by docker and systemd, so changes still waiting for
+    # the flush delay are written and queued announcements sent. discord.py only handles
+    # KeyboardInterrupt itself.
+    #
+    def handleSignals(self):
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self.terminate)
+        except NotImplementedError:
+            # Event loops on Windows do not support signal handlers
+            log.debug('SIGTERM is not handled on this platform')
+
+    def terminate(self):
+        log.info('Received SIGTERM, shutting down')
+        if self.closing == None:
+            self.closing = asyncio.get_running_loop().create_task(self.close())
+
+    # Loads the stored data while the gateway connection is being set up
+    async def loadData(self):
+        started = time.perf_counter()
+        try:
+            await loadStore(store)
+        except Exception:
+            log.exception('Failed to load data')
+            # Closing cancels this task if it is still running, so close from a separate one
+            asyncio.create_task(self.close())
+            raise
+
+        log.info('Loaded data', extra = {'seconds': round(time.perf_counter() - started, 3)})
+
+    # Waits until the stored data is loaded. Events that read or change the data must call this first.
+    async def waitForData(self):
+        if self.loading != None and self.loading.done() == False:
+            await asyncio.shield(self.loading)
+
+    async def close(self):
+        if self.loading != None and self.loading.done() == False:
+            self.loading.cancel()
+
+        for scheduler in self.schedulers.values():
+            scheduler.stop()
+        self.reconciler.stop()
+        # Queued announcements get a chance to go out. The ledger stays behind for any that do not, so catch-up announces them after the restart.
+        if await self.sendQueue.drain(SEND_DRAIN_TIMEOUT) == False:
+            log.warning('Closing with messages still queued', extra = {'messages': self.sendQueue.pending})
+        self.sendQueue.close()
+        if self.lagMonitor != None:
+            self.lagMonitor.cancel()
+        if self.metricsServer != None:
+            self.metricsServer.close()
+        try:
+            await super(BirthdayBotClient, self).close()
+        finally:
+            # Write out any changes still waiting for the debounce window
+            await store.close()
+
+    async def on_shard_ready(self, shardId):
+        log.info('Shard connected', extra = {'shard_id': shardId, 'shard_count': self.shard_count})
+
+        await self.waitForData()
+
+        # on_shard_ready fires again after reconnects, the schedule only needs to be built once
+        scheduler = self.schedulerForShard(shardId)
+        if scheduler.task == None:
+            for guildData in store.announceGuilds():
+                if self.shardOfGuild(guildData.id) != shardId:
+                    continue
+
+                # A guild with settings that cannot be scheduled must not keep the rest of the shard from being announced
+                try:
+                    self.scheduleGuild(guildData.id, includeCurrentHour = True, guildData = guildData)
+                except Exception:
+                    log.exception('Could not schedule guild', extra = {'guild_id': guildData.id})
+
+            scheduler.start()
+
+        await self.catchUpAnnouncements(shardId)
+
     async def on_ready(self):
-        print(f'{self.user} has connected to the server.')
-        self.loop.create_task(self.sampleBirthdayLoop())
+        log.info('Connected to the server', extra = {'user': str(self.user), 'shards': self.shard_ids})
+
+        if self.lagMonitor != None:
+            return
+
+        self.lagMonitor = asyncio.create_task(monitorEventLoopLag())
+        self.reconciler.start()
+        if METRICS_PORT:
+            self.metricsServer = await startMetricsServer(METRICS_HOST, int(METRICS_PORT))
+
+    # Raw so members who were not in the member cache are removed as well
+    async def on_raw_member_remove(self, payload):
+        await self.waitForData()
+        async with self.guildLocks.lock(payload.guild_id):
+            try:
+                deleteUserData(payload.guild_id, payload.user.id)
+            except KeyError:
+                return
+
+        log.info('Removed birthday of departed member', extra = {'guild_id': payload.guild_id, 'user_id': payload.user.id})
+
+    # The bot was kicked or banned, left the guild, or the guild was deleted
+    async def on_guild_remove(self, guild):
+        await self.waitForData()
+        async with self.guildLocks.lock(guild.id):
+            forgotten = self.forgetGuild(guild.id)
+
+        if forgotten:
+            log.info('Removed data of departed guild', extra = {'guild_id': guild.id})
 
     async def commandGetUserBirthday(self, channel, user):
         guild = channel.guild
         try:
-            userBirthday = getUserData(guild.id, user.id)['date']
+            userBirthday = getUserData(guild.id, user.id).birthday
         except KeyError:
             await channel.send('> {} has no birthday set on this server!'.format(user))
             return True
 
-        await channel.send('> {}\'s birthday is {}!'.format(user, getDatetimeFromBirthday(dateMatch(userBirthday)).strftime('%B, %d')))
+        await channel.send('> {}\'s birthday is {}!'.format(user, getDatetimeFromBirthday(userBirthday).strftime('%B, %d')))
         return True
 
     async def on_message(self, message):
-        if message.author == client.user:
+        if message.author == self.user:
             return
 
-        if message.content.startswith(COMMAND_PREFIXES):
-            args = message.content.split(' ')
-
-            #
-            # !bday
-            # Prints the message sender's birthday
-            #
-            if len(args) < 2:
-                # Validate command is sent from a valid channel
-                if self.isValidChannel(message) == False:
-                    return
-
-                if isServerMessage(message) == False:
-                    await message.channel.send(COMMAND_SERVER_ONLY)
-                    return
-
-                return await self.commandGetUserBirthday(message.channel, message.author)
-
-            #
-            # !bday channel
-            # ADMIN ONLY
-            # The only command that can be run from any channel.
-            # Sets the current channel as the birthday bot channel.
-            #
-            if args[1] == 'channel':
-                if isServerMessage(message) == False:
-                    await message.channel.send(COMMAND_SERVER_ONLY)
-                    return
-
-                if isAdminMessage(message) == False:
-                    await message.channel.send(COMMAND_ADMIN_ONLY)
-                    return
-
-                self.setChannel(message)
-                await message.channel.send('> Set current channel for Birthday announcements!')
-                return
+        await self.waitForData()
+        await router.dispatch(self, message)
+
+    #
+    # !bday
+    # Prints the message sender's birthday
+    #
+    async def commandShowOwnBirthday(self, message, args):
+        await self.commandGetUserBirthday(message.channel, message.author)
+
+    #
+    # !bday channel
+    # ADMIN ONLY
+    # The only command that can be run from any channel.
+    # Sets the current channel as the birthday bot channel.
+    #
+    async def commandChannel(self, message, args):
+        async with self.guildLocks.lock(message.channel.guild.id):
+            self.setChannel(message)
+
+        await message.channel.send('> Set current channel for Birthday announcements!')
+
+    #
+    # !bday help
+    # Prints usage information for the bot
+    #
+    async def commandHelp(self, message, args):
+        if len(args) < 3:
+            await message.channel.send(COMMAND_HELP)
+        else:
+            await message.channel.send(COMMAND_HELP_ADMIN)
+
+    #
+    # !bday about
+    # Prints general information for the bot as well as the current server configuration.
+    #
+    async def commandAbout(self, message, args):
+        await message.channel.send(COMMAND_ABOUT)
+
+        if isServerMessage(message) == True:
+            guild = message.channel.guild
+            self.ensureGuildDataExists(guild)
+            guildData = getGuildData(guild.id)
+            await message.channel.send('''
+            > 
+            > Server Info:
+            > Timezone: {}
+            > Announce Hour: {}:00
+            > Registered Birthdays: {}
+            '''.format(formatTimezone(getTimezone(guildData)), getAnnounceHour(guildData), store.countUsers(guild.id)))
+
+    #
+    # !bday [user] [date]
+    # ADMIN ONLY
+    # Shows or sets the birthday of another user
+    #
+    async def commandUser(self, message, args):
+        # Ensure user exists on current guild
+        guild = message.channel.guild
+        userId = int(userMatch(args[1]).group(1))
+        user = guild.get_member(userId)
+        if user == None:
+            await message.channel.send('> Error: User does not exist in current server!')
+            return
 
-            #
-            # All commands below must be sent from a valid channel
-            # Valid channels include direct messages to the bot and messages sent to the
-            # guild's configured channel.
-            #
-            if self.isValidChannel(message) == False:
-                return
+        if len(args) < 3:
+            await self.commandGetUserBirthday(message.channel, user)
+            return
 
-            #
-            # !bday help
-            # Prints usage information for the bot
-            #
-            if args[1] == 'help':
-                if len(args) < 3:
-                    await message.channel.send(COMMAND_HELP)
-                else:
-                    await message.channel.send(COMMAND_HELP_ADMIN)
-                return
+        birthday = parseBirthday(args[2])
+        if birthday == None:
+            await message.channel.send('> Error: Invalid date format')
+            return
 
-            #
-            # !bday about
-            # Prints general information for the bot as well as the current server configuration.
-            #
-            if args[1] == 'about':
-                await message.channel.send(COMMAND_ABOUT)
-
-                if isServerMessage(message) == True:
-                    guild = message.channel.guild
-                    self.ensureGuildDataExists(guild)
-                    guildData = getGuildData(guild.id)
-                    await message.channel.send('''
-                    > 
-                    > Server Info:
-                    > Timezone: UTC {}
-                    > Announce Hour: {}:00
-                    > Registered Birthdays: {}
-                    '''.format(getTimezone(guildData), getAnnounceHour(guildData), len(guildData['users'].items())))
+        async with self.guildLocks.lock(guild.id):
+            self.setBirthday(guild, user, birthday)
 
-                return
+        await message.channel.send('> Set {}\'s birthday!'.format(user))
 
-            #
-            # All commands below must be sent from a Guild
-            #
-            if isServerMessage(message) == False:
-                await message.channel.send(COMMAND_SERVER_ONLY)
-                return
+    #
+    # !bday [date]
+    # Personal command for setting a birthday
+    #
+    async def commandSetOwnBirthday(self, message, args):
+        birthday = parseBirthday(args[1])
+        if birthday == None:
+            await message.channel.send('> Error: Invalid date format')
+            return
 
-            #
-            # !bday [user]
-            # User specific commands
-            #
-            userMatches = userMatch(args[1])
-            if userMatches != None:
-                if isAdminMessage(message) == False:
-                    await message.channel.send(COMMAND_ADMIN_ONLY)
-                    return
-
-                # Ensure user exists on current guild
-                guild = message.channel.guild
-                userId = int(userMatches.group(1))
-                user = guild.get_member(userId)
-                if user == None:
-                    await message.channel.send('> Error: User does not exist in current server!')
-                    return
-
-                if len(args) < 3:
-                    return await self.commandGetUserBirthday(message.channel, user)
-
-                dateMatches = dateMatch(args[2])
-                if dateMatches == None:
-                    await message.channel.send('> Error: Invalid date format')
-                    return
-                
-                try:
-                    datetime(year = 2000, month = dateMatches[0], day = dateMatches[1])
-                except TypeError:
-                    await message.channel.send('> Error: Invalid date format')
-                    return
-                except ValueError:
-                    await message.channel.send('> Error: Invalid date format')
-                    return
-
-                self.setBirthday(guild, user, dateMatches)
-                await message.channel.send('> Set {}\'s birthday!'.format(user))
-                return
+        guild = message.channel.guild
+        async with self.guildLocks.lock(guild.id):
+            self.setBirthday(guild, message.author, birthday)
 
-            #
-            # !bday [date]
-            # Personal command for setting a birthday
-            #
-            dateMatches = dateMatch(args[1])
-            if dateMatches != None:
-                try:
-                    datetime(year = 2000, month = dateMatches[0], day = dateMatches[1])
-                except TypeError:
-                    await message.channel.send('> Error: Invalid date format')
-                    return
-                except ValueError:
-                    await message.channel.send('> Error: Invalid date format')
-                    return
-
-                guild = message.channel.guild
-                self.setBirthday(guild, message.author, dateMatches)
-                await message.channel.send('> Set {}\'s birthday!'.format(message.author))
-                return
+        await message.channel.send('> Set {}\'s birthday!'.format(message.author))
 
-            #
-            # !bday delete [user]
-            # Deletes a user's birthday from the server or deletes the sender's birthday
-            # if no user is specified
-            #
-            if args[1] == 'delete':
-                guild = message.channel.guild
-                if len(args) < 3:
-                    self.deleteBirthday(guild, message.author.id)
-                    await message.channel.send('> Deleted {}\'s birthday!'.format(message.author))
-                    return
-
-                userMatches = userMatch(args[2])
-                if userMatches != None:
-                    if isAdminMessage(message) == False:
-                        await message.channel.send(COMMAND_ADMIN_ONLY)
-                        return
-
-                    userId = int(userMatches.group(1))
-                    user = guild.get_member(userId)
-                    self.deleteBirthday(guild, userId)
-                    await message.channel.send('> Deleted {}\'s birthday!'.format(user))
-                    return
-
-            #
-            # !bday upcoming
-            # Prints upcoming birthdays
-            #
-            if args[1] == 'upcoming':
-                guild = message.channel.guild
-                guildData = getGuildData(guild.id)
-                today = datetime.utcnow() + timedelta(hours = getTimezone(guildData))
-                upcomingUsers = []
-                for userId, userData in guildData['users'].items():
-                    dateMatches = dateMatch(userData['date'])
-                    if dateMatches == None:
-                        print('DATA_ERROR: Date format for user {} is invalid'.format(userId))
-                        continue
-
-                    userBirthday = getDatetimeFromBirthday(dateMatches, today.year)
-                    diff = userBirthday - today
-                    dayDiff = diff.days
-                    if dayDiff < 0:
-                        userBirthday = getDatetimeFromBirthday(dateMatches, today.year + 1)
-                        diff = userBirthday - today
-                        dayDiff = diff.days
-
-                    if dayDiff < 30:
-                        upcomingUsers.append((guild.get_member(int(userId)), userBirthday))
-
-                upcomingUsers.sort(key=lambda a: a[1])
-                if len(upcomingUsers) == 0:
-                    await message.channel.send('> No birthdays in the next 30 days.')
-                else:
-                    await message.channel.send('> Upcoming birthdays:')
-                    for user in upcomingUsers:
-                        await message.channel.send('> {}\'s birthday is {}'.format(user[0], user[1].strftime('%B, %d')))
-                
-                return
+    #
+    # !bday delete [user]
+    # Deletes a user's birthday from the server or deletes the sender's birthday
+    # if no user is specified
+    #
+    async def commandDelete(self, message, args):
+        guild = message.channel.guild
+        if len(args) < 3:
+            async with self.guildLocks.lock(guild.id):
+                self.deleteBirthday(guild, message.author.id)
 
-            # Admin only and configuration commands
-            if args[1] == 'timezone':
-                if isAdminMessage(message) == False:
-                    await message.channel.send(COMMAND_ADMIN_ONLY)
-                    return
+            await message.channel.send('> Deleted {}\'s birthday!'.format(message.author))
+            return
 
-                if len(args) < 3:
-                    await message.channel.send('> Error: Command expects an argument')
-                    return
+        userMatches = userMatch(args[2])
+        if userMatches == None:
+            return
 
-                timezoneRegex = re.compile('[uU][tT][cC]([-+]\d+)').match(args[2])
-                if timezoneRegex == None:
-                    await message.channel.send('> Error: Invalid timezone. Please specify an UTC offset. IE `UTC-8`, `utc+10`')
-                    return
+        if isAdminMessage(message) == False:
+            await message.channel.send(COMMAND_ADMIN_ONLY)
+            return
 
-                self.setTimezone(message, int(timezoneRegex.group(1)))
-                await message.channel.send('> Set server timezone to UTC{}'.format(timezoneRegex.group(1)))
-                return
+        userId = int(userMatches.group(1))
+        user = guild.get_member(userId)
+        async with self.guildLocks.lock(guild.id):
+            self.deleteBirthday(guild, userId)
 
-            if args[1] == 'hour':
-                if isAdminMessage(message) == False:
-                    await message.channel.send(COMMAND_ADMIN_ONLY)
-                    return
+        await message.channel.send('> Deleted {}\'s birthday!'.format(user))
 
-                if len(args) < 3:
-                    await message.channel.send('> Error: Command expects an argument')
-                    return
+    #
+    # !bday upcoming
+    # Prints upcoming birthdays
+    #
+    async def commandUpcoming(self, message, args):
+        guild = message.channel.guild
+        guildData = getGuildData(guild.id)
+        today = getLocalNow(guildData)
+
+        # The reply only changes with the local date or the guild's birthdays
+        key = (today.date(), store.birthdayVersion(guild.id))
+        cached = self.upcomingCache.get(guild.id)
+        if cached == None or cached[0] != key:
+            cached = (key, self.renderUpcoming(guild, today))
+            self.upcomingCache[guild.id] = cached
+
+        for payload in cached[1]:
+            await message.channel.send(**payload)
+
+    # Returns the `upcoming` reply for the guild as a list of keyword arguments for channel.send
+    def renderUpcoming(self, guild, today):
+        # Birthdays from tomorrow through the next 30 days, wrapping into next year
+        start = today + timedelta(days = 1)
+        end = today + timedelta(days = 30)
+        upcomingUsers = []
+        startDay = toDayOfYear(start.month, start.day)
+        endDay = toDayOfYear(end.month, end.day)
+        for userId, birthday in store.snapshot(guild.id, startDay, endDay).birthdaysBetween(startDay, endDay):
+            upcomingUsers.append((guild.get_member(userId), getDatetimeFromBirthday(birthday)))
+
+        if len(upcomingUsers) == 0:
+            return [{'content': '> No birthdays in the next 30 days.'}]
+
+        if UPCOMING_EMBEDS:
+            lines = ['{}\'s birthday is {}'.format(user[0], user[1].strftime('%B, %d')) for user in upcomingUsers]
+            return [{'embeds': embeds} for embeds in packEmbeds('Upcoming birthdays', lines)]
+
+        # As many lines as fit in each message, rather than one message per user
+        lines = ['> {}\'s birthday is {}'.format(user[0], user[1].strftime('%B, %d')) for user in upcomingUsers]
+        return [{'content': content} for content in packLines(lines, header = '> Upcoming birthdays:')]
+
+    #
+    # !bday timezone ZONE
+    # ADMIN ONLY
+    # ZONE is a time zone name like America/New_York or a fixed offset like UTC-8
+    #
+    async def commandTimezone(self, message, args):
+        if len(args) < 3:
+            await message.channel.send('> Error: Command expects an argument')
+            return
 
-                hour = 12
-                try:
-                    hour = int(args[2])
-                    if hour < 1 or hour > 24:
-                        raise ValueError
-                except:
-                    await message.channel.send('> Error: Invalid hour. Please specify an integer from 1 to 24')
-                    return
-
-                self.setHour(message, hour)
-                await message.channel.send('> Set birthday announce hour to {}:00'.format(hour))
+        timezoneRegex = TIMEZONE_PATTERN.fullmatch(args[2])
+        if timezoneRegex != None:
+            timezone = int(timezoneRegex.group(1))
+            if timezone < MIN_UTC_OFFSET or timezone > MAX_UTC_OFFSET:
+                await message.channel.send('> Error: UTC offsets range from UTC{:+d} to UTC{:+d}'.format(MIN_UTC_OFFSET, MAX_UTC_OFFSET))
                 return
+        else:
+            timezone = findTimezone(args[2])
 
-            if args[1] == 'wipe_all':
-                if isAdminMessage(message) == False:
-                    await message.channel.send(COMMAND_ADMIN_ONLY)
-                    return
+        if timezone == None:
+            await message.channel.send('> Error: Invalid timezone. Please specify a time zone name or an UTC offset. IE `America/Los_Angeles`, `Europe/Berlin`, `UTC-8`, `utc+10`')
+            return
 
-                deleteGuildData(message.channel.guild.id)
-                await message.channel.send('> Deleted all birthday bot data for current server!')
-                return
+        async with self.guildLocks.lock(message.channel.guild.id):
+            self.setTimezone(message, timezone)
 
-            #
-            # Force announce user birthdays
-            #
-            if args[1] == 'announce':
-                if isAdminMessage(message) == False:
-                    await message.channel.send(COMMAND_ADMIN_ONLY)
-                    return
-                
-                await self.sampleBirthdays(forGuild = message.channel.guild)
-                return
+        await message.channel.send('> Set server timezone to {}'.format(formatTimezone(timezone)))
+
+    #
+    # !bday hour HH
+    # ADMIN ONLY
+    #
+    async def commandHour(self, message, args):
+        if len(args) < 3:
+            await message.channel.send('> Error: Command expects an argument')
+            return
+
+        hour = 12
+        try:
+            hour = int(args[2])
+            if hour < 1 or hour > 24:
+                raise ValueError
+        except:
+            await message.channel.send('> Error: Invalid hour. Please specify an integer from 1 to 24')
+            return
+
+        async with self.guildLocks.lock(message.channel.guild.id):
+            self.setHour(message, hour)
 
-            print('Received message')
-            print(message.content)
+        await message.channel.send('> Set birthday announce hour to {}:00'.format(hour))
 
-client = BirthdayBotClient()
-client.run(TOKEN)
+    #
+    # !bday import
+    # ADMIN ONLY
+    # Imports birthdays from an attached CSV or JSON file
+    #
+    async def commandImport(self, message, args):
+        if len(message.attachments) == 0:
+            await message.channel.send('> Error: Attach a CSV or JSON file to import')
+            return
+
+        attachment = message.attachments[0]
+        format = formatOf(attachment.filename)
+        if format == None:
+            await message.channel.send('> Error: Only .csv and .json files can be imported')
+            return
+
+        if attachment.size > IMPORT_MAX_BYTES:
+            await message.channel.send('> Error: Import files can be at most {} KiB'.format(IMPORT_MAX_BYTES // 1024))
+            return
+
+        try:
+            result = parseImport(openImportBytes(await attachment.read()), format)
+        except (ValueError, UnicodeDecodeError) as error:
+            await message.channel.send('> Error: Could not read {}: {}'.format(attachment.filename, error))
+            return
+
+        guild = message.channel.guild
+        members = await self.resolveMembers(guild, list(result.users))
+        users = []
+        for userId, (name, birthday) in result.users.items():
+            member = members.get(userId)
+            if member == None:
+                result.reject('user {}'.format(userId), 'not a member of this server')
+                continue
+
+            users.append((member, birthday))
+
+        async with self.guildLocks.lock(guild.id):
+            self.setBirthdays(guild, users)
+
+        log.info('Imported birthdays', extra = {'guild_id': guild.id, 'imported': len(users), 'rejected': result.rejected})
+
+        header = '> Imported {} birthdays, rejected {} rows'.format(len(users), result.rejected)
+        lines = ['> ' + reason for reason in result.reasons]
+        if result.rejected > len(result.reasons):
+            lines.append('> ...and {} more'.format(result.rejected - len(result.reasons)))
+
+        for text in packLines(lines, header):
+            await message.channel.send(text)
+
+    #
+    # !bday export [csv|json]
+    # ADMIN ONLY
+    # Sends the server's birthdays as a file
+    #
+    async def commandExport(self, message, args):
+        format = args[2].lower() if len(args) > 2 else 'csv'
+        if format not in FORMATS:
+            await message.channel.send('> Error: Export format must be csv or json')
+            return
+
+        guild = message.channel.guild
+        self.ensureGuildDataExists(guild)
+        # Written out piece by piece and uploaded from disk rather than built in memory
+        with tempfile.TemporaryFile() as export_file:
+            for chunk in exportChunks(store.iterUsers(guild.id), format):
+                export_file.write(chunk.encode())
+
+            export_file.seek(0)
+            await message.channel.send('> Exported {} birthdays'.format(store.countUsers(guild.id)),
+                file = discord.File(export_file, filename = 'birthdays-{}.{}'.format(guild.id, format)))
+
+    #
+    # !bday wipe_all
+    # ADMIN ONLY
+    #
+    async def commandWipeAll(self, message, args):
+        guildId = message.channel.guild.id
+        async with self.guildLocks.lock(guildId):
+            self.forgetGuild(guildId)
+
+        await message.channel.send('> Deleted all birthday bot data for current server!')
+
+    #
+    # !bday announce
+    # ADMIN ONLY
+    # Force announce user birthdays
+    #
+    async def commandAnnounce(self, message, args):
+        await self.sampleBirthdays(forGuild = message.channel.guild.id)
+
+throttle = CommandThrottle(COMMAND_USER_RATE, COMMAND_USER_BURST, COMMAND_GUILD_RATE, COMMAND_GUILD_BURST)
+router = CommandRouter(COMMAND_PREFIXES, COMMAND_SERVER_ONLY, COMMAND_ADMIN_ONLY, throttle, COMMAND_THROTTLED if COMMAND_THROTTLE_REPLY else None)
+router.register(None, BirthdayBotClient.commandShowOwnBirthday, serverOnly = True)
+router.register('channel', BirthdayBotClient.commandChannel, serverOnly = True, adminOnly = True, anyChannel = True)
+router.register('help', BirthdayBotClient.commandHelp)
+router.register('about', BirthdayBotClient.commandAbout)
+router.register('delete', BirthdayBotClient.commandDelete, serverOnly = True)
+router.register('upcoming', BirthdayBotClient.commandUpcoming, serverOnly = True)
+router.register('timezone', BirthdayBotClient.commandTimezone, serverOnly = True, adminOnly = True)
+router.register('hour', BirthdayBotClient.commandHour, serverOnly = True, adminOnly = True)
+router.register('wipe_all', BirthdayBotClient.commandWipeAll, serverOnly = True, adminOnly = True)
+router.register('announce', BirthdayBotClient.commandAnnounce, serverOnly = True, adminOnly = True)
+router.register('import', BirthdayBotClient.commandImport, serverOnly = True, adminOnly = True)
+router.register('export', BirthdayBotClient.commandExport, serverOnly = True, adminOnly = True)
+router.registerPattern('user', USER_PATTERN, BirthdayBotClient.commandUser, serverOnly = True, adminOnly = True)
+router.registerPattern('set', DATE_PATTERN, BirthdayBotClient.commandSetOwnBirthday, serverOnly = True)
+
+# Creates the storage and client without loading any data or connecting
+def setup():
+    global store, client
+    store = openStorage(DATA_STORAGE, DATA_FILE, SHARD_COUNT, SHARD_IDS, GUILD_CACHE_SIZE)
+    client = BirthdayBotClient()
+    return client
+
+def main():
+    configureLogging(LOG_LEVEL, LOG_FORMAT.lower() == 'json')
+    setup()
+    # Logging is already configured, keep discord.py from adding its own handler
+    client.run(TOKEN, log_handler = None)
+
+if __name__ == '__main__':
+    main()
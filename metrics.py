@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# Default histogram buckets in seconds, from sub-millisecond command handling up to slow passes
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+# How often the event loop lag monitor checks in
+LAG_INTERVAL = 0.5
+
+def formatLabels(labelNames, labelValues, extra = ()):
+    pairs = list(zip(labelNames, labelValues)) + list(extra)
+    if len(pairs) == 0:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs) + '}'
+
+def formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value))
+
+#
+# Minimal Prometheus style metrics. Each metric keeps one value per combination of label
+# values, passed as keyword arguments named after labelNames.
+#
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, labelNames = ()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.values = {}
+        REGISTRY.register(self)
+
+    def key(self, labels):
+        return tuple(labels[name] for name in self.labelNames)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+        for labelValues, value in sorted(self.values.items()):
+            lines.append('{}{} {}'.format(self.name, formatLabels(self.labelNames, labelValues), formatValue(value)))
+
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount = 1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+    def inc(self, amount = 1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelNames = (), buckets = DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labelNames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        series = self.values.get(key)
+        if series == None:
+            # [bucket counts..., sum, count]
+            series = [0] * (len(self.buckets) + 2)
+            self.values[key] = series
+
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[index] += 1
+                break
+
+        series[-2] += value
+        series[-1] += 1
+
+    # Times the body of a with block
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        for labelValues, series in sorted(self.values.items()):
+            cumulative = 0
+            for index, bound in enumerate(self.buckets):
+                cumulative += series[index]
+                lines.append('{}_bucket{} {}'.format(self.name,
+                    formatLabels(self.labelNames, labelValues, [('le', formatValue(bound))]), cumulative))
+
+            labelText = formatLabels(self.labelNames, labelValues)
+            lines.append('{}_sum{} {}'.format(self.name, labelText, formatValue(series[-2])))
+            lines.append('{}_count{} {}'.format(self.name, labelText, series[-1]))
+
+        return lines
+
+class Timer:
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    # Renders every metric in the Prometheus text exposition format
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+COMMAND_SECONDS = Histogram('birthdaybot_command_seconds', 'Time spent handling a command', ('subcommand',))
+FLUSH_SECONDS = Histogram('birthdaybot_flush_seconds', 'Time spent writing pending changes to storage')
+FLUSH_BYTES = Histogram('birthdaybot_flush_bytes', 'Bytes written per storage flush', buckets = SIZE_BUCKETS)
+ANNOUNCE_PASS_SECONDS = Histogram('birthdaybot_announce_pass_seconds', 'Time spent on each announcement pass')
+ANNOUNCE_GUILDS = Counter('birthdaybot_announce_guilds_total', 'Guilds processed by announcement passes')
+ANNOUNCE_BIRTHDAYS = Counter('birthdaybot_announce_birthdays_total', 'Birthdays announced')
+SEND_QUEUE_DEPTH = Gauge('birthdaybot_send_queue_depth', 'Messages waiting in the outbound send queue')
+EVENT_LOOP_LAG = Histogram('birthdaybot_event_loop_lag_seconds', 'How late the event loop runs a scheduled wakeup')
+RECONCILE_PASS_SECONDS = Histogram('birthdaybot_reconcile_pass_seconds', 'Time taken by each reconciliation pass, including pauses')
+RECONCILE_REMOVED = Counter('birthdaybot_reconcile_removed_total', 'Stored records removed because their member or guild is gone', ('kind',))
+GUILD_CACHE_REQUESTS = Counter('birthdaybot_guild_cache_requests_total', 'Guild cache lookups by result, hit, miss or prefetch', ('result',))
+GUILD_CACHE_EVICTIONS = Counter('birthdaybot_guild_cache_evictions_total', 'Guilds evicted from the guild cache')
+GUILD_CACHE_GUILDS = Gauge('birthdaybot_guild_cache_guilds', 'Guilds resident in the guild cache')
+GUILD_CACHE_USERS = Gauge('birthdaybot_guild_cache_users', 'Birthdays resident in the guild cache')
+COMMANDS_THROTTLED = Counter('birthdaybot_commands_throttled_total', 'Commands rejected by the command throttle, by the bucket that ran out, user or guild', ('scope',))
+THROTTLE_BUCKETS = Gauge('birthdaybot_throttle_buckets', 'Users and guilds the command throttle is tracking', ('scope',))
+
+#
+# Serves the registry at /metrics over plain HTTP. Only meant to be bound to a local address
+# for a Prometheus scraper or an operator with curl.
+#
+async def handleMetricsRequest(reader, writer):
+    try:
+        requestLine = await reader.readline()
+        # Skip the headers
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+
+        parts = requestLine.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status = '200 OK'
+            body = REGISTRY.render().encode()
+        else:
+            status = '404 Not Found'
+            body = b'Not found\n'
+
+        writer.write('HTTP/1.1 {}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(status, len(body)).encode())
+        writer.write(body)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def startMetricsServer(host, port):
+    server = await asyncio.start_server(handleMetricsRequest, host, port)
+    log.info('Serving metrics', extra = {'host': host, 'port': port})
+    return server
+
+# Measures how much later than requested the event loop wakes up a sleeping task
+async def monitorEventLoopLag(interval = LAG_INTERVAL):
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0, time.monotonic() - start - interval))
@@ -0,0 +1,149 @@
+import bisect
+import logging
+
+log = logging.getLogger(__name__)
+
+# Birthdays are numbered by their day in a leap year so February 29th has a slot
+LEAP_YEAR = 2000
+DAYS_IN_MONTH = (31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+DAYS_IN_YEAR = sum(DAYS_IN_MONTH)
+
+# Number of days in the year before each month starts
+MONTH_OFFSETS = tuple(sum(DAYS_IN_MONTH[:month]) for month in range(12))
+
+# Guild settings as stored in data.json, mapped to GuildRecord attributes.
+# last_announced is the ledger of announcements, the ISO local date last announced in the guild.
+GUILD_SETTINGS = {
+    'channel_id': 'channelId',
+    'timezone': 'timezone',
+    'announce_hour': 'announceHour',
+    'last_announced': 'lastAnnounced',
+}
+
+# Packs a month and day into a day of year from 1 to 366. Raises ValueError if the date is invalid.
+def toDayOfYear(month, day):
+    if month < 1 or month > 12 or day < 1 or day > DAYS_IN_MONTH[month - 1]:
+        raise ValueError('Invalid date {}-{}'.format(month, day))
+
+    return MONTH_OFFSETS[month - 1] + day
+
+def fromDayOfYear(dayOfYear):
+    month = bisect.bisect_left(MONTH_OFFSETS, dayOfYear)
+    return (month, dayOfYear - MONTH_OFFSETS[month - 1])
+
+# Parses a stored 'M-D' date into a day of year. Raises ValueError if the stored value is malformed.
+def parseStoredDate(date):
+    try:
+        month, day = date.split('-')
+    except AttributeError:
+        raise ValueError('Invalid date {}'.format(date))
+
+    return toDayOfYear(int(month), int(day))
+
+def formatStoredDate(dayOfYear):
+    return '{}-{}'.format(*fromDayOfYear(dayOfYear))
+class UserRecord:
+    __slots__ = ('name', 'birthday')
+
+    def __init__(self, name, birthday):
+        self.name = name
+        # Day of year, see toDayOfYear
+        self.birthday = birthday
+
+    @property
+    def month(self):
+        return fromDayOfYear(self.birthday)[0]
+
+    @property
+    def day(self):
+        return fromDayOfYear(self.birthday)[1]
+
+    def toJson(self):
+        return {'name': self.name, 'date': formatStoredDate(self.birthday)}
+
+#
+# A guild's settings and, for the in-memory backends, its users keyed by int user id.
+# Settings that were never set are None.
+#
+class GuildRecord:
+    __slots__ = ('id', 'name', 'channelId', 'timezone', 'announceHour', 'lastAnnounced', 'users')
+
+    def __init__(self, guildId, name, channelId = None, timezone = None, announceHour = None, lastAnnounced = None, users = None):
+        self.id = guildId
+        self.name = name
+        self.channelId = channelId
+        self.timezone = timezone
+        self.announceHour = announceHour
+        self.lastAnnounced = lastAnnounced
+        self.users = users if users != None else {}
+
+    def hasChannel(self):
+        return self.channelId != None and self.channelId != -1
+
+    def setSetting(self, key, value):
+        setattr(self, GUILD_SETTINGS[key], value)
+
+    #
+    # Copies the record for serialization on another thread. User records are replaced
+    # rather than edited, so a shallow copy of the user map is enough.
+    #
+    def snapshot(self):
+        return GuildRecord(self.id, self.name, self.channelId, self.timezone, self.announceHour, self.lastAnnounced, dict(self.users))
+
+    # Converts to the data.json layout
+    def toJson(self):
+        guildData = {'name': self.name, 'users': {str(userId): user.toJson() for userId, user in self.users.items()}}
+        for key, attribute in GUILD_SETTINGS.items():
+            value = getattr(self, attribute)
+            if value != None:
+                guildData[key] = value
+
+        return guildData
+
+    # Parses a data.json guild entry, validating every stored date once
+    @classmethod
+    def fromJson(cls, guildId, guildData):
+        guild = cls(int(guildId), guildData.get('name'))
+        for key, attribute in GUILD_SETTINGS.items():
+            setattr(guild, attribute, guildData.get(key))
+
+        for userId, userData in guildData.get('users', {}).items():
+            try:
+                birthday = parseStoredDate(userData['date'])
+            except (KeyError, ValueError):
+                log.error('DATA_ERROR: Date format for user is invalid', extra = {'guild_id': guildId, 'user_id': userId})
+                continue
+
+            guild.users[int(userId)] = UserRecord(userData.get('name'), birthday)
+
+        return guild
+
+#
+# Read-only view of a guild's settings and birthdays at one point in time, for readers that
+# must not see changes made while they run. birthdays is a SortedBirthdays, which is never
+# modified, so a snapshot of an in-memory guild shares it instead of copying.
+#
+class GuildSnapshot:
+    __slots__ = ('id', 'name', 'channelId', 'timezone', 'announceHour', 'lastAnnounced', 'birthdays')
+
+    def __init__(self, guild, birthdays):
+        self.id = guild.id
+        self.name = guild.name
+        for attribute in GUILD_SETTINGS.values():
+            setattr(self, attribute, getattr(guild, attribute))
+
+        self.birthdays = birthdays
+
+    def hasChannel(self):
+        return self.channelId != None and self.channelId != -1
+
+    # Returns the ids of users whose birthday is on the given day of the year
+    def birthdaysOn(self, birthday):
+        return self.birthdays.usersOn(birthday)
+
+    # Returns a list of (userId, birthday) like Storage.birthdaysBetween
+    def birthdaysBetween(self, start, end):
+        return self.birthdays.between(start, end)
+
+    def __len__(self):
+        return len(self.birthdays)
@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import random
+import time
+
+from collections import deque
+
+from metrics import SEND_QUEUE_DEPTH
+
+log = logging.getLogger(__name__)
+
+# Discord allows 5 messages every 5 seconds per channel
+CHANNEL_RATE = 5 / 5.0
+CHANNEL_BURST = 5
+
+# How long closing waits for queued messages to go out, in seconds
+DEFAULT_DRAIN_TIMEOUT = 10
+
+# Total number of sends waiting on Discord at once, across all channels
+DEFAULT_MAX_IN_FLIGHT = 10
+
+# Rate limited sends are retried this many times, backing off exponentially from RETRY_DELAY
+DEFAULT_MAX_RETRIES = 5
+RETRY_DELAY = 1.0
+
+#
+# Classic token bucket. Holds up to capacity tokens and refills at rate tokens per second.
+#
+class TokenBucket:
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        # updated is pushed into the future while the bucket is paused
+        if now <= self.updated:
+            return
+
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            await asyncio.sleep(max(self.updated - now, 0) + (1 - self.tokens) / self.rate)
+
+    # Takes a token if one is available, without waiting. Returns whether it did.
+    def tryAcquire(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+
+        return False
+
+    # Returns whether a token can be taken now, without taking it
+    def available(self, now):
+        self.refill(now)
+        return self.tokens >= 1
+
+    def isFull(self, now):
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+    # Empties the bucket and stops it refilling for the given number of seconds
+    def pause(self, seconds):
+        self.tokens = 0
+        self.updated = max(self.updated, time.monotonic() + seconds)
+
+def isRateLimited(error):
+    return getattr(error, 'status', None) == 429
+
+#
+# Messages queued together with SendQueue.sendGroup. done(undelivered) is called once each of
+# them has been sent or given up on, with the list of the ones given up on, in queue order.
+#
+class SendGroup:
+
+    def __init__(self, contents, done):
+        self.contents = contents
+        self.delivered = [False] * len(contents)
+        self.remaining = len(contents)
+        self.done = done
+
+    def finished(self, position, delivered):
+        self.delivered[position] = delivered
+        self.remaining -= 1
+        if self.remaining == 0:
+            undelivered = [content for content, sent in zip(self.contents, self.delivered) if sent == False]
+            try:
+                self.done(undelivered)
+            except Exception:
+                log.exception('Send group callback failed')
+
+#
+# Outbound message queue for announcements.
+# Each channel gets its own FIFO queue, drained by a worker task that respects the channel's
+# rate limit, so a slow or rate limited channel only delays its own messages. Workers for
+# different channels run concurrently up to maxInFlight sends at a time.
+#
+class SendQueue:
+
+    def __init__(self, maxInFlight = DEFAULT_MAX_IN_FLIGHT, maxRetries = DEFAULT_MAX_RETRIES,
+            channelRate = CHANNEL_RATE, channelBurst = CHANNEL_BURST):
+        self.maxRetries = maxRetries
+        self.channelRate = channelRate
+        self.channelBurst = channelBurst
+        self.inFlight = asyncio.Semaphore(maxInFlight)
+        # {channelId: deque([(channel, content, SendGroup or None, position in the group)])}
+        self.queues = {}
+        # {channelId: TokenBucket}
+        self.buckets = {}
+        # {channelId: Task}
+        self.workers = {}
+        self.pending = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    # Queues a message for the channel and returns immediately
+    def send(self, channel, content, group = None, position = 0):
+        self.queues.setdefault(channel.id, deque()).append((channel, content, group, position))
+        self.pending += 1
+        SEND_QUEUE_DEPTH.set(self.pending)
+        self.idle.clear()
+
+        if channel.id not in self.workers:
+            self.workers[channel.id] = asyncio.get_running_loop().create_task(self.work(channel.id))
+
+    # Queues messages for the channel and calls done(undelivered) once they have all been sent or given up on
+    def sendGroup(self, channel, contents, done):
+        group = SendGroup(list(contents), done)
+        for position, content in enumerate(group.contents):
+            self.send(channel, content, group, position)
+
+    async def work(self, channelId):
+        queue = self.queues[channelId]
+        bucket = self.buckets.get(channelId)
+        if bucket == None:
+            bucket = TokenBucket(self.channelRate, self.channelBurst)
+            self.buckets[channelId] = bucket
+
+        try:
+            while len(queue) > 0:
+                channel, content, group, position = queue[0]
+                delivered = await self.deliver(bucket, channel, content)
+                queue.popleft()
+                self.pending -= 1
+                SEND_QUEUE_DEPTH.set(self.pending)
+                if group != None:
+                    group.finished(position, delivered)
+        finally:
+            del self.workers[channelId]
+            if len(queue) == 0:
+                del self.queues[channelId]
+
+            if self.pending == 0:
+                self.idle.set()
+
+    # Returns whether the message was sent
+    async def deliver(self, bucket, channel, content):
+        for attempt in range(self.maxRetries + 1):
+            await bucket.acquire()
+
+            async with self.inFlight:
+                try:
+                    await channel.send(content)
+                    return True
+                except Exception as error:
+                    if isRateLimited(error) == False or attempt == self.maxRetries:
+                        log.error('Failed to send message', extra = {'channel_id': channel.id, 'error': str(error)})
+                        return False
+
+                    retryAfter = getattr(error, 'retry_after', None)
+                    if retryAfter == None:
+                        retryAfter = RETRY_DELAY * 2 ** attempt + random.uniform(0, RETRY_DELAY)
+
+            # Back off without holding an in-flight slot
+            log.warning('Rate limited, retrying', extra = {'channel_id': channel.id, 'retry_after': round(retryAfter, 1)})
+            bucket.pause(retryAfter)
+
+    # Waits until every queued message has been sent or given up on, or at most timeout seconds.
+    # Returns False if messages are still queued.
+    async def drain(self, timeout = None):
+        if self.idle.is_set():
+            return True
+
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+
+        return True
+
+    # Stops sending. Messages still queued are dropped and their groups reported as not delivered.
+    def close(self):
+        for worker in list(self.workers.values()):
+            worker.cancel()
+
+        for queue in self.queues.values():
+            while len(queue) > 0:
+                channel, content, group, position = queue.popleft()
+                if group != None:
+                    group.finished(position, False)
+
+        self.pending = 0
+        SEND_QUEUE_DEPTH.set(0)
+        self.idle.set()
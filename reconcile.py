@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import time
+
+from metrics import RECONCILE_PASS_SECONDS, RECONCILE_REMOVED
+
+log = logging.getLogger(__name__)
+
+# How long to wait between reconciliation passes
+RECONCILE_INTERVAL = 60 * 60
+# Longest stretch a pass may hold the event loop before it yields
+RECONCILE_SLICE_SECONDS = 0.005
+# Users compared against the member cache between checks of the time slice
+RECONCILE_CHUNK = 256
+
+#
+# Removes stored data that has no live counterpart anymore, for members and guilds whose
+# removal events were missed while the bot was offline. Each pass walks every stored guild:
+#   - guilds the client is no longer in are forgotten once they were missing on two passes
+#     in a row, so a guild that is briefly gone from the cache keeps its data
+#   - users who are not members of the guild are deleted, but only for guilds whose member
+#     cache is complete. Others are skipped until it is.
+# The pass yields to the event loop every few milliseconds so it never delays announcements
+# or commands.
+#
+# client is the bot client. It must provide get_guild(guildId), is_ready(), guildLocks and
+# forgetGuild(guildId), which drops the guild's data. Removals hold the guild's lock.
+#
+class Reconciler:
+
+    def __init__(self, client, store, interval = RECONCILE_INTERVAL, sliceSeconds = RECONCILE_SLICE_SECONDS):
+        self.client = client
+        self.store = store
+        self.interval = interval
+        self.sliceSeconds = sliceSeconds
+        # Guilds missing from the client on the previous pass
+        self.missingGuilds = set()
+        self.sliceStarted = 0
+        self.task = None
+
+    def start(self):
+        if self.task == None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        while True:
+            # Waiting first gives the member caches time to fill after connecting
+            await asyncio.sleep(self.interval)
+            if self.client.is_ready() == False:
+                continue
+
+            try:
+                await self.reconcile()
+            except Exception:
+                log.exception('Reconciliation pass failed')
+
+    # Yields to the event loop if the current time slice is used up
+    async def pause(self):
+        if time.perf_counter() - self.sliceStarted >= self.sliceSeconds:
+            await asyncio.sleep(0)
+            self.sliceStarted = time.perf_counter()
+
+    async def reconcile(self):
+        started = time.perf_counter()
+        self.sliceStarted = started
+        missingGuilds = set()
+        removedGuilds = 0
+        removedUsers = 0
+
+        for guildId in self.store.guildIds():
+            await self.pause()
+            guild = self.client.get_guild(guildId)
+            if guild == None:
+                if guildId in self.missingGuilds:
+                    async with self.client.guildLocks.lock(guildId):
+                        if self.client.get_guild(guildId) == None and self.client.forgetGuild(guildId):
+                            removedGuilds += 1
+                else:
+                    missingGuilds.add(guildId)
+                continue
+
+            if guild.unavailable or guild.chunked == False:
+                continue
+
+            removedUsers += await self.reconcileMembers(guild)
+
+        self.missingGuilds = missingGuilds
+        RECONCILE_PASS_SECONDS.observe(time.perf_counter() - started)
+        RECONCILE_REMOVED.inc(removedGuilds, kind = 'guild')
+        RECONCILE_REMOVED.inc(removedUsers, kind = 'user')
+        log.info('Reconciliation pass finished', extra = {'removed_guilds': removedGuilds, 'removed_users': removedUsers,
+            'missing_guilds': len(missingGuilds), 'seconds': round(time.perf_counter() - started, 3)})
+
+    # Deletes the stored users of the guild who are no longer members. Returns how many were deleted.
+    async def reconcileMembers(self, guild):
+        try:
+            userIds = [userId for userId, userData in self.store.iterUsers(guild.id)]
+        except KeyError:
+            return 0
+
+        departed = []
+        for start in range(0, len(userIds), RECONCILE_CHUNK):
+            departed.extend(userId for userId in userIds[start:start + RECONCILE_CHUNK] if guild.get_member(userId) == None)
+            await self.pause()
+
+        if len(departed) == 0:
+            return 0
+
+        async with self.client.guildLocks.lock(guild.id):
+            # Members may have rejoined, or the guild been removed, while the pass was paused
+            departed = [userId for userId in departed if guild.get_member(userId) == None]
+            try:
+                return self.store.deleteUsers(guild.id, departed)
+            except KeyError:
+                return 0
+
+    def stop(self):
+        if self.task != None:
+            self.task.cancel()
+            self.task = None
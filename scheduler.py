@@ -0,0 +1,271 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from datetime import datetime, timedelta, timezone as fixedOffset
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError, available_timezones
+
+from metrics import ANNOUNCE_GUILDS, ANNOUNCE_PASS_SECONDS
+
+log = logging.getLogger(__name__)
+
+# Upper bound on a single sleep so the scheduler recovers from system clock changes
+MAX_SLEEP_SECONDS = 60 * 60
+
+# How long before a bucket's announcement its guilds are prefetched
+PREFETCH_SECONDS = 60
+
+# Range of the fixed UTC offsets in use around the world, in hours
+MIN_UTC_OFFSET = -12
+MAX_UTC_OFFSET = 14
+
+# {lowercase zone name: zone name}, built on first use by findTimezone
+zoneNames = None
+
+#
+# A guild timezone is either an IANA zone name like 'America/New_York', which follows
+# daylight saving time, or a fixed UTC offset in hours as stored by older versions.
+# Raises ZoneInfoNotFoundError or ValueError for an unknown zone name.
+#
+def resolveTimezone(timezone):
+    if isinstance(timezone, str):
+        return ZoneInfo(timezone)
+
+    return fixedOffset(timedelta(hours = timezone))
+
+# Returns the canonical spelling of a zone name given in any case, or None if there is no such zone
+def findTimezone(name):
+    global zoneNames
+    try:
+        ZoneInfo(name)
+        return name
+    except (ZoneInfoNotFoundError, ValueError):
+        pass
+
+    if zoneNames == None:
+        zoneNames = {zoneName.lower(): zoneName for zoneName in available_timezones()}
+
+    return zoneNames.get(name.lower())
+
+# Converts a naive UTC datetime to the naive local time in the timezone
+def toLocalTime(timezone, utcTime):
+    return utcTime.replace(tzinfo = fixedOffset.utc).astimezone(resolveTimezone(timezone)).replace(tzinfo = None)
+
+# Returns the UTC instant of the announcement on a local date as a naive datetime
+def announcementTime(timezone, announceHour, localDate):
+    # Hour 24 is accepted by the hour command and means midnight. An hour skipped by a
+    # daylight saving change resolves to the hour after it.
+    localAnnouncement = datetime(localDate.year, localDate.month, localDate.day, announceHour % 24, tzinfo = resolveTimezone(timezone))
+    return localAnnouncement.astimezone(fixedOffset.utc).replace(tzinfo = None)
+
+#
+# Returns the next UTC instant after now when the local time in a guild reaches
+# announceHour:00. With includeCurrentHour, an announcement hour that has already started is
+# returned as well, so a guild is still announced when the bot starts partway through it.
+# Times are naive UTC datetimes. The instant is computed per local date, so it follows
+# daylight saving time changes.
+#
+def nextAnnouncement(timezone, announceHour, now, includeCurrentHour = False):
+    localDate = toLocalTime(timezone, now).date()
+    while True:
+        when = announcementTime(timezone, announceHour, localDate)
+        cutoff = when
+        if includeCurrentHour:
+            cutoff += timedelta(hours = 1)
+
+        if cutoff > now:
+            return when
+
+        localDate += timedelta(days = 1)
+
+#
+# Returns the local dates whose announcement came due after lastAnnounced, the last local
+# date announced, and no longer than window before now, oldest first. now is a naive UTC
+# datetime and window a timedelta.
+#
+def missedAnnouncements(timezone, announceHour, lastAnnounced, now, window):
+    localDate = toLocalTime(timezone, now).date()
+    dates = []
+    while localDate > lastAnnounced:
+        when = announcementTime(timezone, announceHour, localDate)
+        if when < now - window:
+            break
+
+        if when <= now:
+            dates.append(localDate)
+
+        localDate -= timedelta(days = 1)
+
+    dates.reverse()
+    return dates
+
+#
+# Groups guilds into buckets by timezone and announcement hour, keeps a min-heap of each
+# bucket's next announcement instant and sleeps until the earliest one is due. The instant
+# and local date are computed once per bucket rather than once per guild, and every guild
+# in a bucket is announced in the same pass.
+#
+# announce is a coroutine function called as announce(guildId, localDate) for each guild
+# when its announcement hour starts. Guilds are (re)scheduled with schedule() whenever
+# their settings change, and removed with unschedule().
+#
+# prefetch, if given, is called as prefetch(guildId) for each guild of a bucket about
+# prefetchSeconds before its announcement, so storage that pages guilds in on demand has
+# them in memory by the time they are announced.
+#
+class AnnouncementScheduler:
+
+    def __init__(self, announce, prefetch = None, prefetchSeconds = PREFETCH_SECONDS):
+        self.announce = announce
+        self.prefetch = prefetch
+        self.prefetchLead = timedelta(seconds = prefetchSeconds)
+        self.heap = []
+        # {(timezone, announceHour): [when, sequence, key, includesCurrentHour, prefetched, active]}
+        self.entries = {}
+        # {(timezone, announceHour): set(guildIds)}
+        self.buckets = {}
+        # {guildId: (timezone, announceHour)}
+        self.guildBuckets = {}
+        self.sequence = itertools.count()
+        self.changed = asyncio.Event()
+        self.task = None
+
+    def schedule(self, guildId, timezone, announceHour, now = None, includeCurrentHour = False):
+        key = (timezone, announceHour % 24)
+        if self.guildBuckets.get(guildId) != key:
+            self.unschedule(guildId)
+            self.buckets.setdefault(key, set()).add(guildId)
+            self.guildBuckets[guildId] = key
+
+        entry = self.entries.get(key)
+        if entry != None and (entry[3] or includeCurrentHour == False):
+            return
+
+        if now == None:
+            now = datetime.utcnow()
+
+        # A bucket scheduled for the next day is brought forward if its hour is still under way
+        when = nextAnnouncement(timezone, announceHour, now, includeCurrentHour)
+        if entry == None or when < entry[0]:
+            self.scheduleAt(key, when, includeCurrentHour)
+        else:
+            entry[3] = True
+
+    def scheduleAt(self, key, when, includesCurrentHour = False):
+        # heapq cannot update an entry in place, so the old one is deactivated and skipped
+        entry = self.entries.pop(key, None)
+        if entry != None:
+            entry[-1] = False
+
+        entry = [when, next(self.sequence), key, includesCurrentHour, self.prefetch == None, True]
+        self.entries[key] = entry
+        heapq.heappush(self.heap, entry)
+
+        # Wake the run loop in case this entry is due before the one it is sleeping on
+        self.changed.set()
+
+    def unschedule(self, guildId):
+        key = self.guildBuckets.pop(guildId, None)
+        if key == None:
+            return
+
+        bucket = self.buckets[key]
+        bucket.discard(guildId)
+        if len(bucket) == 0:
+            del self.buckets[key]
+            entry = self.entries.pop(key, None)
+            if entry != None:
+                entry[-1] = False
+
+    def nextDue(self):
+        while len(self.heap) > 0 and self.heap[0][-1] == False:
+            heapq.heappop(self.heap)
+
+        if len(self.heap) == 0:
+            return None
+
+        return self.heap[0][0]
+
+    # Returns the earliest active entry whose guilds were not prefetched yet, or None
+    def nextPrefetch(self):
+        if self.prefetch == None:
+            return None
+
+        pending = [entry for entry in self.heap if entry[4] == False and entry[-1]]
+        if len(pending) == 0:
+            return None
+
+        return min(pending)
+
+    async def prefetchBucket(self, entry):
+        entry[4] = True
+        for guildId in list(self.buckets.get(entry[2], ())):
+            try:
+                self.prefetch(guildId)
+            except Exception:
+                log.exception('Prefetch failed', extra = {'guild_id': guildId})
+
+            # Paging guilds in can take a while, let other tasks run in between
+            await asyncio.sleep(0)
+
+    def start(self):
+        if self.task == None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        while True:
+            due = self.nextDue()
+            now = datetime.utcnow()
+            prefetchEntry = self.nextPrefetch()
+            if prefetchEntry != None and prefetchEntry[0] - self.prefetchLead <= now:
+                await self.prefetchBucket(prefetchEntry)
+                continue
+
+            if due == None or due > now:
+                sleepSeconds = MAX_SLEEP_SECONDS
+                if due != None:
+                    sleepSeconds = min(sleepSeconds, (due - now).total_seconds())
+                if prefetchEntry != None:
+                    sleepSeconds = min(sleepSeconds, (prefetchEntry[0] - self.prefetchLead - now).total_seconds())
+
+                self.changed.clear()
+                try:
+                    await asyncio.wait_for(self.changed.wait(), timeout = sleepSeconds)
+                except asyncio.TimeoutError:
+                    pass
+
+                continue
+
+            await self.fireDue(now)
+
+    async def fireDue(self, now):
+        started = time.perf_counter()
+        guildCount = 0
+        while self.nextDue() != None and self.heap[0][0] <= now:
+            when, _, key, _, _, _ = heapq.heappop(self.heap)
+            del self.entries[key]
+            timezone, announceHour = key
+
+            # The same hour on the next local day, which daylight saving time can move
+            self.scheduleAt(key, nextAnnouncement(timezone, announceHour, when))
+
+            localDate = toLocalTime(timezone, when).date()
+            # Announcing can change the schedule, so walk a copy of the bucket
+            for guildId in list(self.buckets[key]):
+                guildCount += 1
+                try:
+                    await self.announce(guildId, localDate)
+                except Exception:
+                    # One failing guild must not hold up the others
+                    log.exception('Announcement failed', extra = {'guild_id': guildId})
+
+        ANNOUNCE_PASS_SECONDS.observe(time.perf_counter() - started)
+        ANNOUNCE_GUILDS.inc(guildCount)
+        log.info('Announcement pass finished', extra = {'guilds': guildCount})
+
+    def stop(self):
+        if self.task != None:
+            self.task.cancel()
+            self.task = None
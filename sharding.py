@@ -0,0 +1,76 @@
+import os
+import signal
+import subprocess
+import sys
+
+#
+# Gateway sharding helpers and a launcher that runs the bot as several processes, each
+# connecting a slice of the shards and owning the data of the guilds on them.
+#
+
+# Discord assigns guilds to shards by the timestamp bits of their id
+def shardOf(guildId, shardCount):
+    return (guildId >> 22) % shardCount
+
+# Data file holding the guilds of one shard, IE data.json -> data.shard3-of-8.json
+def shardFileName(fileName, shardId, shardCount):
+    root, extension = os.path.splitext(fileName)
+    return '{}.shard{}-of-{}{}'.format(root, shardId, shardCount, extension)
+
+# Parses a comma separated list of shard ids, IE '0,1,2'
+def parseShardIds(string):
+    return [int(shardId) for shardId in string.split(',') if shardId.strip() != '']
+
+# Deals the shards out to the processes round robin, returning one list of shard ids per process
+def assignShards(shardCount, processCount):
+    return [list(range(process, shardCount, processCount)) for process in range(processCount)]
+
+#
+# Starts one bot process per shard set and waits for them. The processes get SHARD_COUNT
+# and SHARD_IDS in their environment and, if METRICS_PORT is set, consecutive metrics
+# ports starting from it. SIGTERM to the launcher stops every process the way Ctrl+C
+# would, a Ctrl+C in the terminal already reaches them directly.
+#
+def launch(shardCount, processCount, script = None):
+    if script == None:
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+
+    metricsPort = os.getenv('METRICS_PORT')
+    processes = []
+    for index, shardIds in enumerate(assignShards(shardCount, processCount)):
+        environment = dict(os.environ)
+        environment['SHARD_COUNT'] = str(shardCount)
+        environment['SHARD_IDS'] = ','.join(str(shardId) for shardId in shardIds)
+        if metricsPort:
+            environment['METRICS_PORT'] = str(int(metricsPort) + index)
+
+        processes.append(subprocess.Popen([sys.executable, script], env = environment))
+
+    def stop(signalNumber, frame):
+        for process in processes:
+            if process.poll() == None:
+                process.send_signal(signal.SIGINT)
+
+    # Set after the processes start so they do not inherit the ignored SIGINT
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, stop)
+
+    status = 0
+    for process in processes:
+        status = max(status, process.wait())
+
+    return status
+
+if __name__ == '__main__':
+    # python sharding.py SHARD_COUNT PROCESS_COUNT
+    if len(sys.argv) != 3:
+        print('Usage: python sharding.py SHARD_COUNT PROCESS_COUNT')
+        sys.exit(1)
+
+    shardCount = int(sys.argv[1])
+    processCount = int(sys.argv[2])
+    if processCount < 1 or processCount > shardCount:
+        print('PROCESS_COUNT must be between 1 and SHARD_COUNT')
+        sys.exit(1)
+
+    sys.exit(launch(shardCount, processCount))
@@ -0,0 +1,251 @@
+import collections
+import io
+import mmap
+import struct
+import sys
+
+from array import array
+from datetime import date
+
+from birthdayindex import SortedBirthdays
+from model import GuildRecord, UserRecord
+
+#
+# Binary snapshot of the data, laid out so a load only has to read the guild table and each
+# guild's users can be decoded from a memory mapping the first time they are needed.
+# All integers are little endian.
+#
+#   header       MAGIC, format version, flags (unused), guild count, guild table offset
+#   guild blocks one per guild, each starting on an 8 byte boundary:
+#                  user ids          int64 per user
+#                  name lengths      int32 per user, -1 for users without a name
+#                  birthdays         uint16 day of the year per user
+#                  user names        UTF-8, back to back
+#                  guild name        UTF-8
+#                  timezone name     UTF-8, for guilds with an IANA time zone
+#                users are ordered by birthday, then by id
+#   guild table  one fixed size GUILD_ENTRY per guild, ordered by guild id
+#
+# Readers refuse files with a newer version than FORMAT_VERSION.
+#
+MAGIC = b'BDAYSNAP'
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct('<8sHHIQ')
+GUILD_ENTRY = struct.Struct('<qqQIIIHHhbB')
+
+# Fields of GUILD_ENTRY. lastAnnounced is a date ordinal and timezoneMinutes a fixed UTC offset.
+GuildEntry = collections.namedtuple('GuildEntry', ('guildId', 'channelId', 'blockOffset', 'userCount', 'userNamesLength',
+    'lastAnnounced', 'nameLength', 'timezoneLength', 'timezoneMinutes', 'announceHour', 'flags'))
+
+# GuildEntry.flags, telling settings that are set apart from ones that were never set
+HAS_NAME = 1
+HAS_CHANNEL = 2
+HAS_TIMEZONE = 4
+TIMEZONE_NAME = 8
+HAS_ANNOUNCE_HOUR = 16
+HAS_LAST_ANNOUNCED = 32
+
+# Bytes per user in the fixed size columns of a guild block
+USER_COLUMN_BYTES = 8 + 4 + 2
+
+def readArray(buffer, typecode, offset, count):
+    values = array(typecode)
+    values.frombytes(buffer[offset:offset + count * values.itemsize])
+    if sys.byteorder != 'little':
+        values.byteswap()
+
+    return values
+
+def packArray(typecode, values):
+    values = array(typecode, values)
+    if sys.byteorder != 'little':
+        values.byteswap()
+
+    return values.tobytes()
+
+def blockLength(entry):
+    return entry.userCount * USER_COLUMN_BYTES + entry.userNamesLength + entry.nameLength + entry.timezoneLength
+
+#
+# Encodes a guild's settings as (GuildEntry, the bytes that end its block) for a block whose
+# users take userCount and userNamesLength. The entry's blockOffset is filled in by writeSnapshot.
+#
+def encodeSettings(guild, userCount, userNamesLength):
+    flags = 0
+    guildName = b''
+    if guild.name != None:
+        flags |= HAS_NAME
+        guildName = guild.name.encode('utf-8')
+
+    channelId = 0
+    if guild.channelId != None:
+        flags |= HAS_CHANNEL
+        channelId = guild.channelId
+
+    timezoneName = b''
+    timezoneMinutes = 0
+    if isinstance(guild.timezone, str):
+        flags |= HAS_TIMEZONE | TIMEZONE_NAME
+        timezoneName = guild.timezone.encode('utf-8')
+    elif guild.timezone != None:
+        flags |= HAS_TIMEZONE
+        timezoneMinutes = round(guild.timezone * 60)
+
+    announceHour = 0
+    if guild.announceHour != None:
+        flags |= HAS_ANNOUNCE_HOUR
+        announceHour = guild.announceHour
+
+    lastAnnounced = 0
+    if guild.lastAnnounced != None:
+        flags |= HAS_LAST_ANNOUNCED
+        lastAnnounced = date.fromisoformat(guild.lastAnnounced).toordinal()
+
+    entry = GuildEntry(guild.id, channelId, 0, userCount, userNamesLength, lastAnnounced,
+        len(guildName), len(timezoneName), timezoneMinutes, announceHour, flags)
+    return entry, guildName + timezoneName
+
+#
+# Encodes a guild as (GuildEntry, block bytes). birthdays is the guild's SortedBirthdays,
+# which fixes the order of the users. The entry's blockOffset is filled in by writeSnapshot.
+#
+def encodeGuild(guild, birthdays):
+    users = guild.users
+    names = []
+    nameLengths = []
+    for userId in birthdays.userIds:
+        name = users[userId].name
+        if name == None:
+            nameLengths.append(-1)
+            continue
+
+        encoded = name.encode('utf-8')
+        names.append(encoded)
+        nameLengths.append(len(encoded))
+
+    userNames = b''.join(names)
+    entry, settings = encodeSettings(guild, len(birthdays), len(userNames))
+    block = b''.join((packArray('q', birthdays.userIds), packArray('i', nameLengths), packArray('H', birthdays.days),
+        userNames, settings))
+    return entry, block
+
+#
+# Writes a snapshot of guilds, an iterable of (GuildEntry, block bytes) as returned by
+# encodeGuild, SnapshotFile.block or SnapshotFile.blockWithSettings, to a binary file. Returns
+# the number of bytes written.
+#
+def writeSnapshot(snapshot_file, guilds):
+    snapshot_file.write(bytes(HEADER.size))
+    offset = HEADER.size
+    entries = []
+    for entry, block in guilds:
+        padding = -offset % 8
+        snapshot_file.write(bytes(padding) + block)
+        entries.append(entry._replace(blockOffset = offset + padding))
+        offset += padding + len(block)
+
+    entries.sort()
+    for entry in entries:
+        snapshot_file.write(GUILD_ENTRY.pack(*entry))
+
+    # The header is written last, once the table offset is known
+    snapshot_file.seek(0)
+    snapshot_file.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(entries), offset))
+    return snapshot_file.seek(0, io.SEEK_END)
+
+#
+# A snapshot file mapped into memory. Opening it reads the guild table, guilds are decoded
+# on request. Raises ValueError if the file is not a snapshot or was written by a newer
+# version.
+#
+class SnapshotFile:
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        with open(fileName, 'rb') as snapshot_file:
+            self.buffer = mmap.mmap(snapshot_file.fileno(), 0, access = mmap.ACCESS_READ)
+
+        try:
+            if len(self.buffer) < HEADER.size:
+                raise ValueError('{} is not a birthday snapshot'.format(fileName))
+
+            magic, version, flags, guildCount, tableOffset = HEADER.unpack_from(self.buffer)
+            if magic != MAGIC:
+                raise ValueError('{} is not a birthday snapshot'.format(fileName))
+
+            if version > FORMAT_VERSION:
+                raise ValueError('{} has snapshot format version {}, this version reads up to {}'.format(fileName, version, FORMAT_VERSION))
+
+            tableEnd = tableOffset + guildCount * GUILD_ENTRY.size
+            if tableEnd > len(self.buffer):
+                raise ValueError('{} is truncated'.format(fileName))
+        except ValueError:
+            self.buffer.close()
+            raise
+
+        # {guildId: GuildEntry}
+        self.entries = {entry[0]: GuildEntry._make(entry) for entry in GUILD_ENTRY.iter_unpack(self.buffer[tableOffset:tableEnd])}
+
+    # Returns the GuildRecord of the entry with its settings only
+    def settings(self, entry):
+        offset = entry.blockOffset + entry.userCount * USER_COLUMN_BYTES + entry.userNamesLength
+        guild = GuildRecord(entry.guildId, None)
+        if entry.flags & HAS_NAME:
+            guild.name = self.buffer[offset:offset + entry.nameLength].decode('utf-8')
+
+        if entry.flags & HAS_CHANNEL:
+            guild.channelId = entry.channelId
+
+        if entry.flags & TIMEZONE_NAME:
+            offset += entry.nameLength
+            guild.timezone = self.buffer[offset:offset + entry.timezoneLength].decode('utf-8')
+        elif entry.flags & HAS_TIMEZONE:
+            hours, minutes = divmod(entry.timezoneMinutes, 60)
+            guild.timezone = hours if minutes == 0 else entry.timezoneMinutes / 60
+
+        if entry.flags & HAS_ANNOUNCE_HOUR:
+            guild.announceHour = entry.announceHour
+
+        if entry.flags & HAS_LAST_ANNOUNCED:
+            guild.lastAnnounced = date.fromordinal(entry.lastAnnounced).isoformat()
+
+        return guild
+
+    # Decodes the entry's guild. Returns (GuildRecord including its users, SortedBirthdays).
+    def guild(self, entry):
+        if entry.blockOffset + blockLength(entry) > len(self.buffer):
+            raise ValueError('{} is truncated'.format(self.fileName))
+
+        guild = self.settings(entry)
+        count = entry.userCount
+        offset = entry.blockOffset
+        userIds = readArray(self.buffer, 'q', offset, count)
+        nameLengths = readArray(self.buffer, 'i', offset + 8 * count, count)
+        days = readArray(self.buffer, 'H', offset + 12 * count, count)
+        names = self.buffer[offset + USER_COLUMN_BYTES * count:offset + USER_COLUMN_BYTES * count + entry.userNamesLength]
+
+        users = guild.users
+        position = 0
+        for userId, nameLength, birthday in zip(userIds, nameLengths, days):
+            name = None
+            if nameLength >= 0:
+                name = names[position:position + nameLength].decode('utf-8')
+                position += nameLength
+
+            users[userId] = UserRecord(name, birthday)
+
+        return guild, SortedBirthdays.fromSorted(tuple(days), tuple(userIds))
+
+    # Returns (GuildEntry, block bytes) of the entry, for writing it to a new snapshot unchanged
+    def block(self, entry):
+        return entry, self.buffer[entry.blockOffset:entry.blockOffset + blockLength(entry)]
+
+    # Like block, but with the settings of guild, a GuildRecord, in place of the entry's. The users are copied without decoding them.
+    def blockWithSettings(self, entry, guild):
+        usersEnd = entry.blockOffset + entry.userCount * USER_COLUMN_BYTES + entry.userNamesLength
+        settingsEntry, settings = encodeSettings(guild, entry.userCount, entry.userNamesLength)
+        return settingsEntry, self.buffer[entry.blockOffset:usersEnd] + settings
+
+    def close(self):
+        self.buffer.close()
@@ -0,0 +1,1814 @@
+import asyncio
+import collections
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import time
+
+from birthdayindex import EMPTY_BIRTHDAYS, CalendarIndex, SortedBirthdays
+from metrics import FLUSH_BYTES, FLUSH_SECONDS, GUILD_CACHE_EVICTIONS, GUILD_CACHE_GUILDS, GUILD_CACHE_REQUESTS, GUILD_CACHE_USERS
+from model import DAYS_IN_YEAR, GUILD_SETTINGS, GuildRecord, GuildSnapshot, UserRecord, formatStoredDate, fromDayOfYear, parseStoredDate, toDayOfYear
+from sharding import shardFileName, shardOf
+from snapshotfile import SnapshotFile, encodeGuild, writeSnapshot
+
+DEFAULT_DATA_FILE = 'data.json'
+DEFAULT_DATABASE_FILE = 'data.db'
+DEFAULT_SNAPSHOT_FILE = 'data.bin'
+
+log = logging.getLogger(__name__)
+
+# Mutations arriving within this many seconds of each other are folded into a single write
+DEFAULT_FLUSH_DELAY = 2.0
+
+# The journal is folded into a fresh snapshot once it grows past this many bytes
+DEFAULT_JOURNAL_MAX_BYTES = 1024 * 1024
+# or once its oldest record is this many seconds old
+DEFAULT_JOURNAL_MAX_AGE = 60 * 60
+
+# Birthdays CachedStore keeps in memory, counting one more per resident guild
+DEFAULT_CACHE_CAPACITY = 100000
+
+# Data files are read this many characters at a time
+READ_CHUNK_SIZE = 64 * 1024
+
+# An async load gives the event loop a turn after this many seconds of parsing
+LOAD_SLICE_SECONDS = 0.005
+
+WHITESPACE = re.compile(r'\s*')
+# Characters that continue a number past where a decoder stops in an incomplete one
+NUMBER_CONTINUATION = '.eE+-'
+
+#
+# Reads the top level object of a JSON file one item at a time, yielding (key, value) pairs,
+# so a large data file is never held in memory as a whole. Raises ValueError if the file is
+# not a JSON object.
+#
+def readJsonObjectItems(dataFile, chunkSize = READ_CHUNK_SIZE):
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+
+    # Reads at least as much as is buffered, so values spanning many chunks are parsed in
+    # linear time. Returns False at the end of the file.
+    def fill():
+        nonlocal buffer, position
+        chunk = dataFile.read(max(chunkSize, len(buffer) - position))
+        if chunk == '':
+            return False
+
+        buffer = buffer[position:] + chunk
+        position = 0
+        return True
+
+    def skipWhitespace():
+        nonlocal position
+        while True:
+            position = WHITESPACE.match(buffer, position).end()
+            if position < len(buffer) or fill() == False:
+                return
+
+    def expect(characters):
+        nonlocal position
+        skipWhitespace()
+        if position >= len(buffer) or buffer[position] not in characters:
+            raise ValueError('Expected one of {!r} in {}'.format(characters, getattr(dataFile, 'name', 'data file')))
+
+        position += 1
+        return buffer[position - 1]
+
+    def decode():
+        nonlocal position
+        skipWhitespace()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if fill() == False:
+                    raise
+
+                continue
+
+            # A number running up to the end of the buffer, or followed by the start of a fraction or
+            # exponent, may continue in the next chunk. Decoding '1' of '1.5' stops before the '.'.
+            if isinstance(value, (dict, list, str)) == False and (end == len(buffer) or buffer[end] in NUMBER_CONTINUATION) and fill():
+                continue
+
+            position = end
+            return value
+
+    expect('{')
+    skipWhitespace()
+    if position < len(buffer) and buffer[position] == '}':
+        return
+
+    while True:
+        key = decode()
+        if isinstance(key, str) == False:
+            raise ValueError('Expected a string key in {}'.format(getattr(dataFile, 'name', 'data file')))
+
+        expect(':')
+        yield key, decode()
+        if expect(',}') == '}':
+            return
+
+#
+# Writes a file through write(file) to a temporary file next to the target, syncs it to disk
+# and renames it over the target. A crash at any point leaves either the old or the new file
+# in place. Returns the size of the written file in bytes.
+#
+def writeFileAtomic(fileName, write, binary = False):
+    tempFileName = '{}.tmp'.format(fileName)
+    with open(tempFileName, 'wb' if binary else 'w') as data_file:
+        write(data_file)
+        data_file.flush()
+        os.fsync(data_file.fileno())
+        size = data_file.tell()
+
+    os.replace(tempFileName, fileName)
+
+    # Persist the rename itself
+    try:
+        directory = os.open(os.path.dirname(os.path.abspath(fileName)), os.O_RDONLY)
+    except OSError:
+        return size
+
+    try:
+        os.fsync(directory)
+    except OSError:
+        pass
+    finally:
+        os.close(directory)
+
+    return size
+
+def writeJsonAtomic(fileName, document):
+    return writeFileAtomic(fileName, lambda data_file: json.dump(document, data_file, indent = 2))
+
+# Converts guild records to the data.json layout
+def serializeGuilds(guilds):
+    return {str(guild.id): guild.toJson() for guild in guilds}
+
+def writeGuildsAtomic(fileName, guilds):
+    return writeJsonAtomic(fileName, serializeGuilds(guilds))
+
+#
+# Interface shared by all storage backends.
+# Ids are passed and returned as ints and birthdays as days of the year (see model.py).
+# Guilds are returned as GuildRecords and users as UserRecords. Settings are changed by
+# their data.json key, one of the keys of GUILD_SETTINGS.
+#
+# Mutations are applied in memory immediately and written out by a background task that
+# coalesces everything changed within flushDelay seconds. close() must be awaited on shutdown.
+#
+class Storage:
+
+    def __init__(self, flushDelay = DEFAULT_FLUSH_DELAY):
+        self.flushDelay = flushDelay
+        self.dirty = False
+        self.flushTask = None
+        self.flushWaiting = False
+        self.flushLock = None
+        # {guildId: int}, see birthdayVersion
+        self.birthdayVersions = {}
+        # Whether guilds are paged in on demand, so prefetch() is worth calling
+        self.pagesGuilds = False
+
+    def load(self):
+        raise NotImplementedError
+
+    # Loads like load(), but lets the event loop run other tasks while loading a large data set
+    async def loadAsync(self):
+        self.load()
+
+    # Raises KeyError if the guild has no data
+    def getGuild(self, guildId):
+        raise NotImplementedError
+
+    def hasGuild(self, guildId):
+        try:
+            self.getGuild(guildId)
+            return True
+        except KeyError:
+            return False
+
+    def createGuild(self, guildId, name):
+        raise NotImplementedError
+
+    # Raises KeyError if the guild has no data
+    def deleteGuild(self, guildId):
+        raise NotImplementedError
+
+    def setGuildSetting(self, guildId, key, value):
+        raise NotImplementedError
+
+    # Returns the GuildRecords of every guild with an announcement channel
+    def announceGuilds(self):
+        raise NotImplementedError
+
+    def guildIds(self):
+        raise NotImplementedError
+
+    # Raises KeyError if the user has no data
+    def getUser(self, guildId, userId):
+        raise NotImplementedError
+
+    def setUser(self, guildId, userId, name, birthday):
+        raise NotImplementedError
+
+    # Sets many birthdays of one guild as a single change. users is an iterable of (userId, name, birthday).
+    def setUsers(self, guildId, users):
+        raise NotImplementedError
+
+    # Raises KeyError if the user has no data
+    def deleteUser(self, guildId, userId):
+        raise NotImplementedError
+
+    # Deletes the users of the guild that have data as a single change. Returns how many were deleted.
+    def deleteUsers(self, guildId, userIds):
+        raise NotImplementedError
+
+    def countUsers(self, guildId):
+        raise NotImplementedError
+
+    # Yields (userId, UserRecord) for every user in the guild, ordered by birthday
+    def iterUsers(self, guildId):
+        raise NotImplementedError
+
+    #
+    # Returns a GuildSnapshot of the guild that later changes do not affect, for readers that
+    # hold on to the guild across await points. Raises KeyError if the guild has no data.
+    # Only the birthdays from the day of the year start through end, wrapping like
+    # birthdaysBetween, are guaranteed to be in it. Backends without an in-memory index copy
+    # just those.
+    #
+    def snapshot(self, guildId, start = 1, end = DAYS_IN_YEAR):
+        guild = self.getGuild(guildId)
+        birthdays = self.birthdaysBetween(guildId, start, end)
+        return GuildSnapshot(guild, SortedBirthdays((birthday, userId) for userId, birthday in birthdays))
+
+    # Hints that the guild is about to be used, for backends that do not keep every guild in memory
+    def prefetch(self, guildId):
+        pass
+
+    # Returns a number that changes whenever the guild's birthdays change, for caching results per guild
+    def birthdayVersion(self, guildId):
+        return self.birthdayVersions.get(guildId, 0)
+
+    def birthdaysChanged(self, guildId):
+        self.birthdayVersions[guildId] = self.birthdayVersion(guildId) + 1
+
+    # Returns every guild as a GuildRecord including its users. Callers must not modify them.
+    def exportGuilds(self):
+        raise NotImplementedError
+
+    # Adds GuildRecords including their users, replacing any guild with the same id
+    def importGuilds(self, guilds):
+        raise NotImplementedError
+
+    #
+    # Returns a list of (userId, birthday) for users in the guild whose birthday falls between
+    # the days of the year start and end inclusive. The range wraps around the end of the
+    # year if start is after end. Results are ordered by date starting at start.
+    #
+    def birthdaysBetween(self, guildId, start, end):
+        raise NotImplementedError
+
+    # Writes out everything changed since the last call. Returns the number of bytes written
+    # if the backend knows it, otherwise None.
+    async def writeChanges(self):
+        raise NotImplementedError
+
+    def writeChangesSync(self):
+        raise NotImplementedError
+
+    #
+    # Records that the data has changed. The write happens later on a background task, so
+    # any number of mutations made before it runs cost a single write.
+    #
+    def markDirty(self):
+        self.dirty = True
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop to defer to (IE tooling or shutdown), write immediately
+            self.flushSync()
+            return
+
+        if self.flushTask == None or self.flushTask.done():
+            self.flushTask = loop.create_task(self.delayedFlush())
+            # Until it starts the task is as good as waiting, close() may cancel it
+            self.flushWaiting = True
+
+    async def delayedFlush(self):
+        # Changes made while a write is in progress are picked up by another round
+        while self.dirty:
+            self.flushWaiting = True
+            try:
+                await asyncio.sleep(self.flushDelay)
+            finally:
+                self.flushWaiting = False
+
+            try:
+                await self.flush()
+            except Exception:
+                # flush() leaves the changes pending, they are retried on the next mutation or at shutdown
+                log.exception('Failed to save data')
+                return
+
+    async def flush(self):
+        if self.flushLock == None:
+            self.flushLock = asyncio.Lock()
+
+        async with self.flushLock:
+            if self.dirty == False:
+                return
+
+            self.dirty = False
+            try:
+                with FLUSH_SECONDS.time():
+                    written = await self.writeChanges()
+            except:
+                # Keep the changes pending so the next flush retries them
+                self.dirty = True
+                raise
+
+            if written != None:
+                FLUSH_BYTES.observe(written)
+
+    def flushSync(self):
+        if self.dirty == False:
+            return
+
+        self.dirty = False
+        try:
+            self.writeChangesSync()
+        except:
+            self.dirty = True
+            raise
+
+    # Writes out any pending changes and releases the backend, for use outside an event loop
+    def closeSync(self):
+        self.flushSync()
+
+    # Writes out any pending changes. Must be awaited before the process exits.
+    async def close(self):
+        if self.flushTask != None and self.flushTask.done() == False:
+            # Only interrupt the debounce sleep, never a write that is already in progress
+            if self.flushWaiting:
+                self.flushTask.cancel()
+
+            try:
+                await self.flushTask
+            except asyncio.CancelledError:
+                pass
+
+        self.flushTask = None
+        await self.flush()
+
+#
+# Keeps the whole data set in memory as GuildRecords and rewrites data.json when it changes.
+# Stored dates are parsed once at load, after that only the serialized copy written to disk
+# uses the 'M-D' format.
+#
+class JsonStore(Storage):
+
+    def __init__(self, fileName = DEFAULT_DATA_FILE, flushDelay = DEFAULT_FLUSH_DELAY):
+        super(JsonStore, self).__init__(flushDelay)
+        self.fileName = fileName
+        # {guildId: GuildRecord}
+        self.guilds = {}
+        self.index = CalendarIndex()
+        # Whether a write is serializing the records in self.guilds on another thread
+        self.writing = False
+        # Ids of the guilds copied since that write started, see changeGuild
+        self.copiedGuilds = set()
+
+    # Loads the data file one guild at a time, yielding after each guild
+    def loadGuilds(self):
+        self.guilds.clear()
+        self.index.clear()
+        try:
+            with open(self.fileName) as data_file:
+                for guildId, guildData in readJsonObjectItems(data_file):
+                    guild = GuildRecord.fromJson(guildId, guildData)
+                    self.guilds[guild.id] = guild
+                    self.index.addGuild(guild.id, guild.users)
+                    yield
+        except FileNotFoundError:
+            log.info('No data file found. Creating...', extra = {'file': self.fileName})
+            writeGuildsAtomic(self.fileName, [])
+
+    # load server settings and user information from the data file
+    def load(self):
+        for _ in self.loadGuilds():
+            pass
+
+    async def loadAsync(self):
+        sliceStarted = time.perf_counter()
+        for _ in self.loadGuilds():
+            if time.perf_counter() - sliceStarted >= LOAD_SLICE_SECONDS:
+                await asyncio.sleep(0)
+                sliceStarted = time.perf_counter()
+
+    # Files every birthday under its day in the calendar index
+    def rebuildIndex(self):
+        self.index.clear()
+        for guild in self.guilds.values():
+            self.index.addGuild(guild.id, guild.users)
+
+    def getGuild(self, guildId):
+        return self.guilds[guildId]
+
+    #
+    # Returns the guild's record for a change. While a write is serializing the records on
+    # another thread, a guild is copied on its first change and the copy takes its place, so
+    # the write sees every guild as it was when it started without a copy of each per flush.
+    #
+    def changeGuild(self, guildId):
+        guild = self.guilds[guildId]
+        if self.writing == False or guildId in self.copiedGuilds:
+            return guild
+
+        guild = guild.snapshot()
+        self.guilds[guildId] = guild
+        self.copiedGuilds.add(guildId)
+        return guild
+
+    # Runs write(guilds) on a worker thread with the current records, see changeGuild
+    async def writeGuilds(self, write):
+        guilds = list(self.guilds.values())
+        self.writing = True
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, write, guilds)
+        finally:
+            self.writing = False
+            self.copiedGuilds.clear()
+
+    def createGuild(self, guildId, name):
+        previous = self.guilds.get(guildId)
+        if previous != None:
+            self.index.removeGuild(guildId, previous.users)
+
+        self.guilds[guildId] = GuildRecord(guildId, name)
+        self.birthdaysChanged(guildId)
+        self.markDirty()
+
+    def deleteGuild(self, guildId):
+        guild = self.guilds.pop(guildId)
+        self.index.removeGuild(guildId, guild.users)
+        self.birthdaysChanged(guildId)
+        self.markDirty()
+
+    def setGuildSetting(self, guildId, key, value):
+        self.changeGuild(guildId).setSetting(key, value)
+        self.markDirty()
+
+    def announceGuilds(self):
+        return [guild for guild in self.guilds.values() if guild.hasChannel()]
+
+    def guildIds(self):
+        return list(self.guilds)
+
+    def getUser(self, guildId, userId):
+        return self.guilds[guildId].users[userId]
+
+    def putUser(self, guildId, userId, name, birthday):
+        users = self.changeGuild(guildId).users
+        previous = users.get(userId)
+        if previous != None:
+            self.index.remove(guildId, userId, previous.birthday)
+
+        users[userId] = UserRecord(name, birthday)
+        self.index.add(guildId, userId, birthday)
+
+    def setUser(self, guildId, userId, name, birthday):
+        self.putUser(guildId, userId, name, birthday)
+        self.birthdaysChanged(guildId)
+        self.markDirty()
+
+    def setUsers(self, guildId, users):
+        guildUsers = self.changeGuild(guildId).users
+        previous = {}
+        added = {}
+        for userId, name, birthday in users:
+            if userId not in added and userId in guildUsers:
+                previous[userId] = guildUsers[userId]
+
+            added[userId] = UserRecord(name, birthday)
+            guildUsers[userId] = added[userId]
+
+        self.index.replaceUsers(guildId, previous, added)
+        self.birthdaysChanged(guildId)
+        self.markDirty()
+
+    def deleteUser(self, guildId, userId):
+        user = self.changeGuild(guildId).users.pop(userId)
+        self.index.remove(guildId, userId, user.birthday)
+        self.birthdaysChanged(guildId)
+        self.markDirty()
+
+    def deleteUsers(self, guildId, userIds):
+        users = self.changeGuild(guildId).users
+        deleted = {}
+        for userId in userIds:
+            user = users.pop(userId, None)
+            if user != None:
+                deleted[userId] = user
+                self.userDeleted(guildId, userId)
+
+        if len(deleted) > 0:
+            self.index.replaceUsers(guildId, deleted, {})
+            self.birthdaysChanged(guildId)
+            self.markDirty()
+
+        return len(deleted)
+
+    # Called by deleteUsers for each user it deletes
+    def userDeleted(self, guildId, userId):
+        pass
+
+    def countUsers(self, guildId):
+        return len(self.guilds[guildId].users)
+
+    def iterUsers(self, guildId):
+        users = self.guilds[guildId].users
+        for userId, birthday in self.index.between(guildId, 1, DAYS_IN_YEAR):
+            yield userId, users[userId]
+
+    # Shares the index's sorted birthdays, which are replaced rather than modified on changes
+    def snapshot(self, guildId, start = 1, end = DAYS_IN_YEAR):
+        return GuildSnapshot(self.guilds[guildId], self.index.sortedBirthdays(guildId))
+
+    def exportGuilds(self):
+        return iter(self.guilds.values())
+
+    def importGuilds(self, guilds):
+        for guild in guilds:
+            previous = self.guilds.get(guild.id)
+            if previous != None:
+                self.index.removeGuild(guild.id, previous.users)
+
+            self.guilds[guild.id] = guild
+            self.index.addGuild(guild.id, guild.users)
+            self.birthdaysChanged(guild.id)
+
+        self.markDirty()
+
+    def birthdaysBetween(self, guildId, start, end):
+        if guildId not in self.guilds:
+            raise KeyError(guildId)
+
+        return self.index.between(guildId, start, end)
+
+    async def writeChanges(self):
+        return await self.writeGuilds(lambda guilds: writeGuildsAtomic(self.fileName, guilds))
+
+    def writeChangesSync(self):
+        writeGuildsAtomic(self.fileName, self.guilds.values())
+
+# Journal operations for each guild setting
+SETTING_OPERATIONS = {
+    'channel_id': 'set-channel',
+    'timezone': 'set-timezone',
+    'announce_hour': 'set-hour',
+    'last_announced': 'set-last-announced',
+}
+
+#
+# Applies a journal record to a {guildId: GuildRecord} map.
+# Every operation is idempotent so a journal can be replayed over a snapshot that already
+# contains some of its records. The calendar index has to be rebuilt afterwards.
+#
+def applyRecord(guilds, record):
+    operation = record['op']
+    guildId = record['guild']
+
+    if operation == 'create-guild':
+        if guildId not in guilds:
+            guilds[guildId] = GuildRecord(guildId, record['name'])
+    elif operation == 'wipe-guild':
+        guilds.pop(guildId, None)
+    elif operation == 'import-guild':
+        guilds[guildId] = GuildRecord.fromJson(guildId, record['data'])
+    elif operation == 'set-birthday':
+        guilds[guildId].users[record['user']] = UserRecord(record['name'], parseStoredDate(record['date']))
+    elif operation == 'delete-user':
+        guilds[guildId].users.pop(record['user'], None)
+    else:
+        for key, settingOperation in SETTING_OPERATIONS.items():
+            if operation == settingOperation:
+                guilds[guildId].setSetting(key, record['value'])
+                return
+
+        raise ValueError('Unknown journal operation: {}'.format(operation))
+
+#
+# Like JsonStore, but every mutation is appended to a journal as one small record instead of
+# rewriting the whole file. The data file becomes a snapshot that a background compaction
+# rewrites once the journal passes a size or age threshold.
+#
+# Files: <data file> is the latest snapshot, <data file>.journal holds the records made
+# since, and <data file>.journal.compacting holds the records being folded into the next
+# snapshot while a compaction is running.
+#
+class JournalStore(JsonStore):
+
+    def __init__(self, fileName = DEFAULT_DATA_FILE, flushDelay = DEFAULT_FLUSH_DELAY,
+            maxJournalBytes = DEFAULT_JOURNAL_MAX_BYTES, maxJournalAge = DEFAULT_JOURNAL_MAX_AGE):
+        super(JournalStore, self).__init__(fileName, flushDelay)
+        self.journalFileName = '{}.journal'.format(fileName)
+        self.compactingFileName = '{}.journal.compacting'.format(fileName)
+        self.maxJournalBytes = maxJournalBytes
+        self.maxJournalAge = maxJournalAge
+        self.journalFile = None
+        self.journalBytes = 0
+        self.syncedBytes = 0
+        self.journalStarted = None
+
+    def replayJournal(self, journalFileName):
+        try:
+            journal = open(journalFileName)
+        except FileNotFoundError:
+            return 0
+
+        replayed = 0
+        with journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A crash can leave the last record partially written
+                    log.warning('Ignoring incomplete journal record', extra = {'file': journalFileName})
+                    continue
+
+                try:
+                    applyRecord(self.guilds, record)
+                except KeyError:
+                    log.error('DATA_ERROR: Journal record for unknown guild', extra = {'guild_id': record.get('guild')})
+                    continue
+                except ValueError:
+                    log.error('DATA_ERROR: Invalid journal record', extra = {'record': record})
+                    continue
+
+                replayed += 1
+
+        return replayed
+
+    # Loads the latest snapshot and replays the journal tail on top of it
+    def load(self):
+        super(JournalStore, self).load()
+        self.recover()
+
+    async def loadAsync(self):
+        await super(JournalStore, self).loadAsync()
+        self.recover()
+
+    # Folds the journals left by the previous run into the loaded snapshot
+    def recover(self):
+        replayed = self.replayJournal(self.compactingFileName)
+        replayed += self.replayJournal(self.journalFileName)
+        log.info('Replayed journal records', extra = {'records': replayed})
+        if replayed > 0:
+            self.rebuildIndex()
+
+        # Start from a clean snapshot so an interrupted compaction is never replayed twice
+        if replayed > 0 or os.path.exists(self.compactingFileName):
+            writeGuildsAtomic(self.fileName, self.guilds.values())
+
+        for journalFileName in (self.compactingFileName, self.journalFileName):
+            try:
+                os.remove(journalFileName)
+            except FileNotFoundError:
+                pass
+
+        self.openJournal()
+
+    def openJournal(self):
+        self.journalFile = open(self.journalFileName, 'a')
+        self.journalBytes = 0
+        self.syncedBytes = 0
+        self.journalStarted = None
+
+    def writeRecord(self, record):
+        line = json.dumps(record, separators = (',', ':')) + '\n'
+        self.journalFile.write(line)
+        self.journalBytes += len(line)
+        if self.journalStarted == None:
+            self.journalStarted = time.monotonic()
+
+    def appendRecord(self, record):
+        self.writeRecord(record)
+        self.markDirty()
+
+    # Each mutation is applied through JsonStore, which also keeps the calendar index current
+    def createGuild(self, guildId, name):
+        super(JournalStore, self).createGuild(guildId, name)
+        self.appendRecord({'op': 'create-guild', 'guild': guildId, 'name': name})
+
+    def deleteGuild(self, guildId):
+        super(JournalStore, self).deleteGuild(guildId)
+        self.appendRecord({'op': 'wipe-guild', 'guild': guildId})
+
+    def setGuildSetting(self, guildId, key, value):
+        super(JournalStore, self).setGuildSetting(guildId, key, value)
+        self.appendRecord({'op': SETTING_OPERATIONS[key], 'guild': guildId, 'value': value})
+
+    def setUser(self, guildId, userId, name, birthday):
+        super(JournalStore, self).setUser(guildId, userId, name, birthday)
+        self.appendRecord({'op': 'set-birthday', 'guild': guildId, 'user': userId, 'name': name, 'date': formatStoredDate(birthday)})
+
+    # The records are synced together by a single flush
+    def setUsers(self, guildId, users):
+        if guildId not in self.guilds:
+            raise KeyError(guildId)
+
+        users = list(users)
+        for userId, name, birthday in users:
+            self.writeRecord({'op': 'set-birthday', 'guild': guildId, 'user': userId, 'name': name, 'date': formatStoredDate(birthday)})
+
+        super(JournalStore, self).setUsers(guildId, users)
+
+    def deleteUser(self, guildId, userId):
+        super(JournalStore, self).deleteUser(guildId, userId)
+        self.appendRecord({'op': 'delete-user', 'guild': guildId, 'user': userId})
+
+    def userDeleted(self, guildId, userId):
+        self.writeRecord({'op': 'delete-user', 'guild': guildId, 'user': userId})
+
+    # One record per guild, synced together by a single flush
+    def importGuilds(self, guilds):
+        guilds = list(guilds)
+        for guild in guilds:
+            self.writeRecord({'op': 'import-guild', 'guild': guild.id, 'data': guild.toJson()})
+
+        super(JournalStore, self).importGuilds(guilds)
+
+    def shouldCompact(self):
+        if self.journalStarted == None:
+            return False
+
+        if self.journalBytes >= self.maxJournalBytes:
+            return True
+
+        return time.monotonic() - self.journalStarted >= self.maxJournalAge
+
+    async def writeChanges(self):
+        # Appends are buffered, so this only has to push them out and sync the journal
+        self.journalFile.flush()
+        await asyncio.get_running_loop().run_in_executor(None, os.fsync, self.journalFile.fileno())
+        written = self.journalBytes - self.syncedBytes
+        self.syncedBytes = self.journalBytes
+
+        if self.shouldCompact():
+            written += await self.compact()
+
+        return written
+
+    def writeChangesSync(self):
+        self.journalFile.flush()
+        os.fsync(self.journalFile.fileno())
+
+    #
+    # Folds the journal into a new snapshot. The current journal is set aside and a fresh one
+    # takes new records while the snapshot is written in the background, so commands never
+    # wait on the compaction.
+    #
+    async def compact(self):
+        self.journalFile.close()
+        if os.path.exists(self.compactingFileName):
+            # A previous compaction failed, keep its records ahead of the current ones
+            with open(self.journalFileName) as journal, open(self.compactingFileName, 'a') as compacting:
+                compacting.write(journal.read())
+            os.remove(self.journalFileName)
+        else:
+            os.replace(self.journalFileName, self.compactingFileName)
+
+        self.openJournal()
+        return await self.writeGuilds(self.writeSnapshot)
+
+    def writeSnapshot(self, guilds):
+        size = writeGuildsAtomic(self.fileName, guilds)
+        os.remove(self.compactingFileName)
+        return size
+
+    def closeSync(self):
+        super(JournalStore, self).closeSync()
+        if self.journalFile != None:
+            self.journalFile.close()
+            self.journalFile = None
+
+    async def close(self):
+        await super(JournalStore, self).close()
+        if self.journalFile != None:
+            self.journalFile.close()
+            self.journalFile = None
+
+# timezone has no type, it holds an IANA zone name or an int UTC offset and either is kept as given
+SQLITE_GUILDS_TABLE = '''
+CREATE TABLE IF NOT EXISTS {} (
+    guild_id INTEGER PRIMARY KEY,
+    name TEXT,
+    channel_id INTEGER,
+    timezone,
+    announce_hour INTEGER,
+    last_announced TEXT
+);
+'''
+
+SQLITE_SCHEMA = SQLITE_GUILDS_TABLE.format('guilds') + '''
+CREATE TABLE IF NOT EXISTS birthdays (
+    guild_id INTEGER NOT NULL REFERENCES guilds (guild_id) ON DELETE CASCADE,
+    user_id INTEGER NOT NULL,
+    name TEXT,
+    month INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    PRIMARY KEY (guild_id, user_id)
+);
+
+CREATE INDEX IF NOT EXISTS birthdays_by_date ON birthdays (guild_id, month, day);
+'''
+
+# Columns of guilds after guild_id, in GuildRecord argument order
+GUILD_COLUMNS = ', '.join(('name',) + tuple(GUILD_SETTINGS))
+GUILD_PLACEHOLDERS = ', '.join('?' * (len(GUILD_SETTINGS) + 2))
+
+# Creates the tables, and adds setting columns that databases made by older versions lack
+def createSqliteSchema(connection):
+    connection.executescript(SQLITE_SCHEMA)
+    columns = {row[1]: row[2] for row in connection.execute('PRAGMA table_info(guilds)')}
+    for key in GUILD_SETTINGS:
+        if key not in columns:
+            connection.execute('ALTER TABLE guilds ADD COLUMN {}'.format(key))
+
+    if columns.get('timezone', '') != '':
+        untypeTimezoneColumn(connection)
+
+#
+# Older versions declared guilds.timezone INTEGER. SQLite cannot change a column's type, so
+# the table is copied into one with the current schema. Foreign keys are off while the old
+# table is dropped, otherwise every birthday would be deleted with it.
+#
+def untypeTimezoneColumn(connection):
+    log.info('Migrating guilds.timezone to an untyped column')
+    connection.commit()
+    foreignKeys = connection.execute('PRAGMA foreign_keys').fetchone()[0]
+    connection.execute('PRAGMA foreign_keys = OFF')
+    try:
+        connection.executescript('BEGIN;' + SQLITE_GUILDS_TABLE.format('guilds_migrated') + '''
+            INSERT INTO guilds_migrated (guild_id, {0}) SELECT guild_id, {0} FROM guilds;
+            DROP TABLE guilds;
+            ALTER TABLE guilds_migrated RENAME TO guilds;
+            COMMIT;
+        '''.format(GUILD_COLUMNS))
+    except:
+        connection.rollback()
+        raise
+    finally:
+        connection.execute('PRAGMA foreign_keys = {}'.format(foreignKeys))
+
+#
+# Keeps guilds and birthdays in SQLite tables. Lookups by date go through the
+# (guild_id, month, day) index instead of walking every user.
+# Statements run in an open transaction that is committed on the flush schedule.
+#
+class SqliteStore(Storage):
+
+    def __init__(self, fileName = DEFAULT_DATABASE_FILE, flushDelay = DEFAULT_FLUSH_DELAY):
+        super(SqliteStore, self).__init__(flushDelay)
+        self.fileName = fileName
+        self.connection = None
+
+    def load(self):
+        self.connection = sqlite3.connect(self.fileName)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        createSqliteSchema(self.connection)
+        self.connection.commit()
+
+    # Users stay in the birthdays table, the returned records only carry the guild settings
+    def getGuild(self, guildId):
+        row = self.connection.execute(
+            'SELECT guild_id, {} FROM guilds WHERE guild_id = ?'.format(GUILD_COLUMNS),
+            (guildId,)).fetchone()
+        if row == None:
+            raise KeyError(guildId)
+
+        return GuildRecord(*row)
+
+    def createGuild(self, guildId, name):
+        self.connection.execute('INSERT OR IGNORE INTO guilds (guild_id, name) VALUES (?, ?)', (guildId, name))
+        self.markDirty()
+
+    def deleteGuild(self, guildId):
+        cursor = self.connection.execute('DELETE FROM guilds WHERE guild_id = ?', (guildId,))
+        if cursor.rowcount == 0:
+            raise KeyError(guildId)
+
+        self.birthdaysChanged(guildId)
+        self.markDirty()
+
+    def setGuildSetting(self, guildId, key, value):
+        if key not in GUILD_SETTINGS:
+            raise KeyError(key)
+
+        cursor = self.connection.execute('UPDATE guilds SET {} = ? WHERE guild_id = ?'.format(key), (value, guildId))
+        if cursor.rowcount == 0:
+            raise KeyError(guildId)
+
+        self.markDirty()
+
+    def announceGuilds(self):
+        rows = self.connection.execute(
+            'SELECT guild_id, {} FROM guilds WHERE channel_id IS NOT NULL AND channel_id != -1'.format(GUILD_COLUMNS))
+        return [GuildRecord(*row) for row in rows]
+
+    def guildIds(self):
+        return [row[0] for row in self.connection.execute('SELECT guild_id FROM guilds')]
+
+    def getUser(self, guildId, userId):
+        row = self.connection.execute(
+            'SELECT name, month, day FROM birthdays WHERE guild_id = ? AND user_id = ?',
+            (guildId, userId)).fetchone()
+        if row == None:
+            raise KeyError(userId)
+
+        return UserRecord(row[0], toDayOfYear(row[1], row[2]))
+
+    def setUser(self, guildId, userId, name, birthday):
+        month, day = fromDayOfYear(birthday)
+        self.connection.execute(
+            'INSERT OR REPLACE INTO birthdays (guild_id, user_id, name, month, day) VALUES (?, ?, ?, ?, ?)',
+            (guildId, userId, name, month, day))
+        self.birthdaysChanged(guildId)
+        self.markDirty()
+
+    def setUsers(self, guildId, users):
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO birthdays (guild_id, user_id, name, month, day) VALUES (?, ?, ?, ?, ?)',
+            ((guildId, userId, name) + fromDayOfYear(birthday) for userId, name, birthday in users))
+        self.birthdaysChanged(guildId)
+        self.markDirty()
+
+    def deleteUser(self, guildId, userId):
+        cursor = self.connection.execute('DELETE FROM birthdays WHERE guild_id = ? AND user_id = ?', (guildId, userId))
+        if cursor.rowcount == 0:
+            raise KeyError(userId)
+
+        self.birthdaysChanged(guildId)
+        self.markDirty()
+
+    def deleteUsers(self, guildId, userIds):
+        cursor = self.connection.executemany('DELETE FROM birthdays WHERE guild_id = ? AND user_id = ?',
+            ((guildId, userId) for userId in userIds))
+        if cursor.rowcount > 0:
+            self.birthdaysChanged(guildId)
+            self.markDirty()
+
+        return cursor.rowcount
+
+    def countUsers(self, guildId):
+        return self.connection.execute('SELECT COUNT(*) FROM birthdays WHERE guild_id = ?', (guildId,)).fetchone()[0]
+
+    def iterUsers(self, guildId):
+        rows = self.connection.execute(
+            'SELECT user_id, name, month, day FROM birthdays WHERE guild_id = ? ORDER BY month, day, user_id', (guildId,))
+        for userId, name, month, day in rows:
+            yield userId, UserRecord(name, toDayOfYear(month, day))
+
+    def exportGuilds(self):
+        guilds = self.connection.execute('SELECT guild_id, {} FROM guilds ORDER BY guild_id'.format(GUILD_COLUMNS)).fetchall()
+        for row in guilds:
+            guild = GuildRecord(*row)
+            rows = self.connection.execute('SELECT user_id, name, month, day FROM birthdays WHERE guild_id = ?', (guild.id,))
+            for userId, name, month, day in rows:
+                guild.users[userId] = UserRecord(name, toDayOfYear(month, day))
+
+            yield guild
+
+    def importGuilds(self, guilds):
+        for guild in guilds:
+            self.connection.execute('DELETE FROM guilds WHERE guild_id = ?', (guild.id,))
+            self.connection.execute(
+                'INSERT INTO guilds (guild_id, {}) VALUES ({})'.format(GUILD_COLUMNS, GUILD_PLACEHOLDERS),
+                (guild.id, guild.name) + tuple(getattr(guild, attribute) for attribute in GUILD_SETTINGS.values()))
+            self.connection.executemany(
+                'INSERT INTO birthdays (guild_id, user_id, name, month, day) VALUES (?, ?, ?, ?, ?)',
+                ((guild.id, userId, user.name) + fromDayOfYear(user.birthday) for userId, user in guild.users.items()))
+            self.birthdaysChanged(guild.id)
+
+        self.markDirty()
+
+    def birthdaysBetween(self, guildId, start, end):
+        query = 'SELECT user_id, month, day FROM birthdays WHERE guild_id = ? AND {} ORDER BY month, day, user_id'
+        startMonthDay = fromDayOfYear(start)
+        endMonthDay = fromDayOfYear(end)
+        if start <= end:
+            rows = self.connection.execute(query.format('(month, day) BETWEEN (?, ?) AND (?, ?)'), (guildId,) + startMonthDay + endMonthDay).fetchall()
+        else:
+            rows = self.connection.execute(query.format('(month, day) >= (?, ?)'), (guildId,) + startMonthDay).fetchall()
+            rows += self.connection.execute(query.format('(month, day) <= (?, ?)'), (guildId,) + endMonthDay).fetchall()
+
+        return [(userId, toDayOfYear(month, day)) for userId, month, day in rows]
+
+    async def writeChanges(self):
+        # WAL commits with synchronous = NORMAL do not wait on the disk
+        self.connection.commit()
+
+    def writeChangesSync(self):
+        self.connection.commit()
+
+    def closeSync(self):
+        super(SqliteStore, self).closeSync()
+        if self.connection != None:
+            self.connection.close()
+            self.connection = None
+
+    async def close(self):
+        await super(SqliteStore, self).close()
+        if self.connection != None:
+            self.connection.close()
+            self.connection = None
+
+#
+# Keeps the data in a binary snapshot (see snapshotfile.py) that is memory mapped rather than
+# parsed at load, so a restart costs a read of the guild table however many birthdays are
+# stored. A guild's users are decoded from the mapping the first time the guild is used and
+# stay in memory from then on, like in JsonStore. Flushes rewrite the snapshot, copying the
+# blocks of guilds that were never decoded as they are.
+#
+# Reading or changing the settings of a guild does not decode it. A guild that was not decoded
+# is returned by getGuild with its settings only, and changed settings are kept apart until
+# the guild is decoded or written with its users copied as they are.
+#
+class BinaryStore(Storage):
+
+    def __init__(self, fileName = DEFAULT_SNAPSHOT_FILE, flushDelay = DEFAULT_FLUSH_DELAY):
+        super(BinaryStore, self).__init__(flushDelay)
+        self.fileName = fileName
+        self.snapshotFile = None
+        # {guildId: GuildEntry} of the guilds in the snapshot that were not decoded yet
+        self.entries = {}
+        # {guildId: GuildRecord with settings only} of the guilds in self.entries whose settings
+        # changed. Records are replaced rather than modified.
+        self.overrides = {}
+        # {guildId: GuildRecord} of the decoded and new guilds
+        self.guilds = {}
+        # {guildId: SortedBirthdays} of the guilds in self.guilds
+        self.birthdays = {}
+
+    def load(self):
+        if os.path.exists(self.fileName) == False:
+            log.info('No data file found. Creating...', extra = {'file': self.fileName})
+            writeFileAtomic(self.fileName, lambda snapshot_file: writeSnapshot(snapshot_file, []), binary = True)
+
+        if self.snapshotFile != None:
+            self.snapshotFile.close()
+
+        self.snapshotFile = SnapshotFile(self.fileName)
+        self.entries = dict(self.snapshotFile.entries)
+        self.overrides.clear()
+        self.guilds.clear()
+        self.birthdays.clear()
+
+    # Decodes a guild that was not decoded yet, with its changed settings. Returns (GuildRecord, SortedBirthdays).
+    def decode(self, guildId):
+        guild, birthdays = self.snapshotFile.guild(self.entries[guildId])
+        settings = self.overrides.get(guildId)
+        if settings != None:
+            for attribute in GUILD_SETTINGS.values():
+                setattr(guild, attribute, getattr(settings, attribute))
+
+        return guild, birthdays
+
+    # Returns the guild's GuildRecord, decoding it if needed. Raises KeyError if the guild has no data.
+    def decoded(self, guildId):
+        guild = self.guilds.get(guildId)
+        if guild != None:
+            return guild
+
+        guild, birthdays = self.decode(guildId)
+        del self.entries[guildId]
+        self.overrides.pop(guildId, None)
+        self.guilds[guildId] = guild
+        self.birthdays[guildId] = birthdays
+        return guild
+
+    # Returns the settings of a guild that was not decoded as a GuildRecord without users
+    def settings(self, guildId):
+        settings = self.overrides.get(guildId)
+        if settings != None:
+            return settings
+
+        return self.snapshotFile.settings(self.entries[guildId])
+
+    # Guilds that were not decoded are returned with their settings only
+    def getGuild(self, guildId):
+        guild = self.guilds.get(guildId)
+        if guild != None:
+            return guild
+
+        return self.settings(guildId)
+
+    def createGuild(self, guildId, name):
+        self.entries.pop(guildId, None)
+        self.overrides.pop(guildId, None)
+        self.guilds[guildId] = GuildRecord(guildId, name)
+        self.birthdays[guildId] = EMPTY_BIRTHDAYS
+        self.birthdaysChanged(guildId)
+        self.markDirty()
+
+    def deleteGuild(self, guildId):
+        if guildId in self.guilds:
+            del self.guilds[guildId]
+            del self.birthdays[guildId]
+        else:
+            del self.entries[guildId]
+            self.overrides.pop(guildId, None)
+
+        self.birthdaysChanged(guildId)
+        self.markDirty()
+
+    def setGuildSetting(self, guildId, key, value):
+        if key not in GUILD_SETTINGS:
+            raise KeyError(key)
+
+        guild = self.guilds.get(guildId)
+        if guild != None:
+            guild.setSetting(key, value)
+        else:
+            # A write may be encoding the current override, so it is replaced
+            settings = self.settings(guildId).snapshot()
+            settings.setSetting(key, value)
+            self.overrides[guildId] = settings
+
+        self.markDirty()
+
+    # Guilds that were not decoded are returned with their settings only
+    def announceGuilds(self):
+        guilds = [guild for guild in self.guilds.values() if guild.hasChannel()]
+        guilds.extend(guild for guild in map(self.settings, self.entries) if guild.hasChannel())
+        return guilds
+
+    def guildIds(self):
+        return list(self.guilds) + list(self.entries)
+
+    def getUser(self, guildId, userId):
+        return self.decoded(guildId).users[userId]
+
+    def setUser(self, guildId, userId, name, birthday):
+        users = self.decoded(guildId).users
+        birthdays = self.birthdays[guildId]
+        previous = users.get(userId)
+        if previous != None:
+            birthdays = birthdays.removed(userId, previous.birthday)
+
+        users[userId] = UserRecord(name, birthday)
+        self.birthdays[guildId] = birthdays.added(userId, birthday)
+        self.birthdaysChanged(guildId)
+        self.markDirty()
+
+    def setUsers(self, guildId, users):
+        guildUsers = self.decoded(guildId).users
+        for userId, name, birthday in users:
+            guildUsers[userId] = UserRecord(name, birthday)
+
+        self.birthdays[guildId] = SortedBirthdays((user.birthday, userId) for userId, user in guildUsers.items())
+        self.birthdaysChanged(guildId)
+        self.markDirty()
+
+    def deleteUser(self, guildId, userId):
+        user = self.decoded(guildId).users.pop(userId)
+        self.birthdays[guildId] = self.birthdays[guildId].removed(userId, user.birthday)
+        self.birthdaysChanged(guildId)
+        self.markDirty()
+
+    def deleteUsers(self, guildId, userIds):
+        users = self.decoded(guildId).users
+        deleted = [userId for userId in set(userIds) if users.pop(userId, None) != None]
+        if len(deleted) > 0:
+            self.birthdays[guildId] = SortedBirthdays((user.birthday, userId) for userId, user in users.items())
+            self.birthdaysChanged(guildId)
+            self.markDirty()
+
+        return len(deleted)
+
+    # The guild table has the count, so guilds are not decoded for it
+    def countUsers(self, guildId):
+        guild = self.guilds.get(guildId)
+        if guild == None:
+            return self.entries[guildId].userCount
+
+        return len(guild.users)
+
+    # Guilds that were not decoded are decoded for the walk only, without keeping them in memory
+    def iterUsers(self, guildId):
+        if guildId in self.entries:
+            guild, birthdays = self.decode(guildId)
+        else:
+            guild = self.decoded(guildId)
+            birthdays = self.birthdays[guildId]
+
+        users = guild.users
+        return ((userId, users[userId]) for userId in birthdays.userIds)
+
+    def snapshot(self, guildId, start = 1, end = DAYS_IN_YEAR):
+        return GuildSnapshot(self.decoded(guildId), self.birthdays[guildId])
+
+    # Guilds that were not decoded are decoded for the export only, without keeping them in memory
+    def exportGuilds(self):
+        yield from list(self.guilds.values())
+        for guildId in list(self.entries):
+            yield self.decode(guildId)[0]
+
+    def importGuilds(self, guilds):
+        for guild in guilds:
+            self.entries.pop(guild.id, None)
+            self.overrides.pop(guild.id, None)
+            self.guilds[guild.id] = guild
+            self.birthdays[guild.id] = SortedBirthdays((user.birthday, userId) for userId, user in guild.users.items())
+            self.birthdaysChanged(guild.id)
+
+        self.markDirty()
+
+    def birthdaysBetween(self, guildId, start, end):
+        self.decoded(guildId)
+        return self.birthdays[guildId].between(start, end)
+
+    #
+    # Writes the guilds captured by the caller to a new snapshot. Runs on an executor thread.
+    # Guilds that were not decoded keep their blocks' users, with the settings in overrides
+    # if they changed.
+    #
+    def writeGuilds(self, snapshotFile, guilds, entries, overrides):
+        def blocks():
+            for guild, birthdays in guilds:
+                yield encodeGuild(guild, birthdays)
+
+            for entry in entries:
+                settings = overrides.get(entry.guildId)
+                yield snapshotFile.block(entry) if settings == None else snapshotFile.blockWithSettings(entry, settings)
+
+        return writeFileAtomic(self.fileName, lambda snapshot_file: writeSnapshot(snapshot_file, blocks()), binary = True)
+
+    #
+    # Maps the snapshot just written. Guilds still not decoded now refer to their blocks in it,
+    # which hold the overrides that were written, so only the ones changed since are kept.
+    #
+    def remap(self, overrides):
+        previous = self.snapshotFile
+        self.snapshotFile = SnapshotFile(self.fileName)
+        self.entries = {guildId: entry for guildId, entry in self.snapshotFile.entries.items() if guildId in self.entries}
+        self.overrides = {guildId: settings for guildId, settings in self.overrides.items() if overrides.get(guildId) is not settings}
+        previous.close()
+
+    async def writeChanges(self):
+        guilds = [(guild.snapshot(), self.birthdays[guild.id]) for guild in self.guilds.values()]
+        entries = list(self.entries.values())
+        overrides = dict(self.overrides)
+        written = await asyncio.get_running_loop().run_in_executor(None, self.writeGuilds, self.snapshotFile, guilds, entries, overrides)
+        self.remap(overrides)
+        return written
+
+    def writeChangesSync(self):
+        guilds = [(guild, self.birthdays[guild.id]) for guild in self.guilds.values()]
+        self.writeGuilds(self.snapshotFile, guilds, list(self.entries.values()), self.overrides)
+        self.remap(self.overrides)
+
+    def closeSync(self):
+        super(BinaryStore, self).closeSync()
+        if self.snapshotFile != None:
+            self.snapshotFile.close()
+            self.snapshotFile = None
+
+    async def close(self):
+        await super(BinaryStore, self).close()
+        if self.snapshotFile != None:
+            self.snapshotFile.close()
+            self.snapshotFile = None
+
+# A guild resident in CachedStore
+class CachedGuild:
+    __slots__ = ('record', 'birthdays', 'dirtyUsers', 'weight')
+
+    def __init__(self, record, birthdays):
+        # GuildRecord including its users
+        self.record = record
+        # SortedBirthdays of the users, swapped for a new instance on every change
+        self.birthdays = birthdays
+        # Ids of users changed or deleted since they were last written to the database
+        self.dirtyUsers = set()
+        # Cache capacity used, see CachedStore
+        self.weight = 1 + len(record.users)
+
+#
+# Keeps the guilds in use in memory in front of a SQLite database, so memory follows the
+# number of active guilds instead of every registration. Guilds are paged in whole on their
+# first access and the least recently used ones are evicted once more than capacity users
+# (each guild counting one more for its settings) are resident.
+#
+# Settings and guild creation and deletion are written to the database immediately, so the
+# scans over every guild (announceGuilds, guildIds) never need to page guilds in. Birthday
+# changes are written back on the flush schedule or when their guild is evicted.
+#
+class CachedStore(Storage):
+
+    def __init__(self, fileName = DEFAULT_DATABASE_FILE, capacity = DEFAULT_CACHE_CAPACITY, flushDelay = DEFAULT_FLUSH_DELAY):
+        super(CachedStore, self).__init__(flushDelay)
+        self.fileName = fileName
+        self.capacity = capacity
+        self.database = SqliteStore(fileName, flushDelay)
+        self.pagesGuilds = True
+        # {guildId: CachedGuild}, least recently used first
+        self.guilds = collections.OrderedDict()
+        # Sum of the weights of the resident guilds
+        self.residentWeight = 0
+
+    def load(self):
+        self.database.load()
+
+    # Returns the resident guild, paging it in if needed. Raises KeyError if the guild has no data.
+    def cached(self, guildId, prefetch = False):
+        cachedGuild = self.guilds.get(guildId)
+        if cachedGuild != None:
+            self.guilds.move_to_end(guildId)
+            if prefetch == False:
+                GUILD_CACHE_REQUESTS.inc(result = 'hit')
+            return cachedGuild
+
+        guild = self.database.getGuild(guildId)
+        GUILD_CACHE_REQUESTS.inc(result = 'prefetch' if prefetch else 'miss')
+
+        # iterUsers yields the users in birthday order, so the sorted birthdays need no sort
+        days = []
+        userIds = []
+        for userId, user in self.database.iterUsers(guildId):
+            guild.users[userId] = user
+            days.append(user.birthday)
+            userIds.append(userId)
+
+        cachedGuild = CachedGuild(guild, SortedBirthdays.fromSorted(tuple(days), tuple(userIds)))
+        self.guilds[guildId] = cachedGuild
+        self.residentWeight += cachedGuild.weight
+        GUILD_CACHE_GUILDS.inc()
+        GUILD_CACHE_USERS.inc(len(guild.users))
+        self.evict()
+        return cachedGuild
+
+    # Evicts least recently used guilds until the cache is within capacity. The most recently used guild always stays.
+    def evict(self):
+        while self.residentWeight > self.capacity and len(self.guilds) > 1:
+            guildId, cachedGuild = self.guilds.popitem(last = False)
+            self.writeBack(cachedGuild)
+            self.residentWeight -= cachedGuild.weight
+            GUILD_CACHE_EVICTIONS.inc()
+            GUILD_CACHE_GUILDS.inc(-1)
+            GUILD_CACHE_USERS.inc(-len(cachedGuild.record.users))
+
+    # Writes the guild's changed birthdays to the database, which commits them on its own flush schedule
+    def writeBack(self, cachedGuild):
+        if len(cachedGuild.dirtyUsers) == 0:
+            return
+
+        guild = cachedGuild.record
+        changed = [(userId, guild.users[userId].name, guild.users[userId].birthday) for userId in cachedGuild.dirtyUsers if userId in guild.users]
+        deleted = [userId for userId in cachedGuild.dirtyUsers if userId not in guild.users]
+        cachedGuild.dirtyUsers = set()
+        if len(changed) > 0:
+            self.database.setUsers(guild.id, changed)
+        if len(deleted) > 0:
+            self.database.deleteUsers(guild.id, deleted)
+
+    def writeBackAll(self):
+        for cachedGuild in self.guilds.values():
+            self.writeBack(cachedGuild)
+
+    # Drops the guild from the cache without writing it back
+    def discard(self, guildId):
+        cachedGuild = self.guilds.pop(guildId, None)
+        if cachedGuild == None:
+            return
+
+        self.residentWeight -= cachedGuild.weight
+        GUILD_CACHE_GUILDS.inc(-1)
+        GUILD_CACHE_USERS.inc(-len(cachedGuild.record.users))
+
+    # Records a change to the guild's birthdays. previous is the number of users before it.
+    def usersChanged(self, cachedGuild, previous):
+        users = len(cachedGuild.record.users)
+        cachedGuild.weight = 1 + users
+        self.residentWeight += users - previous
+        GUILD_CACHE_USERS.inc(users - previous)
+        self.birthdaysChanged(cachedGuild.record.id)
+        self.markDirty()
+        self.evict()
+
+    def prefetch(self, guildId):
+        try:
+            self.cached(guildId, prefetch = True)
+        except KeyError:
+            pass
+
+    def getGuild(self, guildId):
+        return self.cached(guildId).record
+
+    # The database ignores the creation of an existing guild, and so does the cache
+    def createGuild(self, guildId, name):
+        self.database.createGuild(guildId, name)
+
+    def deleteGuild(self, guildId):
+        self.database.deleteGuild(guildId)
+        self.discard(guildId)
+
+        self.birthdaysChanged(guildId)
+
+    def setGuildSetting(self, guildId, key, value):
+        self.database.setGuildSetting(guildId, key, value)
+        cachedGuild = self.guilds.get(guildId)
+        if cachedGuild != None:
+            cachedGuild.record.setSetting(key, value)
+
+    def announceGuilds(self):
+        return self.database.announceGuilds()
+
+    def guildIds(self):
+        return self.database.guildIds()
+
+    def getUser(self, guildId, userId):
+        return self.cached(guildId).record.users[userId]
+
+    def setUser(self, guildId, userId, name, birthday):
+        cachedGuild = self.cached(guildId)
+        users = cachedGuild.record.users
+        previous = len(users)
+        birthdays = cachedGuild.birthdays
+        oldUser = users.get(userId)
+        if oldUser != None:
+            birthdays = birthdays.removed(userId, oldUser.birthday)
+
+        users[userId] = UserRecord(name, birthday)
+        cachedGuild.birthdays = birthdays.added(userId, birthday)
+        cachedGuild.dirtyUsers.add(userId)
+        self.usersChanged(cachedGuild, previous)
+
+    def setUsers(self, guildId, users):
+        cachedGuild = self.cached(guildId)
+        guildUsers = cachedGuild.record.users
+        previous = len(guildUsers)
+        for userId, name, birthday in users:
+            guildUsers[userId] = UserRecord(name, birthday)
+            cachedGuild.dirtyUsers.add(userId)
+
+        cachedGuild.birthdays = SortedBirthdays((user.birthday, userId) for userId, user in guildUsers.items())
+        self.usersChanged(cachedGuild, previous)
+
+    def deleteUser(self, guildId, userId):
+        cachedGuild = self.cached(guildId)
+        users = cachedGuild.record.users
+        previous = len(users)
+        user = users.pop(userId)
+        cachedGuild.birthdays = cachedGuild.birthdays.removed(userId, user.birthday)
+        cachedGuild.dirtyUsers.add(userId)
+        self.usersChanged(cachedGuild, previous)
+
+    def deleteUsers(self, guildId, userIds):
+        cachedGuild = self.cached(guildId)
+        users = cachedGuild.record.users
+        previous = len(users)
+        deleted = [userId for userId in set(userIds) if users.pop(userId, None) != None]
+        if len(deleted) == 0:
+            return 0
+
+        cachedGuild.birthdays = SortedBirthdays((user.birthday, userId) for userId, user in users.items())
+        cachedGuild.dirtyUsers.update(deleted)
+        self.usersChanged(cachedGuild, previous)
+        return len(deleted)
+
+    # Counting does not need the users in memory, so guilds that are not resident are counted in the database
+    def countUsers(self, guildId):
+        cachedGuild = self.guilds.get(guildId)
+        if cachedGuild == None:
+            return self.database.countUsers(guildId)
+
+        return len(cachedGuild.record.users)
+
+    #
+    # Guilds that are not resident are read from the database without paging them in, so a
+    # pass over every guild, like the reconciler's, does not evict the guilds in use. They
+    # have no changes waiting, those are written back when a guild is evicted.
+    #
+    def iterUsers(self, guildId):
+        cachedGuild = self.guilds.get(guildId)
+        if cachedGuild == None:
+            if self.database.hasGuild(guildId) == False:
+                raise KeyError(guildId)
+
+            return self.database.iterUsers(guildId)
+
+        users = cachedGuild.record.users
+        return ((userId, users[userId]) for userId in cachedGuild.birthdays.userIds)
+
+    def snapshot(self, guildId, start = 1, end = DAYS_IN_YEAR):
+        cachedGuild = self.cached(guildId)
+        return GuildSnapshot(cachedGuild.record, cachedGuild.birthdays)
+
+    def exportGuilds(self):
+        self.writeBackAll()
+        return self.database.exportGuilds()
+
+    def importGuilds(self, guilds):
+        guilds = list(guilds)
+        for guild in guilds:
+            self.discard(guild.id)
+            self.birthdaysChanged(guild.id)
+
+        self.database.importGuilds(guilds)
+
+    def birthdaysBetween(self, guildId, start, end):
+        return self.cached(guildId).birthdays.between(start, end)
+
+    async def writeChanges(self):
+        self.writeBackAll()
+        await self.database.flush()
+
+    def writeChangesSync(self):
+        self.writeBackAll()
+        self.database.flushSync()
+
+    def closeSync(self):
+        super(CachedStore, self).closeSync()
+        self.database.closeSync()
+        for guildId in list(self.guilds):
+            self.discard(guildId)
+
+    async def close(self):
+        await super(CachedStore, self).close()
+        await self.database.close()
+        for guildId in list(self.guilds):
+            self.discard(guildId)
+
+#
+# Splits the data into one store per gateway shard, so each bot process only loads and
+# writes the guilds on the shards it runs. Guilds are routed to the store of their shard,
+# guilds on shards owned by other processes are not found here.
+#
+# A shard store that does not exist yet is seeded with its guilds from the unsharded data
+# file, if there is one. The unsharded file itself is left untouched.
+#
+class ShardedStorage(Storage):
+
+    # The cache capacity of the 'cached' backend is split evenly between the shards
+    def __init__(self, backend, fileName, shardCount, shardIds, cacheCapacity = DEFAULT_CACHE_CAPACITY):
+        super(ShardedStorage, self).__init__()
+        self.backend = backend
+        self.fileName = fileName
+        self.shardCount = shardCount
+        shardIds = list(shardIds)
+        shardCapacity = max(1, cacheCapacity // max(1, len(shardIds)))
+        # {shardId: Storage}
+        self.shards = {shardId: openStorage(backend, shardFileName(fileName, shardId, shardCount), cacheCapacity = shardCapacity)
+            for shardId in shardIds}
+        self.pagesGuilds = any(store.pagesGuilds for store in self.shards.values())
+
+    def unseededShards(self):
+        if os.path.exists(self.fileName) == False:
+            return []
+
+        return [shardId for shardId, store in self.shards.items() if os.path.exists(store.fileName) == False]
+
+    def load(self):
+        unseeded = self.unseededShards()
+        for store in self.shards.values():
+            store.load()
+
+        if len(unseeded) > 0:
+            self.seed(unseeded)
+
+    async def loadAsync(self):
+        unseeded = self.unseededShards()
+        for store in self.shards.values():
+            await store.loadAsync()
+
+        if len(unseeded) > 0:
+            self.seed(unseeded)
+
+    def seed(self, shardIds):
+        source = openStorage(self.backend, self.fileName)
+        source.load()
+
+        guilds = {shardId: [] for shardId in shardIds}
+        for guild in source.exportGuilds():
+            shardGuilds = guilds.get(shardOf(guild.id, self.shardCount))
+            if shardGuilds != None:
+                shardGuilds.append(guild)
+
+        for shardId, shardGuilds in guilds.items():
+            self.shards[shardId].importGuilds(shardGuilds)
+            log.info('Seeded shard from the unsharded data file', extra = {'shard_id': shardId, 'guilds': len(shardGuilds)})
+
+        source.closeSync()
+
+    def storeFor(self, guildId):
+        shardId = shardOf(guildId, self.shardCount)
+        store = self.shards.get(shardId)
+        if store == None:
+            raise KeyError('Guild {} is on shard {}, which this process does not own'.format(guildId, shardId))
+
+        return store
+
+    def getGuild(self, guildId):
+        return self.storeFor(guildId).getGuild(guildId)
+
+    def createGuild(self, guildId, name):
+        self.storeFor(guildId).createGuild(guildId, name)
+
+    def deleteGuild(self, guildId):
+        self.storeFor(guildId).deleteGuild(guildId)
+
+    def setGuildSetting(self, guildId, key, value):
+        self.storeFor(guildId).setGuildSetting(guildId, key, value)
+
+    def announceGuilds(self):
+        guilds = []
+        for store in self.shards.values():
+            guilds.extend(store.announceGuilds())
+
+        return guilds
+
+    def guildIds(self):
+        guildIds = []
+        for store in self.shards.values():
+            guildIds.extend(store.guildIds())
+
+        return guildIds
+
+    def getUser(self, guildId, userId):
+        return self.storeFor(guildId).getUser(guildId, userId)
+
+    def setUser(self, guildId, userId, name, birthday):
+        self.storeFor(guildId).setUser(guildId, userId, name, birthday)
+
+    def setUsers(self, guildId, users):
+        self.storeFor(guildId).setUsers(guildId, users)
+
+    def deleteUser(self, guildId, userId):
+        self.storeFor(guildId).deleteUser(guildId, userId)
+
+    def deleteUsers(self, guildId, userIds):
+        return self.storeFor(guildId).deleteUsers(guildId, userIds)
+
+    def countUsers(self, guildId):
+        return self.storeFor(guildId).countUsers(guildId)
+
+    def iterUsers(self, guildId):
+        return self.storeFor(guildId).iterUsers(guildId)
+
+    def prefetch(self, guildId):
+        self.storeFor(guildId).prefetch(guildId)
+
+    def birthdayVersion(self, guildId):
+        return self.storeFor(guildId).birthdayVersion(guildId)
+
+    def snapshot(self, guildId, start = 1, end = DAYS_IN_YEAR):
+        return self.storeFor(guildId).snapshot(guildId, start, end)
+
+    def exportGuilds(self):
+        for store in self.shards.values():
+            yield from store.exportGuilds()
+
+    def importGuilds(self, guilds):
+        shardGuilds = {}
+        for guild in guilds:
+            shardGuilds.setdefault(self.storeFor(guild.id), []).append(guild)
+
+        for store, storeGuilds in shardGuilds.items():
+            store.importGuilds(storeGuilds)
+
+    def birthdaysBetween(self, guildId, start, end):
+        return self.storeFor(guildId).birthdaysBetween(guildId, start, end)
+
+    # Each shard store runs its own write-behind flush, so there is nothing to write here
+    async def writeChanges(self):
+        return None
+
+    def writeChangesSync(self):
+        pass
+
+    async def flush(self):
+        for store in self.shards.values():
+            await store.flush()
+
+    def flushSync(self):
+        for store in self.shards.values():
+            store.flushSync()
+
+    def closeSync(self):
+        for store in self.shards.values():
+            store.closeSync()
+
+    async def close(self):
+        for store in self.shards.values():
+            await store.close()
+
+def defaultFileName(backend):
+    if backend in ('sqlite', 'cached'):
+        return DEFAULT_DATABASE_FILE
+
+    if backend == 'binary':
+        return DEFAULT_SNAPSHOT_FILE
+
+    return DEFAULT_DATA_FILE
+
+#
+# Opens the given backend. With a shardCount the data is partitioned by shard and only the
+# shards in shardIds, all of them by default, are opened. cacheCapacity is the number of
+# birthdays the 'cached' backend keeps in memory.
+#
+def openStorage(backend, fileName = None, shardCount = None, shardIds = None, cacheCapacity = DEFAULT_CACHE_CAPACITY):
+    fileName = fileName or defaultFileName(backend)
+    if shardCount != None:
+        return ShardedStorage(backend, fileName, shardCount, shardIds if shardIds != None else range(shardCount), cacheCapacity)
+
+    if backend == 'json':
+        return JsonStore(fileName)
+
+    if backend == 'journal':
+        return JournalStore(fileName)
+
+    if backend == 'sqlite':
+        return SqliteStore(fileName)
+
+    if backend == 'cached':
+        return CachedStore(fileName, cacheCapacity)
+
+    if backend == 'binary':
+        return BinaryStore(fileName)
+
+    raise ValueError('Unknown storage backend: {}'.format(backend))
+
+#
+# Copies every guild and user from a data.json file into a SQLite database.
+# Entries with malformed dates are reported and skipped.
+#
+def migrateJsonToSqlite(jsonFileName = DEFAULT_DATA_FILE, sqliteFileName = DEFAULT_DATABASE_FILE):
+    with open(jsonFileName) as data_file:
+        data = json.load(data_file)
+
+    connection = sqlite3.connect(sqliteFileName)
+    createSqliteSchema(connection)
+
+    guildCount = 0
+    userCount = 0
+    with connection:
+        for guildId, guildData in data.items():
+            connection.execute(
+                'INSERT OR REPLACE INTO guilds (guild_id, {}) VALUES ({})'.format(GUILD_COLUMNS, GUILD_PLACEHOLDERS),
+                (int(guildId), guildData.get('name')) + tuple(guildData.get(key) for key in GUILD_SETTINGS))
+            guildCount += 1
+
+            for userId, userData in guildData.get('users', {}).items():
+                try:
+                    month, day = fromDayOfYear(parseStoredDate(userData.get('date')))
+                except ValueError:
+                    log.error('DATA_ERROR: Date format for user is invalid, skipping', extra = {'guild_id': guildId, 'user_id': userId})
+                    continue
+
+                connection.execute(
+                    'INSERT OR REPLACE INTO birthdays (guild_id, user_id, name, month, day) VALUES (?, ?, ?, ?, ?)',
+                    (int(guildId), int(userId), userData.get('name'), month, day))
+                userCount += 1
+
+    connection.close()
+    print('Migrated {} guilds and {} birthdays from {} to {}'.format(guildCount, userCount, jsonFileName, sqliteFileName))
+
+#
+# Copies every guild from one backend's data file into another's, replacing guilds the
+# target already has. IE a binary snapshot converted to the json backend is readable data.json.
+#
+def convertStorage(sourceBackend, sourceFileName, targetBackend, targetFileName):
+    source = openStorage(sourceBackend, sourceFileName)
+    source.load()
+    target = openStorage(targetBackend, targetFileName)
+    target.load()
+
+    guilds = list(source.exportGuilds())
+    target.importGuilds(guilds)
+    target.closeSync()
+    source.closeSync()
+    print('Converted {} guilds from {} to {}'.format(len(guilds), source.fileName, target.fileName))
+
+if __name__ == '__main__':
+    # python storage.py migrate [data.json] [data.db]
+    # python storage.py convert SOURCE_BACKEND SOURCE_FILE TARGET_BACKEND TARGET_FILE
+    if len(sys.argv) >= 2 and sys.argv[1] == 'migrate':
+        migrateJsonToSqlite(*sys.argv[2:4])
+    elif len(sys.argv) == 6 and sys.argv[1] == 'convert':
+        convertStorage(*sys.argv[2:6])
+    else:
+        print('Usage: python storage.py migrate [JSON_FILE] [SQLITE_FILE]')
+        print('       python storage.py convert SOURCE_BACKEND SOURCE_FILE TARGET_BACKEND TARGET_FILE')
+        sys.exit(1)
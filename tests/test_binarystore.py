@@ -0,0 +1,138 @@
+import asyncio
+import os
+import struct
+import threading
+
+import pytest
+
+from snapshotfile import FORMAT_VERSION, MAGIC
+from storage import BinaryStore
+
+def makeStore(fileName):
+    store = BinaryStore(fileName)
+    store.load()
+    store.createGuild(1, 'first')
+    store.setGuildSetting(1, 'channel_id', 10)
+    store.setGuildSetting(1, 'timezone', 'Europe/Berlin')
+    store.setUsers(1, [(100, 'alice', 60), (101, None, 60), (102, 'bøb', 365)])
+    store.createGuild(2, 'second')
+    store.setGuildSetting(2, 'timezone', -5)
+    store.setUser(2, 200, 'carol', 1)
+    store.closeSync()
+
+    store = BinaryStore(fileName)
+    store.load()
+    return store
+
+def users(store, guildId):
+    return [(userId, user.name, user.birthday) for userId, user in store.iterUsers(guildId)]
+
+def testSettingsChangeWithoutDecodingTheGuild(tmp_path):
+    fileName = str(tmp_path / 'data.bin')
+    store = makeStore(fileName)
+    store.setGuildSetting(1, 'last_announced', '2026-10-16')
+    store.setGuildSetting(1, 'timezone', 'America/New_York')
+    assert 1 in store.entries and 1 not in store.guilds
+
+    guild = store.getGuild(1)
+    assert (guild.name, guild.channelId, guild.timezone, guild.lastAnnounced) == ('first', 10, 'America/New_York', '2026-10-16')
+    assert [guild.lastAnnounced for guild in store.announceGuilds()] == ['2026-10-16']
+    store.closeSync()
+
+    # The block's users are copied as they are, with the new settings
+    store = BinaryStore(fileName)
+    store.load()
+    guild = store.getGuild(1)
+    assert (guild.name, guild.channelId, guild.timezone, guild.lastAnnounced) == ('first', 10, 'America/New_York', '2026-10-16')
+    assert users(store, 1) == [(100, 'alice', 60), (101, None, 60), (102, 'bøb', 365)]
+    assert users(store, 2) == [(200, 'carol', 1)]
+    assert len(store.overrides) == 0
+    store.closeSync()
+
+def testDecodedGuildKeepsChangedSettings(tmp_path):
+    store = makeStore(str(tmp_path / 'data.bin'))
+    store.setGuildSetting(2, 'announce_hour', 9)
+    store.setUser(2, 201, 'dave', 2)
+    guild = store.getGuild(2)
+    assert 2 in store.guilds and 2 not in store.overrides
+    assert (guild.timezone, guild.announceHour, sorted(guild.users)) == (-5, 9, [200, 201])
+    store.closeSync()
+
+def testSettingsChangedDuringAWriteAreKept(tmp_path):
+    fileName = str(tmp_path / 'data.bin')
+    store = makeStore(fileName)
+    store.flushDelay = 0
+    started = threading.Event()
+    release = threading.Event()
+    writeGuilds = store.writeGuilds
+
+    def slowWrite(*args):
+        started.set()
+        release.wait(10)
+        return writeGuilds(*args)
+
+    store.writeGuilds = slowWrite
+
+    async def run():
+        store.setGuildSetting(1, 'announce_hour', 8)
+        await asyncio.get_running_loop().run_in_executor(None, started.wait, 10)
+        store.setGuildSetting(1, 'announce_hour', 9)
+        release.set()
+        await store.flushTask
+        assert store.getGuild(1).announceHour == 9
+        await store.close()
+
+    asyncio.run(run())
+    store = BinaryStore(fileName)
+    store.load()
+    assert store.getGuild(1).announceHour == 9
+    store.closeSync()
+
+def testSnapshotRoundTrip(tmp_path):
+    fileName = str(tmp_path / 'data.bin')
+    store = BinaryStore(fileName)
+    store.load()
+    store.createGuild(1, 'fractional offset')
+    store.setGuildSetting(1, 'timezone', 5.5)
+    store.setGuildSetting(1, 'announce_hour', 0)
+    store.setGuildSetting(1, 'last_announced', '2024-02-29')
+    store.setGuildSetting(1, 'channel_id', -1)
+    store.createGuild(2, None)
+    store.createGuild(3, 'ünïcode')
+    store.setUsers(3, [(2 ** 62, 'big id', 366), (5, '', 1), (6, None, 1), (7, '名前', 200)])
+    store.closeSync()
+
+    store = BinaryStore(fileName)
+    store.load()
+    assert sorted(store.guildIds()) == [1, 2, 3]
+    assert store.countUsers(3) == 4
+    guild = store.getGuild(1)
+    assert (guild.name, guild.channelId, guild.timezone, guild.announceHour, guild.lastAnnounced) == (
+        'fractional offset', -1, 5.5, 0, '2024-02-29')
+    guild = store.getGuild(2)
+    assert (guild.name, guild.channelId, guild.timezone, guild.announceHour, guild.lastAnnounced) == (None, None, None, None, None)
+    assert users(store, 2) == []
+    assert users(store, 3) == [(5, '', 1), (6, None, 1), (7, '名前', 200), (2 ** 62, 'big id', 366)]
+    assert store.snapshot(3).birthdaysBetween(300, 10) == [(2 ** 62, 366), (5, 1), (6, 1)]
+    store.closeSync()
+
+def testNewerFormatVersionIsRefused(tmp_path):
+    fileName = str(tmp_path / 'data.bin')
+    makeStore(fileName).closeSync()
+    with open(fileName, 'r+b') as snapshot_file:
+        snapshot_file.seek(len(MAGIC))
+        snapshot_file.write(struct.pack('<H', FORMAT_VERSION + 1))
+
+    store = BinaryStore(fileName)
+    with pytest.raises(ValueError, match = 'format version'):
+        store.load()
+
+def testTruncatedSnapshotIsRefused(tmp_path):
+    fileName = str(tmp_path / 'data.bin')
+    makeStore(fileName).closeSync()
+    with open(fileName, 'r+b') as snapshot_file:
+        snapshot_file.truncate(os.path.getsize(fileName) - 1)
+
+    store = BinaryStore(fileName)
+    with pytest.raises(ValueError, match = 'truncated'):
+        store.load()
@@ -0,0 +1,83 @@
+import asyncio
+
+from storage import CachedStore, SqliteStore
+
+def makeDatabase(fileName):
+    database = SqliteStore(fileName)
+    database.load()
+    for guildId in (1, 2, 3):
+        database.createGuild(guildId, 'guild {}'.format(guildId))
+        database.setUsers(guildId, [(guildId * 100 + index, 'user', index + 1) for index in range(3)])
+    database.closeSync()
+
+# Users as stored in the database, bypassing the cache
+def storedUsers(fileName, guildId):
+    database = SqliteStore(fileName)
+    database.load()
+    try:
+        return [(userId, user.name, user.birthday) for userId, user in database.iterUsers(guildId)]
+    finally:
+        database.closeSync()
+
+def testChangesAreWrittenBackOnEviction(tmp_path):
+    fileName = str(tmp_path / 'data.db')
+    makeDatabase(fileName)
+    # Room for one guild of three users and its settings
+    store = CachedStore(fileName, capacity = 4, flushDelay = 60)
+    store.load()
+
+    # Changes wait for the flush inside an event loop
+    async def run():
+        store.setUser(1, 100, 'renamed', 50)
+        store.deleteUser(1, 101)
+        assert list(store.guilds) == [1]
+        assert store.guilds[1].dirtyUsers == {100, 101}
+
+        # Paging in guild 2 evicts guild 1, which writes its changes to the database
+        assert store.getUser(2, 200).name == 'user'
+        assert list(store.guilds) == [2]
+        assert store.countUsers(1) == 2
+        await store.database.flush()
+        assert storedUsers(fileName, 1) == [(102, 'user', 3), (100, 'renamed', 50)]
+
+        # Paged back in with the changes
+        assert store.getUser(1, 100).birthday == 50
+        assert 101 not in store.getGuild(1).users
+        await store.close()
+
+    asyncio.run(run())
+
+def testUnchangedGuildsAreNotWrittenBack(tmp_path):
+    fileName = str(tmp_path / 'data.db')
+    makeDatabase(fileName)
+    store = CachedStore(fileName, capacity = 4)
+    store.load()
+    store.getGuild(1)
+    store.getGuild(2)
+    assert store.database.dirty == False
+    store.closeSync()
+
+def testChangesAreWrittenBackOnClose(tmp_path):
+    fileName = str(tmp_path / 'data.db')
+    makeDatabase(fileName)
+    store = CachedStore(fileName, flushDelay = 60)
+
+    async def run():
+        store.load()
+        store.setUser(3, 300, 'renamed', 200)
+        store.setUsers(3, [(303, 'new', 1)])
+        store.deleteUsers(3, [301, 302])
+        await store.close()
+
+    asyncio.run(run())
+    assert len(store.guilds) == 0
+    assert storedUsers(fileName, 3) == [(303, 'new', 1), (300, 'renamed', 200)]
+
+def testChangesAreWrittenBackOnCloseSync(tmp_path):
+    fileName = str(tmp_path / 'data.db')
+    makeDatabase(fileName)
+    store = CachedStore(fileName)
+    store.load()
+    store.setUser(2, 203, 'new', 100)
+    store.closeSync()
+    assert storedUsers(fileName, 2)[-1] == (203, 'new', 100)
@@ -0,0 +1,103 @@
+import asyncio
+import json
+import threading
+import time
+
+import storage
+
+from storage import JsonStore
+
+def readData(dataFile):
+    with open(dataFile) as data_file:
+        return json.load(data_file)
+
+def testFailedFlushIsRetriedOnTheNextChange(tmp_path):
+    dataFile = tmp_path / 'data.json'
+    store = JsonStore(str(dataFile), flushDelay = 0)
+    store.load()
+    writeChanges = store.writeChanges
+    failures = []
+
+    async def failOnce():
+        if len(failures) == 0:
+            failures.append(True)
+            raise RuntimeError('disk on fire')
+        return await writeChanges()
+
+    store.writeChanges = failOnce
+
+    async def run():
+        store.createGuild(7, 'guild')
+        await store.flushTask
+        # The error is logged instead of escaping and the change stays pending
+        assert store.dirty == True
+        assert readData(dataFile) == {}
+
+        store.setUser(7, 70, 'alice', 100)
+        await store.flushTask
+        assert store.dirty == False
+
+    asyncio.run(run())
+    assert readData(dataFile)['7']['users']['70']['name'] == 'alice'
+
+def testWriteSeesGuildsAsTheyWereWhenItStarted(tmp_path, monkeypatch):
+    dataFile = tmp_path / 'data.json'
+    store = JsonStore(str(dataFile), flushDelay = 0)
+    store.load()
+    store.createGuild(1, 'changed')
+    store.setUser(1, 10, 'alice', 100)
+    store.createGuild(2, 'untouched')
+    store.setUser(2, 20, 'bob', 200)
+    store.flushSync()
+    untouched = store.getGuild(2)
+
+    started = threading.Event()
+    release = threading.Event()
+    writeGuildsAtomic = storage.writeGuildsAtomic
+    written = []
+    passed = []
+
+    def slowWrite(fileName, guilds):
+        passed.append(guilds)
+        started.set()
+        release.wait(10)
+        written.append({guild.id: dict(guild.users) for guild in guilds})
+        return writeGuildsAtomic(fileName, guilds)
+
+    monkeypatch.setattr(storage, 'writeGuildsAtomic', slowWrite)
+
+    async def run():
+        store.setGuildSetting(1, 'announce_hour', 9)
+        await asyncio.sleep(0)
+        await asyncio.get_running_loop().run_in_executor(None, started.wait, 10)
+
+        # Changes made during the write go to a copy of the guild, the write keeps the original
+        store.setUser(1, 11, 'carol', 300)
+        store.deleteUser(1, 10)
+        store.setGuildSetting(1, 'announce_hour', 10)
+        release.set()
+        await store.flushTask
+
+    asyncio.run(run())
+    # Nothing is copied for the flush itself
+    assert any(guild is untouched for guild in passed[0])
+    assert store.getGuild(2) is untouched
+    assert sorted(written[0][1]) == [10]
+    assert sorted(written[-1][1]) == [11]
+    data = readData(dataFile)
+    assert data['1']['announce_hour'] == 10
+    assert sorted(data['1']['users']) == ['11']
+
+def testCloseRightAfterAChangeDoesNotWaitForTheFlushDelay(tmp_path):
+    dataFile = tmp_path / 'data.json'
+    store = JsonStore(str(dataFile), flushDelay = 60)
+    store.load()
+
+    async def run():
+        store.createGuild(7, 'guild')
+        started = time.monotonic()
+        await store.close()
+        assert time.monotonic() - started < 5
+
+    asyncio.run(run())
+    assert readData(dataFile)['7']['name'] == 'guild'
@@ -0,0 +1,91 @@
+import json
+import os
+
+from storage import JournalStore
+
+def makeStore(fileName):
+    store = JournalStore(fileName)
+    store.load()
+    store.createGuild(1, 'guild')
+    store.setGuildSetting(1, 'channel_id', 10)
+    store.setUser(1, 100, 'alice', 60)
+    store.setUser(1, 101, 'bob', 61)
+    store.deleteUser(1, 101)
+    store.closeSync()
+
+def users(store, guildId):
+    return [(userId, user.name, user.birthday) for userId, user in store.iterUsers(guildId)]
+
+def reload(fileName):
+    store = JournalStore(fileName)
+    store.load()
+    return store
+
+def testJournalIsReplayedOverTheSnapshot(tmp_path):
+    fileName = str(tmp_path / 'data.json')
+    makeStore(fileName)
+    with open(fileName) as data_file:
+        assert json.load(data_file) == {}
+
+    store = reload(fileName)
+    assert store.getGuild(1).channelId == 10
+    assert users(store, 1) == [(100, 'alice', 60)]
+    store.closeSync()
+
+    # Recovery folds the journal into the snapshot and starts a new one
+    with open(fileName) as data_file:
+        assert list(json.load(data_file)['1']['users']) == ['100']
+    with open(fileName + '.journal') as journal:
+        assert journal.read() == ''
+
+def testTornLastRecordIsIgnored(tmp_path):
+    fileName = str(tmp_path / 'data.json')
+    makeStore(fileName)
+    record = json.dumps({'op': 'set-birthday', 'guild': 1, 'user': 102, 'name': 'carol', 'date': '3-4'})
+    with open(fileName + '.journal', 'a') as journal:
+        journal.write(record[:len(record) // 2])
+
+    store = reload(fileName)
+    assert users(store, 1) == [(100, 'alice', 60)]
+    store.closeSync()
+
+def testTruncatedJournalKeepsTheRecordsBeforeTheCut(tmp_path):
+    fileName = str(tmp_path / 'data.json')
+    makeStore(fileName)
+    with open(fileName + '.journal') as journal:
+        lines = journal.readlines()
+
+    # Cut inside the record that sets bob, so neither it nor the records after it survive
+    with open(fileName + '.journal', 'w') as journal:
+        journal.write(''.join(lines[:3]) + lines[3][:-10])
+
+    store = reload(fileName)
+    assert store.getGuild(1).channelId == 10
+    assert users(store, 1) == [(100, 'alice', 60)]
+    store.closeSync()
+
+def testInvalidRecordsAreSkipped(tmp_path):
+    fileName = str(tmp_path / 'data.json')
+    makeStore(fileName)
+    with open(fileName + '.journal', 'a') as journal:
+        journal.write(json.dumps({'op': 'set-birthday', 'guild': 2, 'user': 200, 'name': 'dave', 'date': '1-1'}) + '\n')
+        journal.write(json.dumps({'op': 'set-birthday', 'guild': 1, 'user': 102, 'name': 'eve', 'date': '2-30'}) + '\n')
+        journal.write(json.dumps({'op': 'set-birthday', 'guild': 1, 'user': 103, 'name': 'frank', 'date': '1-5'}) + '\n')
+
+    store = reload(fileName)
+    assert store.guildIds() == [1]
+    assert users(store, 1) == [(103, 'frank', 5), (100, 'alice', 60)]
+    store.closeSync()
+
+def testInterruptedCompactionIsReplayedFirst(tmp_path):
+    fileName = str(tmp_path / 'data.json')
+    makeStore(fileName)
+    # A compaction set the journal aside and never finished, then more records were made
+    os.replace(fileName + '.journal', fileName + '.journal.compacting')
+    with open(fileName + '.journal', 'w') as journal:
+        journal.write(json.dumps({'op': 'set-birthday', 'guild': 1, 'user': 100, 'name': 'alice', 'date': '12-31'}) + '\n')
+
+    store = reload(fileName)
+    assert users(store, 1) == [(100, 'alice', 366)]
+    store.closeSync()
+    assert os.path.exists(fileName + '.journal.compacting') == False
@@ -0,0 +1,31 @@
+import io
+import json
+
+import pytest
+
+from storage import readJsonObjectItems
+
+# Numbers in every form the decoder can stop partway through, next to strings and containers
+DOCUMENT = ('{"a": 1.5, "b": 1e5, "c": 0.0001, "d": -2.5E-3, "e": 7E+2, "f": 12345678901234567890, '
+    '"g": [1.25, -3, "x"], "h": {"i": 3.75, "j": "\\u00e9"}, "k": true, "l": false, "m": null, "n": 10}')
+
+def readItems(text, chunkSize):
+    return list(readJsonObjectItems(io.StringIO(text), chunkSize = chunkSize))
+
+def testEveryChunkSizeReadsTheSameItems():
+    expected = list(json.loads(DOCUMENT).items())
+    for chunkSize in range(1, len(DOCUMENT) + 2):
+        assert readItems(DOCUMENT, chunkSize) == expected, 'chunk size {}'.format(chunkSize)
+
+@pytest.mark.parametrize('chunkSize', [1, 2, 4, 8])
+def testFractionSplitAtAChunkBoundary(chunkSize):
+    assert readItems('{"a": 1.5}', chunkSize) == [('a', 1.5)]
+
+def testEmptyObject():
+    assert readItems(' { } ', 1) == []
+
+@pytest.mark.parametrize('text', ['[1, 2]', '{"a": 1', '{"a" 1}', '{1: 2}', '{"a": 1.}'])
+def testMalformedDocumentsRaise(text):
+    for chunkSize in (1, 3, 64):
+        with pytest.raises(ValueError):
+            readItems(text, chunkSize)
@@ -0,0 +1,27 @@
+from datetime import datetime
+
+import pytest
+
+from scheduler import AnnouncementScheduler
+from storage import openStorage
+
+async def announce(guildId, localDate):
+    pass
+
+@pytest.mark.parametrize('backend, pagesGuilds', [
+    ('json', False), ('journal', False), ('sqlite', False), ('binary', False), ('cached', True)])
+def testOnlyTheCachedBackendPagesGuilds(tmp_path, backend, pagesGuilds):
+    fileName = str(tmp_path / 'data')
+    assert openStorage(backend, fileName).pagesGuilds == pagesGuilds
+    assert openStorage(backend, fileName, shardCount = 2).pagesGuilds == pagesGuilds
+
+def testSchedulerWithoutPrefetchOnlyWakesForAnnouncements():
+    scheduler = AnnouncementScheduler(announce)
+    scheduler.schedule(1, 'Europe/Berlin', 9, now = datetime(2026, 10, 17, 12))
+    assert scheduler.nextPrefetch() == None
+    assert scheduler.nextDue() == datetime(2026, 10, 18, 7)
+
+def testSchedulerWithPrefetchWakesBeforeTheAnnouncement():
+    scheduler = AnnouncementScheduler(announce, lambda guildId: None)
+    scheduler.schedule(1, 'Europe/Berlin', 9, now = datetime(2026, 10, 17, 12))
+    assert scheduler.nextPrefetch()[0] == datetime(2026, 10, 18, 7)
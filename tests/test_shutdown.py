@@ -0,0 +1,54 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs the bot's client without connecting, makes a change that waits for the flush delay and
+# then waits for the client to be closed by a signal
+CHILD = '''
+import asyncio
+import main
+
+async def run():
+    async with main.client:
+        main.store.load()
+        main.store.flushDelay = 60
+        main.client.handleSignals()
+        main.store.createGuild(7, 'guild')
+        main.store.setUser(7, 70, 'alice', 100)
+        print('ready', flush = True)
+        while main.client.closing == None:
+            await asyncio.sleep(0.01)
+        await main.client.closing
+
+main.setup()
+asyncio.run(run())
+'''
+
+def readData(dataFile):
+    if dataFile.exists() == False:
+        return {}
+
+    with open(dataFile) as data_file:
+        return json.load(data_file)
+
+def testSigtermWritesPendingChanges(tmp_path):
+    dataFile = tmp_path / 'data.json'
+    environment = dict(os.environ, DATA_FILE = str(dataFile), DATA_STORAGE = 'json', SEND_DRAIN_TIMEOUT = '0')
+    child = subprocess.Popen([sys.executable, '-c', CHILD], cwd = REPO, env = environment,
+        stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, text = True)
+    try:
+        assert child.stdout.readline().strip() == 'ready'
+        # The change is still waiting for the flush delay
+        assert readData(dataFile).get('7') == None
+
+        child.send_signal(signal.SIGTERM)
+        assert child.wait(timeout = 30) == 0
+    finally:
+        if child.poll() == None:
+            child.kill()
+
+    assert readData(dataFile)['7']['users']['70']['name'] == 'alice'
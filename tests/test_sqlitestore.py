@@ -0,0 +1,72 @@
+import sqlite3
+
+from storage import SqliteStore
+
+# guilds as created by versions that declared timezone INTEGER
+OLD_SCHEMA = '''
+CREATE TABLE guilds (
+    guild_id INTEGER PRIMARY KEY,
+    name TEXT,
+    channel_id INTEGER,
+    timezone INTEGER,
+    announce_hour INTEGER,
+    last_announced TEXT
+);
+
+CREATE TABLE birthdays (
+    guild_id INTEGER NOT NULL REFERENCES guilds (guild_id) ON DELETE CASCADE,
+    user_id INTEGER NOT NULL,
+    name TEXT,
+    month INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    PRIMARY KEY (guild_id, user_id)
+);
+
+INSERT INTO guilds VALUES (1, 'named', 10, 'Europe/Berlin', 9, NULL);
+INSERT INTO guilds VALUES (2, 'offset', 20, -5, 0, '2026-10-16');
+INSERT INTO birthdays VALUES (1, 100, 'alice', 3, 4);
+INSERT INTO birthdays VALUES (2, 200, 'bob', 12, 31);
+'''
+
+def timezoneType(fileName):
+    connection = sqlite3.connect(fileName)
+    try:
+        return {row[1]: row[2] for row in connection.execute('PRAGMA table_info(guilds)')}['timezone']
+    finally:
+        connection.close()
+
+def testTimezoneKeepsNamesAndOffsets(tmp_path):
+    store = SqliteStore(str(tmp_path / 'data.db'))
+    store.load()
+    store.createGuild(1, 'named')
+    store.createGuild(2, 'offset')
+    store.createGuild(3, 'numeric name')
+    store.setGuildSetting(1, 'timezone', 'America/New_York')
+    store.setGuildSetting(2, 'timezone', 14)
+    store.setGuildSetting(3, 'timezone', '5')
+    store.closeSync()
+
+    store.load()
+    assert store.getGuild(1).timezone == 'America/New_York'
+    assert store.getGuild(2).timezone == 14
+    assert store.getGuild(3).timezone == '5'
+    store.closeSync()
+
+def testIntegerTimezoneColumnIsMigrated(tmp_path):
+    fileName = str(tmp_path / 'data.db')
+    connection = sqlite3.connect(fileName)
+    connection.executescript(OLD_SCHEMA)
+    connection.close()
+
+    store = SqliteStore(fileName)
+    store.load()
+    assert timezoneType(fileName) == ''
+    assert store.getGuild(1).timezone == 'Europe/Berlin'
+    assert store.getGuild(2).timezone == -5
+    assert store.getGuild(2).lastAnnounced == '2026-10-16'
+    # Birthdays survive the old guilds table being dropped, and still cascade afterwards
+    assert store.getUser(1, 100).name == 'alice'
+    assert store.getUser(2, 200).name == 'bob'
+    store.deleteGuild(2)
+    assert store.countUsers(2) == 0
+    store.closeSync()
@@ -0,0 +1,106 @@
+import time
+
+from metrics import COMMANDS_THROTTLED, THROTTLE_BUCKETS
+from outbound import TokenBucket
+
+# Commands a user may send per second, and in a burst
+DEFAULT_USER_RATE = 0.5
+DEFAULT_USER_BURST = 5
+# Commands a guild's users may send together per second, and in a burst
+DEFAULT_GUILD_RATE = 5
+DEFAULT_GUILD_BURST = 20
+
+# A throttled user is told at most once this many seconds, further commands are dropped silently
+WARN_INTERVAL = 30
+# How often buckets that have refilled completely are dropped
+SWEEP_INTERVAL = 60
+
+#
+# Token buckets by key, created on first use. A bucket that has refilled completely is the
+# same as no bucket, so sweep() drops those to keep memory bounded by recent senders.
+#
+class KeyedBuckets:
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        # {key: TokenBucket}
+        self.buckets = {}
+
+    def bucket(self, key):
+        bucket = self.buckets.get(key)
+        if bucket == None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self.buckets[key] = bucket
+
+        return bucket
+
+    def sweep(self, now):
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if bucket.isFull(now) == False}
+
+    def __len__(self):
+        return len(self.buckets)
+
+#
+# Limits how many commands each user and each guild can send. check() is meant to run before
+# a message is parsed or any data is touched, so excess commands cost a couple of dict
+# lookups. A rate of 0 turns that limit off.
+#
+class CommandThrottle:
+
+    def __init__(self, userRate = DEFAULT_USER_RATE, userBurst = DEFAULT_USER_BURST,
+            guildRate = DEFAULT_GUILD_RATE, guildBurst = DEFAULT_GUILD_BURST):
+        self.users = KeyedBuckets(userRate, userBurst) if userRate > 0 else None
+        self.guilds = KeyedBuckets(guildRate, guildBurst) if guildRate > 0 else None
+        # {userId: when the user was last told they are throttled}
+        self.warned = {}
+        self.swept = time.monotonic()
+
+    #
+    # Returns None if the command may run, otherwise the scope of the limit it hit, 'user' or
+    # 'guild'. guildId is None for direct messages. Tokens are only taken once both limits
+    # allow the command, so a rejected command does not count against the other limit.
+    #
+    def check(self, userId, guildId):
+        now = time.monotonic()
+        if now - self.swept >= SWEEP_INTERVAL:
+            self.sweep(now)
+
+        userBucket = None
+        if self.users != None:
+            userBucket = self.users.bucket(userId)
+            if userBucket.available(now) == False:
+                COMMANDS_THROTTLED.inc(scope = 'user')
+                return 'user'
+
+        guildBucket = None
+        if guildId != None and self.guilds != None:
+            guildBucket = self.guilds.bucket(guildId)
+            if guildBucket.available(now) == False:
+                COMMANDS_THROTTLED.inc(scope = 'guild')
+                return 'guild'
+
+        if userBucket != None:
+            userBucket.tryAcquire(now)
+        if guildBucket != None:
+            guildBucket.tryAcquire(now)
+
+        return None
+
+    # Returns True if a throttled user should be told so, at most once every WARN_INTERVAL seconds
+    def shouldWarn(self, userId):
+        now = time.monotonic()
+        warned = self.warned.get(userId)
+        if warned != None and now - warned < WARN_INTERVAL:
+            return False
+
+        self.warned[userId] = now
+        return True
+
+    def sweep(self, now):
+        self.swept = now
+        self.warned = {userId: warned for userId, warned in self.warned.items() if now - warned < WARN_INTERVAL}
+        for scope, buckets in (('user', self.users), ('guild', self.guilds)):
+            if buckets != None:
+                buckets.sweep(now)
+                THROTTLE_BUCKETS.set(len(buckets), scope = scope)
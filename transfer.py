@@ -0,0 +1,189 @@
+import csv
+import io
+import json
+import os
+import sys
+
+from dotenv import load_dotenv
+
+from commands import DATE_PATTERN, USER_PATTERN
+from model import formatStoredDate, toDayOfYear
+from storage import openStorage, readJsonObjectItems
+
+#
+# Bulk import and export of a guild's birthdays, shared by the `import` and `export` commands
+# and the command line below. Two formats are supported:
+#   csv     a header row with user_id, name and date columns, IE `1234,Alice,7-4`
+#   json    an object of users keyed by id, the same shape as the users of a guild in data.json
+# user_id may also be a mention and date is MM-DD, like the date argument of `!bday DATE`.
+#
+FORMATS = ('csv', 'json')
+CSV_COLUMNS = ('user_id', 'name', 'date')
+
+# Exports are produced in pieces of about this many characters
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+# How many rejected rows an import summary lists individually
+MAX_LISTED_REJECTIONS = 10
+
+# Returns the format of a file by its extension, or None if it is not supported
+def formatOf(fileName):
+    extension = os.path.splitext(fileName)[1].lower().lstrip('.')
+    return extension if extension in FORMATS else None
+
+def parseUserId(value):
+    value = str(value).strip()
+    userMatches = USER_PATTERN.fullmatch(value)
+    if userMatches != None:
+        value = userMatches.group(1)
+
+    if value.isdigit() == False:
+        raise ValueError('invalid user id {!r}'.format(value))
+
+    return int(value)
+
+def parseDate(value):
+    dateMatches = DATE_PATTERN.fullmatch(str(value).strip())
+    if dateMatches == None:
+        raise ValueError('invalid date {!r}'.format(value))
+
+    try:
+        return toDayOfYear(int(dateMatches.group(1)), int(dateMatches.group(2)))
+    except ValueError:
+        raise ValueError('invalid date {!r}'.format(value))
+
+#
+# Validated rows of an import. Later rows for the same user replace earlier ones.
+# users: {userId: (name, birthday)}
+#
+class ImportResult:
+
+    def __init__(self):
+        self.users = {}
+        self.rejected = 0
+        self.reasons = []
+
+    def reject(self, where, reason):
+        self.rejected += 1
+        if len(self.reasons) < MAX_LISTED_REJECTIONS:
+            self.reasons.append('{}: {}'.format(where, reason))
+
+# Yields (where, userId, name, date) for each data row of a CSV file
+def readCsvRows(textFile):
+    reader = csv.DictReader(textFile)
+    if reader.fieldnames == None or 'user_id' not in reader.fieldnames or 'date' not in reader.fieldnames:
+        raise ValueError('CSV files need a header row with user_id, name and date columns')
+
+    for row in reader:
+        yield 'line {}'.format(reader.line_num), row.get('user_id'), row.get('name'), row.get('date')
+
+# Yields (where, userId, name, date) for each user of a JSON file, without loading the whole file
+def readJsonRows(textFile):
+    for userId, userData in readJsonObjectItems(textFile):
+        if isinstance(userData, dict) == False:
+            # Rejected as a date that is not MM-DD
+            yield 'user {}'.format(userId), userId, None, userData
+            continue
+
+        yield 'user {}'.format(userId), userId, userData.get('name'), userData.get('date')
+
+#
+# Parses and validates an import file row by row. Raises ValueError if the file as a whole
+# cannot be read, IE malformed JSON or a CSV without a header. Bad rows are only rejected.
+#
+def parseImport(textFile, format):
+    rows = readCsvRows(textFile) if format == 'csv' else readJsonRows(textFile)
+    result = ImportResult()
+    for where, userId, name, date in rows:
+        try:
+            userId = parseUserId(userId)
+            birthday = parseDate(date)
+        except ValueError as error:
+            result.reject(where, error)
+            continue
+
+        result.users[userId] = (name.strip() if isinstance(name, str) else None, birthday)
+
+    return result
+
+# Opens the bytes of an uploaded file for parseImport. Tolerates the byte order mark spreadsheets add.
+def openImportBytes(data):
+    return io.TextIOWrapper(io.BytesIO(data), encoding = 'utf-8-sig', newline = '')
+
+#
+# Yields an export of users, an iterable of (userId, UserRecord), as text chunks of about
+# chunkSize characters so large guilds never sit in memory as one string.
+#
+def exportChunks(users, format, chunkSize = EXPORT_CHUNK_SIZE):
+    buffer = io.StringIO()
+    if format == 'csv':
+        writer = csv.writer(buffer, lineterminator = '\n')
+        writer.writerow(CSV_COLUMNS)
+        for userId, userData in users:
+            writer.writerow((userId, userData.name, formatStoredDate(userData.birthday)))
+            if buffer.tell() >= chunkSize:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+    else:
+        separator = '{\n'
+        for userId, userData in users:
+            buffer.write('{}{}: {}'.format(separator, json.dumps(str(userId)), json.dumps(userData.toJson())))
+            separator = ',\n'
+            if buffer.tell() >= chunkSize:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+
+        buffer.write('{' if separator == '{\n' else '\n')
+        buffer.write('}\n')
+
+    yield buffer.getvalue()
+
+#
+# Offline import and export against the configured storage, for onboarding a server from a
+# spreadsheet or backing one up. Only run it while the bot is stopped, the bot would
+# overwrite the changes with its own copy of the data.
+#
+def runImport(store, guildId, fileName):
+    with open(fileName, encoding = 'utf-8-sig', newline = '') as import_file:
+        result = parseImport(import_file, formatOf(fileName))
+
+    store.setUsers(guildId, ((userId, name, birthday) for userId, (name, birthday) in result.users.items()))
+    print('Imported {} birthdays, rejected {} rows'.format(len(result.users), result.rejected))
+    for reason in result.reasons:
+        print('  ' + reason)
+
+def runExport(store, guildId, fileName):
+    with open(fileName, 'w', encoding = 'utf-8', newline = '') as export_file:
+        for chunk in exportChunks(store.iterUsers(guildId), formatOf(fileName)):
+            export_file.write(chunk)
+
+    print('Exported {} birthdays to {}'.format(store.countUsers(guildId), fileName))
+
+if __name__ == '__main__':
+    # python transfer.py import|export GUILD_ID FILE
+    if len(sys.argv) != 4 or sys.argv[1] not in ('import', 'export') or formatOf(sys.argv[3]) == None:
+        print('Usage: python transfer.py import|export GUILD_ID FILE.csv|FILE.json')
+        sys.exit(1)
+
+    # Same storage configuration as the bot
+    load_dotenv()
+    shardCount = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+    store = openStorage(os.getenv('DATA_STORAGE', 'json'), os.getenv('DATA_FILE'), shardCount)
+    store.load()
+    guildId = int(sys.argv[2])
+    try:
+        store.getGuild(guildId)
+    except KeyError:
+        print('Guild {} has no data yet, use the bot in it first'.format(guildId))
+        store.closeSync()
+        sys.exit(1)
+
+    try:
+        if sys.argv[1] == 'import':
+            runImport(store, guildId, sys.argv[3])
+        else:
+            runExport(store, guildId, sys.argv[3])
+    finally:
+        store.closeSync()